@@ -86,7 +86,52 @@ class FogRain:
         l = np.clip(l, 0, 1)
         return l
 
-    def fog_rain_layer(self, image, depth):
+    @staticmethod
+    def extinction_base(image, depth):
+        '''
+        Function to compute the part of fog_rain_layer which does not depend on the rain intensity, to share it when a
+        frame is rendered for several intensities: extinction exp(-beta_ext * depth) only differs by beta_ext.
+        :return: Dictionary, see fog_rain_layer.
+        '''
+        return {"depth": depth.astype(np.float32),
+                "image_mean": np.mean(image.reshape(-1, 3), axis=0, dtype=np.float64)}
+
+    def fog_rain_layer(self, image, depth, base=None):
+        '''
+        Fused float32 version of fog_rain_layer_reference.
+        Extinction is computed once as a single channel, and since l_in is (1 - f_ext) scaled per channel the blur is
+        linear, so blur(l_in) = l_in_scale * (1 - blur(f_ext)) unless l_in is clipped (then the channel is blurred).
+        :param image: Image (H, W, 3) in [0, 1].
+        :param depth: Depth map (H, W) in meters.
+        :param base: Optional extinction base of image and depth (see extinction_base).
+        :return: Image with fog-like rain, of same type as image.
+        '''
+        if base is None:
+            base = self.extinction_base(image, depth)
+
+        self.beta_ext = self.calc_beta_ext()
+        f_ext = np.exp(np.float32(-self.beta_ext / 1000) * base["depth"])
+
+        # Mean of the irradiance (see calc_irradiance), without the full size irradiance image
+        irradiance_factor = (4 * (self.f_number ** 2)) / (self.exposure_time * self.camera_gain * np.pi)
+        irradiance_mean = irradiance_factor * base["image_mean"]
+        l_in_scale = self.calc_beta_hg() * irradiance_mean
+
+        f_ext_blur = cv2.GaussianBlur(f_ext, (25, 25), 25)
+        l_in = np.empty(image.shape, dtype=np.float32)
+        for c in range(3):
+            if l_in_scale[c] * (1 - f_ext.min()) <= 1:
+                l_in[..., c] = np.float32(l_in_scale[c]) * (1 - f_ext_blur)
+            else:
+                l_in[..., c] = cv2.GaussianBlur(np.clip(np.float32(l_in_scale[c]) * (1 - f_ext), 0, 1), (25, 25), 25)
+
+        # A multiscale model for rain rendering in real-time (Weber 2015), Eq. 13
+        l = image.astype(np.float32) * np.expand_dims(f_ext_blur, axis=-1) + l_in
+        l = np.clip(l, 0, 1)
+
+        return l.astype(image.dtype, copy=False)
+
+    def fog_rain_layer_reference(self, image, depth):
         self.current_image = image.copy()
         self.current_depth = depth.copy()
 
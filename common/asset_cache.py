@@ -0,0 +1,124 @@
+import collections
+import os
+import threading
+
+import numpy as np
+
+'''
+Process-wide cache of the assets read from files: streak textures, their normalization coefficients and particles
+simulations.
+
+Assets are shared by all the simulations rendered by a process, e.g. textures are read once instead of once per
+sequence and intensity, and sequences resolving to the same simulation file open it once. They are keyed by kind,
+path(s) and loading parameters, and validated against the modification time and size of their files, so that edited
+files are reloaded. Assets are evicted in least recently used order beyond a memory budget, memory-mapped arrays being
+accounted for free (their pages belong to the OS cache). Cached assets are shared, hence must not be modified.
+'''
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def signature(path):
+    '''
+    Function to identify the version of a file, or of the files of a folder (not recursive).
+    :return: Hashable signature, None if the path does not exist.
+    '''
+    if not os.path.exists(path):
+        return None
+
+    if os.path.isdir(path):
+        return tuple(sorted((e.name, e.stat().st_mtime_ns, e.stat().st_size) for e in os.scandir(path) if e.is_file()))
+
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def nbytes(value, depth=3):
+    '''
+    Function to estimate the memory held by an asset: arrays (memory maps excluded) in containers and objects.
+    '''
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if depth == 0:
+        return 0
+    if isinstance(value, dict):
+        return sum(nbytes(v, depth - 1) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v, depth - 1) for v in value)
+    if hasattr(value, '__dict__'):
+        return nbytes(vars(value), depth)
+    return 0
+
+
+class AssetCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+        :param max_bytes: Memory budget of cached assets.
+        '''
+        self.max_bytes = max_bytes
+        self.assets = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "AssetCache({} assets, {:.1f}MB, {} hits, {} misses, {} evictions)".format(
+            len(self.assets), self.bytes / 2 ** 20, self.hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return len(self.assets)
+
+    def load(self, kind, paths, build, params=()):
+        '''
+        Function to fetch an asset, loading it if not cached or if its files changed.
+        :param kind: Kind of asset (e.g. 'streaks').
+        :param paths: Path, or list of paths, the asset is read from.
+        :param build: Function returning the asset, called if it is not cached.
+        :param params: Hashable loading parameters, other than paths.
+        :return: Asset (shared, must not be modified).
+        '''
+        paths = [paths] if isinstance(paths, str) else list(paths)
+        key = (kind, tuple(os.path.abspath(p) for p in paths), params)
+        sig = tuple(signature(p) for p in paths)
+
+        with self.lock:
+            entry = self.assets.get(key)
+            if entry is not None and entry[0] == sig:
+                self.assets.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Loaded outside of the lock, concurrent loads of the same asset are harmless
+        value = build()
+        size = nbytes(value)
+
+        with self.lock:
+            if key in self.assets:
+                self.bytes -= self.assets.pop(key)[2]
+            self.assets[key] = (sig, value, size)
+            self.bytes += size
+            # The asset just loaded is kept, even beyond the budget
+            while self.bytes > self.max_bytes and len(self.assets) > 1:
+                _, (_, _, evicted_size) = self.assets.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.assets.clear()
+            self.bytes = 0
+
+
+# Cache of the process (each process of a pool has its own)
+assets = AssetCache()
+
+
+def load(kind, paths, build, params=()):
+    return assets.load(kind, paths, build, params)
@@ -1,17 +1,21 @@
 import hashlib
 import os
 import sys
+import time
 import traceback
 from enum import Enum
-from xml.etree.ElementTree import parse
+from xml.etree.ElementTree import ParseError, iterparse
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pyclipper
-from scipy.ndimage.filters import gaussian_filter
 
-from common import my_utils, db
+from common import my_utils, db, particles_bin, geometry_cache, solid_angle, asset_cache
+from common.particles_bin import ParticlesSim
+from common.streak_sampler import StreakSampler
+from common.streak_splat import StreakSplatter
+from common.transmittance import TransmittanceBuffer
 
 plt.ion()
 
@@ -36,6 +40,18 @@ except Exception:
 
 cache = {}
 
+# Luminance (Y) of a white drop pixel, in the xyY space used to colour drops
+GRAY_LUMINANCE = my_utils.convert_rgb_to_xyY(np.ones(3))[2]
+
+# Defocus blur: gaussian kernels are truncated at DEFOCUS_TRUNCATE sigmas (as scipy gaussian_filter), and sigmas can
+# be bucketed by DEFOCUS_SIGMA_STEP pixels to share kernels across drops (0 for exact sigmas)
+DEFOCUS_TRUNCATE = 4.0
+DEFOCUS_SIGMA_STEP = 0.
+
+# Drops are classified by their maximum width (pixels): Big from BIG_DROP_WIDTH, Medium above SMALL_DROP_WIDTH
+BIG_DROP_WIDTH = 4
+SMALL_DROP_WIDTH = 1
+
 
 class DropType(Enum):
     Big = 0
@@ -62,6 +78,28 @@ class Streak:
     def __repr__(self):
         return str(self.__dict__).replace(',', '\n')
 
+    @staticmethod
+    def from_drops(drops, i):
+        '''
+        Function to get one drop of drops arrays (see DBManager.drops_from_columns) as a Streak.
+        Array attributes are views, modifying them modifies the drops arrays.
+        '''
+        s = Streak()
+        s.pid = int(drops["pid"][i])
+        s.world_position_start = drops["world_position_start"][i]
+        s.world_position_end = drops["world_position_end"][i]
+        s.world_diameter_start = float(drops["world_diameter_start"][i])
+        s.world_diameter_end = float(drops["world_diameter_end"][i])
+        s.image_position_start = drops["image_position_start"][i]
+        s.image_position_end = drops["image_position_end"][i]
+        s.image_diameter_start = drops["image_diameter_start"][i]
+        s.image_diameter_end = drops["image_diameter_end"][i]
+        s.max_width = int(drops["max_width"][i])
+        s.ratio = drops["ratio"][i]
+        s.length = drops["length"][i]
+        s.drop_type = DropType(drops["drop_type"][i])
+        return s
+
 
 class Frame:
     def __init__(self, ):
@@ -75,6 +113,88 @@ class Frame:
         return str(self.__dict__).replace(',', '\n')
 
 
+class HashingReader:
+    '''
+    File-like wrapper computing the md5 of everything read through it, so that a file can be hashed and parsed in a
+    single pass.
+    '''
+    def __init__(self, fp):
+        self.fp = fp
+        self.hasher = hashlib.md5()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        buf = self.fp.read(size)
+        self.hasher.update(buf)
+        self.bytes_read += len(buf)
+        return buf
+
+    def hexdigest(self):
+        # Consume what the parser did not read (e.g. trailing spaces) for the hash to cover the whole file
+        while self.read(1 << 20):
+            pass
+        return self.hasher.hexdigest()
+
+
+def file_md5(path, chunk_size=1 << 20):
+    hasher = hashlib.md5()
+    with open(path, 'rb') as afile:
+        for buf in iter(lambda: afile.read(chunk_size), b''):
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def _decode_tuples(values, dim):
+    # "(x;y;z)" strings are decoded all at once rather than one by one
+    if len(values) == 0:
+        return np.zeros((0, dim))
+    return np.array(';'.join([v[1:-1] for v in values]).split(';'), dtype=float).reshape(-1, dim)
+
+
+def iter_xml_frames(source):
+    '''
+    Generator streaming the frames of a particles simulation XML file.
+    Drops are accumulated as strings and decoded in bulk once their frame is complete. Elements are cleared as soon
+    as they are consumed, hence memory is bounded by the size of one frame.
+    :param source: Path or file-like object of the simulation file.
+    :return: Yield tuples (Frame, columns), columns being a dictionary of arrays of the raw simulator attributes.
+    '''
+    keys = ["pid", "wp1", "wp2", "wd1", "wd2", "ip1", "ip2", "iw1", "iw2"]
+    depth = 0
+    root, attribs = None, None
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if depth == 0:
+                root = elem
+            elif depth == 1:
+                attribs = {k: [] for k in keys}
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 2:
+            # Drop
+            for k in keys:
+                attribs[k].append(elem.attrib[k])
+        elif depth == 1:
+            # Frame
+            f = Frame()
+            f.id = int(elem.attrib['id'])
+            f.exposure_time = int(elem.attrib['t'])
+            f.starting_time = int(elem.attrib['d'])
+            f.streaks_count = int(elem.attrib['rs'])
+
+            columns = {"pid": np.array(attribs["pid"], dtype=np.int64)}
+            for k in ["wd1", "wd2", "iw1", "iw2"]:
+                columns[k] = np.array(attribs[k], dtype=float)
+            for k, dim in [("wp1", 3), ("wp2", 3), ("ip1", 2), ("ip2", 2)]:
+                columns[k] = _decode_tuples(attribs[k], dim)
+
+            attribs = None
+            root.clear()
+            yield f, columns
+
+
 class DBManager:
     def __init__(self, streaks_path=None, streaks_path_xml=None, norm_coeff_path=None):
         '''
@@ -85,9 +205,12 @@ class DBManager:
         '''
         self.streaks_path = streaks_path
         self.streaks_path_xml = streaks_path_xml
-        self.streaks_light = np.array([])
+        self.streaks_light = []
         self.norm_coeff_path = norm_coeff_path
         self.streaks_simulator = {}
+        self.sim_hash = None
+        self.particles = None
+        self.particles_settings = None
         self.ratio = np.array([])
 
     def __repr__(self):
@@ -98,25 +221,30 @@ class DBManager:
 
     @staticmethod
     def classify_drop(w):
-        if w >= 4:
-            return DropType(0)
-        if w > 1:
-            return DropType(1)
-
-        return DropType(2)
+        '''
+        Function to classify drops by their maximum width (pixels).
+        :param w: Maximum width of a drop, or array of maximum widths.
+        :return: DropType of the drop, or array of DropType values.
+        '''
+        drop_type = np.where(w >= BIG_DROP_WIDTH, DropType.Big.value,
+                             np.where(w > SMALL_DROP_WIDTH, DropType.Medium.value, DropType.Small.value))
+        return DropType(int(drop_type)) if np.ndim(w) == 0 else drop_type
 
     def load_streak_database(self):
         '''
         Function to load and store the texture maps.
-        Streaks are stored in a list.
+        Streaks are stored in a list. They are read once per process (see asset_cache).
         '''
 
         if not os.path.exists(self.streaks_path):
             print("No existing path for streak database (", self.streaks_path, ")")
             exit(-1)
 
-        tmp = []
-        norm_coeff_path = self.norm_coeff_path
+        self.streaks_light, self.ratio = asset_cache.load('streaks', [self.streaks_path, self.norm_coeff_path],
+                                                          self.read_streak_database)
+
+    @staticmethod
+    def read_norm_coeffs(norm_coeff_path):
         norm_coeffs = {}
 
         with open(norm_coeff_path, 'r') as file:
@@ -128,6 +256,18 @@ class DBManager:
                 continue
             norm_coeffs.update({coeff: [float(v) for v in line.split('\n')[0].split(' ')[:-1]]})
 
+        return norm_coeffs
+
+    def read_streak_database(self):
+        '''
+        Function to read the texture maps, normalized.
+        :return: Tuple (textures, unique aspect ratios of the textures).
+        '''
+        tmp = []
+        ratio = np.array([])
+        norm_coeffs = asset_cache.load('norm_coeffs', self.norm_coeff_path,
+                                       lambda: self.read_norm_coeffs(self.norm_coeff_path))
+
         for file_name in my_utils.os_listdir(self.streaks_path):
             name = os.path.splitext(file_name)[0]
             coeff, osc = name.split('_')
@@ -137,33 +277,34 @@ class DBManager:
                 coeff = int(coeff[-2:])
             osc = int(osc[-1:])
             drop_image = cv2.imread(os.path.join(self.streaks_path, file_name), cv2.IMREAD_ANYDEPTH)
-            drop_image = cv2.cvtColor(drop_image, cv2.COLOR_GRAY2BGR)
-            drop_image_norm = ((255.0 * norm_coeffs[coeff][osc] * drop_image) / 65535.0).astype(np.uint8)
+            # Single channel (streaks are gray, colour is applied at blending), keeping the 16 bits precision. Compared to
+            # textures quantized to uint8, rainy images differ by at most 1 (8-bit) and rain masks by at most 3 (see README)
+            drop_image_norm = (norm_coeffs[coeff][osc] * drop_image.astype(np.float32)) / np.float32(65535.0)
             tmp.append(drop_image_norm)
-            self.ratio = np.append(self.ratio, tmp[-1].shape[1] / tmp[-1].shape[0])
+            ratio = np.append(ratio, tmp[-1].shape[1] / tmp[-1].shape[0])
 
-        self.ratio = np.unique(self.ratio)
-        self.streaks_light = np.array(tmp)
+        return tmp, np.unique(ratio)
 
     def load_streaks_from_xml(self, dataset, settings, image_shape_WH, use_pickle=True, verbose=True):
         '''
         Function to load and store the output from the physical simulator.
         Streak data is stored in a dictionary. Key: ID, Value: data
+        The XML file is streamed: the md5 is computed while reading, each frame is decoded in bulk as soon as it is
+        complete and then released, so that the parser memory is bounded by one frame.
         '''
         print('Reading particles file {}'.format(self.streaks_path_xml))
 
         pickle_version = '1.0'
 
-        # Compute the simulation file hash
-        hasher = hashlib.md5()
-        with open(self.streaks_path_xml, 'rb') as afile:
-            buf = afile.read()
-            hasher.update(buf)
-        sim_hash = hasher.hexdigest()
+        if not os.path.exists(self.streaks_path_xml):
+            my_utils.print_error("No existing path for XML file (" + self.streaks_path_xml + ")")
+            exit(-1)
 
         pickle_path = self.streaks_path_xml + '.pkl'
         if use_pickle and os.path.exists(pickle_path):
             print('     loading from pickle')
+            # Compute the simulation file hash
+            sim_hash = file_md5(self.streaks_path_xml)
             input = open(pickle_path, 'rb')
             pickle_data = pickle.load(input)
 
@@ -171,98 +312,246 @@ class DBManager:
             if 'version' in pickle_data and pickle_data['version'] == pickle_version and pickle_data[
                 'sim_hash'] == sim_hash and np.all(pickle_data['image_shapeWH'] == image_shape_WH):
                 self.streaks_simulator = pickle_data['streaks']
+                self.sim_hash = sim_hash
                 input.close()
                 return
             else:
                 print('Pickle out-dated. Regenerate.')
                 input.close()
 
+        t0 = time.time()
+        drops_num = 0
+        file_size = os.path.getsize(self.streaks_path_xml)
+        if verbose:
+            my_utils.print_progress_bar(0, max(file_size, 1))
+
+        with open(self.streaks_path_xml, 'rb') as afile:
+            reader = HashingReader(afile)
+            try:
+                for f, columns in iter_xml_frames(reader):
+                    f.streaks = self.streaks_from_columns(columns, dataset, settings, image_shape_WH)
+                    drops_num += len(columns["pid"])
+
+                    self.streaks_simulator.update({f.id: f})
+                    if verbose:
+                        my_utils.print_progress_bar(reader.bytes_read, max(file_size, 1))
+            except ParseError as e:
+                raise Exception("Reading XML file {} crashed, which is likely due to corrupted particles simulation files. If so, delete this simulation folder manually and re-run to allow generation of new simulation.".format(self.streaks_path_xml))
+            except Exception as e:
+                ex_type, ex, tb = sys.exc_info()
+                my_utils.print_error('Error while parsing XML file.\n\tFile: ' + self.streaks_path_xml)
+                traceback.print_tb(tb)
+                exit(-1)
+
+            self.sim_hash = reader.hexdigest()
+
+        if verbose and reader.bytes_read < file_size:
+            my_utils.print_progress_bar(file_size, file_size)
+
+        dt = max(time.time() - t0, 1e-6)
+        print('     {} drops in {} frames parsed in {:.2f}s ({:.0f} drops/s)'.format(drops_num, len(self.streaks_simulator), dt, drops_num / dt))
+
+    def load_particles(self, dataset, settings, image_shape_WH, verbose=True):
+        '''
+        Function to load the output from the physical simulator as memory-mapped columns (see particles_bin).
+        The XML file is converted once to the binary format, stored next to it, and re-converted only if the XML file
+        changed. Contrary to load_streaks_from_xml, frames are only decoded when requested with frame().
+        '''
+        self.particles_settings = (dataset, settings, image_shape_WH)
+
+        if os.path.isdir(self.streaks_path_xml):
+            # Already a binary simulation
+            self.particles = asset_cache.load('particles', self.streaks_path_xml,
+                                              lambda: ParticlesSim.open(self.streaks_path_xml))
+            self.sim_hash = self.particles.meta.get("md5")
+            return
+
         if not os.path.exists(self.streaks_path_xml):
             my_utils.print_error("No existing path for XML file (" + self.streaks_path_xml + ")")
             exit(-1)
 
+        bin_path = particles_bin.bin_path(self.streaks_path_xml)
+        if not particles_bin.is_up_to_date(bin_path, self.streaks_path_xml):
+            try:
+                self.convert_xml(bin_path, verbose=verbose)
+            except OSError as e:
+                my_utils.print_warning("Cannot write binary particles file {} ({}). Loading in memory instead.".format(bin_path, e))
+                self.particles = asset_cache.load('particles', self.streaks_path_xml, self._read_xml_particles)
+                return
+
+        self.particles = asset_cache.load('particles', bin_path, lambda: ParticlesSim.open(bin_path))
+        self.sim_hash = self.particles.meta.get("md5")
+
+    def load_sampler(self, dataset, settings, image_shape_WH, sim_options, fallrate, seed=0):
+        '''
+        Function to sample frames directly instead of loading a simulation (see streak_sampler), frames are unlimited.
+        :param sim_options: Simulation settings, including sequence specific ones (see db.sim).
+        :param fallrate: Rain fall rate (mm/hr).
+        :param seed: Seed of the frames, which should differ across sequences (see streak_sampler.sequence_seed).
+        '''
+        self.particles_settings = (dataset, settings, image_shape_WH)
+        self.particles = StreakSampler(sim_options, fallrate, seed)
+        self.sim_hash = None
+
+    def _read_xml_particles(self):
+        with open(self.streaks_path_xml, 'rb') as afile:
+            return ParticlesSim.from_frames(self._xml_frames(HashingReader(afile)))
+
+    def _xml_frames(self, reader, meta=None):
         try:
-            simulation = parse(self.streaks_path_xml).getroot()
-        except Exception as e:
+            for f, columns in iter_xml_frames(reader):
+                yield (f.id, f.exposure_time, f.starting_time, f.streaks_count), columns
+        except ParseError as e:
             raise Exception("Reading XML file {} crashed, which is likely due to corrupted particles simulation files. If so, delete this simulation folder manually and re-run to allow generation of new simulation.".format(self.streaks_path_xml))
 
+        # The hash is only known once the whole file was read
+        self.sim_hash = reader.hexdigest()
+        if meta is not None:
+            meta["md5"] = self.sim_hash
+
+    def convert_xml(self, bin_path=None, verbose=True):
+        '''
+        Function to convert the XML output of the simulator to the columnar binary format.
+        :param bin_path: Output folder. Default is next to the XML file (see particles_bin.bin_path).
+        '''
+        bin_path = particles_bin.bin_path(self.streaks_path_xml) if bin_path is None else bin_path
+        print('Converting particles file {}'.format(self.streaks_path_xml))
+
+        t0 = time.time()
+        meta = {"source": particles_bin.source_signature(self.streaks_path_xml)}
+        with open(self.streaks_path_xml, 'rb') as afile:
+            frames_num, drops_num = particles_bin.write(bin_path, self._xml_frames(HashingReader(afile), meta), meta)
+
+        dt = max(time.time() - t0, 1e-6)
         if verbose:
-            my_utils.print_progress_bar(0, len(simulation))
-        try:
-            for fix, frame in enumerate(simulation):
-                f = Frame()
-                f.id = int(frame.attrib['id'])
-                f.exposure_time = int(frame.attrib['t'])
-                f.starting_time = int(frame.attrib['d'])
-                f.streaks_count = int(frame.attrib['rs'])
-                f.streaks = {}
-
-                for drop in frame:
-                    s = Streak()
-                    s.pid = int(drop.attrib["pid"])
-                    s.world_position_start = np.array(drop.attrib["wp1"][1:-1].split(';'), dtype=float)
-                    s.world_position_end = np.array(drop.attrib["wp2"][1:-1].split(';'), dtype=float)
-                    s.world_diameter_start = float(drop.attrib['wd1'])
-                    s.world_diameter_end = float(drop.attrib['wd2'])
-
-                    s.image_position_start = np.array(drop.attrib["ip1"][1:-1].split(';'), dtype=float) / settings["render_scale"]  # x,y
-                    s.image_position_end = np.array(drop.attrib["ip2"][1:-1].split(';'), dtype=float) / settings["render_scale"]  # x,y
-                    s.image_diameter_start = float(drop.attrib['iw1']) / settings["render_scale"]
-                    s.image_diameter_end = float(drop.attrib['iw2']) / settings["render_scale"]
-
-                    if dataset == 'nuscenes_gan':
-                        # in case the simulation and the rendering are not at the same resolution
-                        r = np.mean((image_shape_WH[0] / 1600, image_shape_WH[1] / 900))
-                        s.image_position_start = np.array(drop.attrib["ip1"][1:-1].split(';'), dtype=float) * r  # x,y
-                        s.image_position_end = np.array(drop.attrib["ip2"][1:-1].split(';'), dtype=float) * r  # x,y
-                        s.image_diameter_start = float(drop.attrib['iw1']) * r
-                        s.image_diameter_end = float(drop.attrib['iw2']) * r
-
-                    s.image_position_start[1] = image_shape_WH[1] - s.image_position_start[1]
-                    s.image_position_end[1] = image_shape_WH[1] - s.image_position_end[1]
-                    s.world_position_start[2] *= -1
-                    s.world_position_end[2] *= -1
-                    diff = abs(s.image_position_start - s.image_position_end)
-                    s.max_width = int(max(s.image_diameter_start, s.image_diameter_end))
-
-                    dir1 = np.array([0, -1])
-                    dir2 = diff / np.linalg.norm(diff)
-                    dir2[1] = -dir2[1]
-                    cos_theta = np.dot(dir1, dir2)
-                    actual_length = diff[1] / cos_theta
-                    s.ratio = s.max_width / actual_length
-                    s.image_position_end = s.image_position_end.round().astype(int)
-                    s.image_position_start = s.image_position_start.round().astype(int)
-                    s.length = np.ceil(np.linalg.norm(s.image_position_start - s.image_position_end)).astype(int)
-                    s.drop_type = self.classify_drop(s.max_width)
-                    if s.max_width >= 1 and s.length >= 1:
-                        f.streaks.update({s.pid: s})
-
-                self.streaks_simulator.update({f.id: f})
-                if verbose:
-                    my_utils.print_progress_bar(fix + 1, len(simulation))
-        except Exception as e:
-            ex_type, ex, tb = sys.exc_info()
-            my_utils.print_error('Error while parsing XML file.\n\tFile: ' + self.streaks_path_xml)
-            traceback.print_tb(tb)
-            exit(-1)
+            print('     {} drops in {} frames converted in {:.2f}s ({:.0f} drops/s)'.format(drops_num, frames_num, dt, drops_num / dt))
 
-    def take_drop_texture(self, drop):
+    def frames_count(self):
+        # None if frames are unlimited (sampler)
+        return None if isinstance(self.particles, StreakSampler) else len(self.particles)
+
+    def frame(self, idx):
+        '''
+        Function to decode one frame of the simulation loaded with load_particles or load_sampler.
+        :param idx: Frame index, in [0, frames_count()) or any non negative index if frames are unlimited.
+        :return: Frame with its streaks.
+        '''
+        attrs, columns = self.particles.frame_columns(idx)
+        f = Frame()
+        f.id = attrs["id"]
+        f.exposure_time = attrs["t"]
+        f.starting_time = attrs["d"]
+        f.streaks_count = attrs["rs"]
+        f.streaks = self.streaks_from_columns(columns, *self.particles_settings)
+        return f
+
+    def frame_drops(self, idx):
+        '''
+        Function to decode one frame of the simulation loaded with load_particles or load_sampler, as arrays.
+        :param idx: Frame index, in [0, frames_count()) or any non negative index if frames are unlimited.
+        :return: Tuple (frame attributes, drops), see drops_from_columns.
+        '''
+        attrs, columns = self.particles.frame_columns(idx)
+        return attrs, self.drops_from_columns(columns, *self.particles_settings)
+
+    def streaks_from_columns(self, columns, dataset, settings, image_shape_WH):
+        '''
+        Function to convert the decoded attributes of one frame into streaks.
+        :param columns: Dictionary of arrays (pid, wp1, wp2, wd1, wd2, ip1, ip2, iw1, iw2) as stored in the simulator file.
+        :return: Dictionary of streaks. Key: pid, Value: Streak
+        '''
+        drops = self.drops_from_columns(columns, dataset, settings, image_shape_WH)
+        streaks = {}
+        for i in range(len(drops["pid"])):
+            s = Streak.from_drops(drops, i)
+            streaks.update({s.pid: s})
+
+        return streaks
+
+    @staticmethod
+    def drops_from_columns(columns, dataset, settings, image_shape_WH):
+        '''
+        Function to convert the decoded attributes of one frame into drops arrays.
+        All drops of the frame are processed at once, drops smaller than one pixel are discarded.
+        :param columns: Dictionary of arrays (pid, wp1, wp2, wd1, wd2, ip1, ip2, iw1, iw2) as stored in the simulator file.
+        :return: Dictionary of arrays, one per Streak attribute (drop_type being stored as DropType values).
+        '''
+        image_position_start = columns["ip1"] / settings["render_scale"]  # x,y
+        image_position_end = columns["ip2"] / settings["render_scale"]  # x,y
+        image_diameter_start = columns["iw1"] / settings["render_scale"]
+        image_diameter_end = columns["iw2"] / settings["render_scale"]
+
+        if dataset == 'nuscenes_gan':
+            # in case the simulation and the rendering are not at the same resolution
+            r = np.mean((image_shape_WH[0] / 1600, image_shape_WH[1] / 900))
+            image_position_start = columns["ip1"] * r  # x,y
+            image_position_end = columns["ip2"] * r  # x,y
+            image_diameter_start = columns["iw1"] * r
+            image_diameter_end = columns["iw2"] * r
+
+        image_position_start[:, 1] = image_shape_WH[1] - image_position_start[:, 1]
+        image_position_end[:, 1] = image_shape_WH[1] - image_position_end[:, 1]
+        world_position_start = columns["wp1"].astype(float)
+        world_position_end = columns["wp2"].astype(float)
+        world_position_start[:, 2] *= -1
+        world_position_end[:, 2] *= -1
+        diff = abs(image_position_start - image_position_end)
+        max_width = np.maximum(image_diameter_start, image_diameter_end).astype(int)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dir1 = np.array([0, -1])
+            dir2 = diff / np.linalg.norm(diff, axis=1, keepdims=True)
+            dir2[:, 1] = -dir2[:, 1]
+            cos_theta = dir1[0] * dir2[:, 0] + dir1[1] * dir2[:, 1]
+            actual_length = diff[:, 1] / cos_theta
+            ratio = max_width / actual_length
+        image_position_end = image_position_end.round().astype(int)
+        image_position_start = image_position_start.round().astype(int)
+        length = np.ceil(np.linalg.norm(image_position_start - image_position_end, axis=1)).astype(int)
+        drop_type = DBManager.classify_drop(max_width)
+
+        keep = (max_width >= 1) & (length >= 1)
+        return {"pid": columns["pid"][keep],
+                "world_position_start": world_position_start[keep],
+                "world_position_end": world_position_end[keep],
+                "world_diameter_start": columns["wd1"][keep].astype(float),
+                "world_diameter_end": columns["wd2"][keep].astype(float),
+                "image_position_start": image_position_start[keep],
+                "image_position_end": image_position_end[keep],
+                "image_diameter_start": image_diameter_start[keep],
+                "image_diameter_end": image_diameter_end[keep],
+                "max_width": max_width[keep],
+                "ratio": ratio[keep],
+                "length": length[keep],
+                "drop_type": drop_type[keep]}
+
+    def take_drop_texture_index(self, drop):
+        '''
+        Function to pick a random texture of the database, among those of similar aspect ratio.
+        :return: Index in streaks_light.
+        '''
         if drop.ratio < self.ratio[0]:
-            drop = self.streaks_light[np.random.randint(0, 10)] / 255.0
-            return drop
+            return np.random.randint(0, 10)
         if drop.ratio < self.ratio[1]:
-            drop = self.streaks_light[np.random.randint(10, 20)] / 255.0
-            return drop
+            return np.random.randint(10, 20)
         if drop.ratio < self.ratio[2]:
-            drop = self.streaks_light[np.random.randint(20, 30)] / 255.0
-            return drop
+            return np.random.randint(20, 30)
         if drop.ratio < self.ratio[3]:
-            drop = self.streaks_light[np.random.randint(30, 40)] / 255.0
-            return drop
+            return np.random.randint(30, 40)
         else:
-            drop = self.streaks_light[np.random.randint(40, 50)] / 255.0
-            return drop
+            return np.random.randint(40, 50)
+
+    def drops_texture_bin(self, ratio):
+        '''
+        Vectorized version of the aspect ratio classes of take_drop_texture_index, textures of class k being the
+        indices [10 * k, 10 * k + 10).
+        :param ratio: Drops aspect ratio (N,).
+        :return: Classes (N,).
+        '''
+        return np.searchsorted(self.ratio[:4], ratio, side='right')
+
+    def take_drop_texture(self, drop):
+        return self.streaks_light[self.take_drop_texture_index(drop)]
 
     @staticmethod
     def normalize(v):
@@ -270,31 +559,62 @@ class DBManager:
 
 
 class RainRenderer:
-    def __init__(self, focal, f_number, focus_plane, radius, fov):
+    def __init__(self, focal, f_number, focus_plane, radius, fov, defocus_sigma_step=DEFOCUS_SIGMA_STEP):
         self.f = focal
         self.N = f_number
         self.focus_plane = focus_plane
         self.radius = radius
         self.fov = fov
 
+        # Separable defocus kernels per sigma bucket (0 for exact sigmas), and time spent on defocus (s) for profiling
+        self.defocus_sigma_step = defocus_sigma_step
+        self.defocus_kernels = {}
+        self.defocus_time = 0.
+
     def __repr__(self):
         return "RainRenderer()"
 
     def __str__(self):
         return 'RainRenderer'.format()
 
-    def circle_of_confusion(self, drop, drop_distance, drop_dict):
-        # TODO:: Assess this chunk of code
+    def defocus_kernel(self, sigma):
+        '''
+        Function to fetch the gaussian kernel of a sigma bucket.
+        :return: Normalized 1D kernel of odd length, float32.
+        '''
+        step = self.defocus_sigma_step
+        bucket = int(round(sigma / step)) if step > 0 else float(sigma)
+        kernel = self.defocus_kernels.get(bucket)
+        if kernel is None:
+            sigma = bucket * step if step > 0 else sigma
+            radius = int(DEFOCUS_TRUNCATE * sigma + 0.5)
+            x = np.arange(-radius, radius + 1)
+            kernel = np.exp(-0.5 * x ** 2 / sigma ** 2) if radius > 0 else np.ones(1)
+            kernel = (kernel / kernel.sum()).astype(np.float32)
+            if step > 0:
+                self.defocus_kernels[bucket] = kernel
+        return kernel
+
+    def circle_of_confusion(self, drop, drop_distance, drop_dict, c=None):
+        '''
+        Function to apply the out-of-focus blur to a drop.
+        :param drop: Single channel drop.
+        :param drop_distance: Drop distance to the camera (m).
+        :param c: Circle of confusion (pixels), if already computed (see compute_circle, which accepts arrays).
+        :return: Tuple (blurred drop, shift), shift (x, y) being the padding added on each side.
+        '''
+        t0 = time.time()
 
         # Out-of-focus blur produces larger drop. Thus, we first copy drop in a bigger array and later apply gaussian blur.
-        c = abs(self.compute_circle(abs(drop_distance)))
-        sigma1, sigma2 = c, c / 2
-        # sigma1,sigma2 = (drop_dict.maxWidth/2,drop_dict.maxWidth/2) if drop_dict.dropType==DropType.Big else (drop_dict.maxWidth/3,drop_dict.maxWidth/3)
-        shift = int(10 * c)  # TODO: We consider a 10 margin increase, reasonable for most ouf-of-focus blur
+        # The blur is truncated, padding by the kernels radius is enough (beyond is exactly zero)
+        c = abs(self.compute_circle(abs(drop_distance))) if c is None else c
+        kernel_y, kernel_x = self.defocus_kernel(c), self.defocus_kernel(c / 2)
+        shift = np.array([len(kernel_x) // 2, len(kernel_y) // 2])
 
-        drop2 = cv2.copyMakeBorder(drop, shift, shift, shift, shift, cv2.BORDER_CONSTANT, value=(0, 0, 0, 0))
-        drop2 = gaussian_filter(drop2, [sigma1, sigma2, 0])
+        drop2 = cv2.copyMakeBorder(drop, shift[1], shift[1], shift[0], shift[0], cv2.BORDER_CONSTANT, value=0)
+        drop2 = cv2.sepFilter2D(drop2, -1, kernel_x, kernel_y, borderType=cv2.BORDER_CONSTANT)
 
+        self.defocus_time += time.time() - t0
         return drop2, shift
 
     @staticmethod
@@ -333,17 +653,61 @@ class RainRenderer:
         drop[..., :3] = drop[..., :3] * np.expand_dims(drop[..., 3] / 255, axis=-1)
         return drop
 
+    @staticmethod
+    def drop_color(fov_solid_angle_sum, fov_xyY, ambient_lum, solid_angle_sum, irrad_type):
+        '''
+        Function to compute the colour of a unit (white) drop pixel, from the environment map integrated over its FOV.
+        Gray drop pixels take the FOV chromaticity and their luminance is scaled, which is linear in the drop
+        luminance: the colour of a drop is its luminance times this colour.
+        :param fov_solid_angle_sum: Solid angle of the FOV, or array (N,) for N drops.
+        :param fov_xyY: xyY weighted by solid angle summed over the FOV (3,), or array (N, 3).
+        :return: BGR colour (3,), or array (N, 3).
+        '''
+        fov_xy_avg = fov_xyY[..., :2] / np.expand_dims(fov_solid_angle_sum, axis=-1)
+        drop_xyY_fov_color = np.concatenate([fov_xy_avg, np.full(fov_xy_avg.shape[:-1] + (1,), GRAY_LUMINANCE)], axis=-1)
+
+        # In case of drop radiance from environment
+        if irrad_type == 'ambient':
+            # TODO:: check if it was the only irrad_type here
+            avg_fov_lum = fov_xyY[..., 2] / solid_angle_sum
+            drop_Y = 0.94 * avg_fov_lum + 0.06 * ambient_lum
+            drop_xyY_fov_color[..., 2] *= drop_Y
+
+        drop_color_rgb = my_utils.convert_xyY_to_rgb(drop_xyY_fov_color)
+        return drop_color_rgb[..., ::-1]
+
     def add_drop_to_image(self, dataset, env_map_xyY, solid_angle_map, drop_fov_pts, drop_minC, bg, rainy_bg,
                           rainy_mask, rainy_saturation_mask, drop, drop_dict, irrad_type, rendering_strategy,
-                          opacity_attenuation=1.0):
+                          opacity_attenuation=1.0, env_integral=None, exposure_time=None, coc=None):
+        drop, drop_minC, blending = self.prepare_drop(dataset, env_map_xyY, solid_angle_map, drop_fov_pts, drop_minC,
+                                                      bg.shape, drop, drop_dict, irrad_type, rendering_strategy,
+                                                      opacity_attenuation, env_integral, exposure_time, coc)
+        drop_vis, drop_blend = self.blend_drop(rainy_bg, rainy_mask, rainy_saturation_mask, drop, drop_minC, *blending)
+
+        return rainy_bg, rainy_mask, rainy_saturation_mask, drop_vis, drop_blend, drop_minC
+
+    def prepare_drop(self, dataset, env_map_xyY, solid_angle_map, drop_fov_pts, drop_minC, image_shape, drop,
+                     drop_dict, irrad_type, rendering_strategy, opacity_attenuation=1.0, env_integral=None,
+                     exposure_time=None, coc=None):
+        '''
+        Function to compute the colour, defocus and blending coefficients of a drop, see add_drop_to_image.
+        Drops are prepared independently of each other (and of the image being rendered).
+        :param image_shape: Shape of the rendered image.
+        :return: Tuple (drop, drop_minC, blending), blending being the arguments of blend_drop following drop_minC.
+        '''
         global cache
         # This part can be optimized using matplotlib
         # https://stackoverflow.com/questions/36399381/whats-the-fastest-way-of-checking-if-a-point-is-inside-a-polygon-in-python
         # TODO - cases where smaller drops may be darker than completely occluding large drops
 
-        exposure_time = db.settings(dataset)["cam_exposure"] / 1000.
+        # Per frame constants may be provided by the caller (see EnvMapIntegral), to avoid recomputing them per drop
+        if exposure_time is None:
+            exposure_time = db.settings(dataset)["cam_exposure"] / 1000.
         drop_size = 1.16 * 1e-3  # Photorealistic Rendering of Rain Streaks (section 4)
 
+        # The drop is a single channel sprite (luminance and alpha), its colour is applied at blending (white by default)
+        drop_color_bgr = np.ones(3)
+
         # Compute the intersection between the FOV points of the drop and the environment map
         # Will return the mask of the drop in the env map
         if rendering_strategy in ['white']:
@@ -375,48 +739,38 @@ class RainRenderer:
             # Compute the drop average size
             d_avg = (drop_dict.image_diameter_start + drop_dict.image_diameter_end) / 2.
 
-            # added
-            drop_xyY = my_utils.convert_rgb_to_xyY(drop[..., :3])
-            drop_xyY[np.isnan(drop_xyY)] = 0
-
-            # Using cache 2.5x faster (Raoul)
-            if 'mask_env_float64' not in cache or not np.all(solid_angle_map.shape[:2] == cache['mask_env_bool'].shape[:2]):
-                cache['mask_env_float64'] = np.zeros(env_map_xyY.shape[:2], dtype=np.float64)
-                cache['mask_env_bool'] = np.zeros(env_map_xyY.shape[:2], dtype=np.bool)
-
-            cache['mask_env_float64'][:] = 0.
-            cv2.fillConvexPoly(cache['mask_env_float64'], s, 1)
-            cache['mask_env_bool'][:] = cache['mask_env_float64']
-            mask_env = cache['mask_env_bool']
-
-            # Get the envmap in drop FOV
-            fov_solid_angle = solid_angle_map[mask_env].copy()
-            fov_envmap = env_map_xyY[mask_env].copy()
-            fov_xyY = (fov_envmap * np.expand_dims(fov_solid_angle, axis=-1)).sum(axis=0)
+            if env_integral is not None:
+                # Get the envmap in drop FOV, from the frame prefix sums (same pixels as the mask below)
+                fov_solid_angle_sum, fov_xyY = env_integral.integrate(s)
+                ambient_lum, solid_angle_sum = env_integral.ambient_lum, env_integral.solid_angle_sum
+            else:
+                # Using cache 2.5x faster (Raoul)
+                if 'mask_env_float64' not in cache or not np.all(solid_angle_map.shape[:2] == cache['mask_env_bool'].shape[:2]):
+                    cache['mask_env_float64'] = np.zeros(env_map_xyY.shape[:2], dtype=np.float64)
+                    cache['mask_env_bool'] = np.zeros(env_map_xyY.shape[:2], dtype=np.bool)
 
-            fov_xy_avg = fov_xyY[:2] / (np.sum(fov_solid_angle))
+                cache['mask_env_float64'][:] = 0.
+                cv2.fillConvexPoly(cache['mask_env_float64'], s, 1)
+                cache['mask_env_bool'][:] = cache['mask_env_float64']
+                mask_env = cache['mask_env_bool']
 
-            drop_xyY_fov_color = drop_xyY.copy()
-            drop_xyY_fov_color[..., :2] = fov_xy_avg
+                # Get the envmap in drop FOV
+                fov_solid_angle = solid_angle_map[mask_env].copy()
+                fov_envmap = env_map_xyY[mask_env].copy()
+                fov_xyY = (fov_envmap * np.expand_dims(fov_solid_angle, axis=-1)).sum(axis=0)
+                fov_solid_angle_sum = np.sum(fov_solid_angle)
 
-            # In case of drop radiance from environment
-            ambient_lum = env_map_xyY[..., 2] * solid_angle_map
-            ambient_lum = np.sum(ambient_lum) / np.sum(solid_angle_map)
-            if irrad_type == 'ambient':
-                # TODO:: check if it was the only irrad_type here
-                avg_fov_lum = fov_xyY[..., 2] / np.sum(solid_angle_map)
-                drop_Y = 0.94 * avg_fov_lum + 0.06 * ambient_lum
-                drop_xyY_fov_color[..., 2] *= drop_Y
+                ambient_lum = env_map_xyY[..., 2] * solid_angle_map
+                solid_angle_sum = np.sum(solid_angle_map)
+                ambient_lum = np.sum(ambient_lum) / solid_angle_sum
 
-            drop_color_rgb = my_utils.convert_xyY_to_rgb(drop_xyY_fov_color)
-            drop_color_bgr = drop_color_rgb[..., ::-1]
-            drop[..., :3][drop[..., 3] > 0] = drop_color_bgr[drop[..., 3] > 0]
+            drop_color_bgr = self.drop_color(fov_solid_angle_sum, fov_xyY, ambient_lum, solid_angle_sum, irrad_type)
 
             # Apply defocus effects
-            drop, shift = self.circle_of_confusion(drop, drop_dict.world_position_start[2], drop_dict)
+            drop, shift = self.circle_of_confusion(drop, drop_dict.world_position_start[2], drop_dict, coc)
 
             drop_minC_tmp = drop_minC - shift
-            drop_minC = np.array([np.clip(drop_minC_tmp[0], 0, bg.shape[1]), np.clip(drop_minC_tmp[1], 0, bg.shape[0])])
+            drop_minC = np.array([np.clip(drop_minC_tmp[0], 0, image_shape[1]), np.clip(drop_minC_tmp[1], 0, image_shape[0])])
             delta = drop_minC - drop_minC_tmp  # evaluate clipping
             drop = drop[:delta[1]] if delta[1] < 0 else drop[delta[1]:]
             drop = drop[:, :delta[0]] if delta[0] < 0 else drop[:, delta[0]:]
@@ -426,21 +780,70 @@ class RainRenderer:
             length_opacity = opacity_attenuation * d_avg / (drop_dict.length + d_avg)  # pr pg 5 camera effects
             tau_one = exposure_time * length_opacity
 
+        return drop, drop_minC, (drop_color_bgr, tau_one, tau_zero, exposure_time)
+
+    @staticmethod
+    def crop_drop(drop, drop_minC, region):
+        '''
+        Function to crop a drop to an image region (x0, y0, x1, y1), x1 and y1 excluded.
+        :return: Tuple (drop, drop_minC), the drop being a view.
+        '''
+        x0, y0 = max(region[0], drop_minC[0]), max(region[1], drop_minC[1])
+        x1, y1 = min(region[2], drop_minC[0] + drop.shape[1]), min(region[3], drop_minC[1] + drop.shape[0])
+        drop = drop[y0 - drop_minC[1]:max(y1 - drop_minC[1], y0 - drop_minC[1]),
+                    x0 - drop_minC[0]:max(x1 - drop_minC[0], x0 - drop_minC[0])]
+        return drop, np.array([x0, y0])
+
+    @staticmethod
+    def accumulate_drop(buffer, rainy_mask, rainy_saturation_mask, drop, drop_minC, drop_color_bgr, tau_one, tau_zero,
+                        exposure_time, region=None):
+        '''
+        Order-independent version of blend_drop: the drop is accumulated into a TransmittanceBuffer, which is resolved
+        into the rainy image once all drops are accumulated. Masks are updated as blend_drop does.
+        :param rainy_saturation_mask: Saturation mask, or None if not computed.
+        :param region: Optional image region (x0, y0, x1, y1) to restrict blending to.
+        '''
+        H, W = rainy_mask.shape[:2]
+        region = (0, 0, W, H) if region is None else (max(region[0], 0), max(region[1], 0), min(region[2], W), min(region[3], H))
+        drop, drop_minC = RainRenderer.crop_drop(drop, drop_minC, region)
+        if drop.size == 0:
+            return
+
+        buffer.add(drop, drop_minC, tau_one / exposure_time, drop_color_bgr * (tau_one / tau_zero))
+
+        rows, cols = slice(drop_minC[1], drop_minC[1] + drop.shape[0]), slice(drop_minC[0], drop_minC[0] + drop.shape[1])
+        rainy_mask[rows, cols] += drop
+        if rainy_saturation_mask is not None:
+            drop_vis_color = np.expand_dims(drop, axis=-1) * np.asarray(drop_color_bgr, dtype=rainy_saturation_mask.dtype)
+            rainy_saturation_mask[rows, cols] += np.clip(drop_vis_color, 0, 1)
+
+    @staticmethod
+    def blend_drop(rainy_bg, rainy_mask, rainy_saturation_mask, drop, drop_minC, drop_color_bgr, tau_one, tau_zero,
+                   exposure_time, region=None):
+        '''
+        Function to blend a prepared drop (see prepare_drop) into the rainy image and masks, in place.
+        Pixels are blended independently, hence blending a drop region by region is identical to blending it at once.
+        :param rainy_saturation_mask: Saturation mask, or None if not computed.
+        :param region: Optional image region (x0, y0, x1, y1) to restrict blending to.
+        :return: Tuple (drop_vis, drop_blend), the visible part of the drop and its blended pixels.
+        '''
+        if region is not None:
+            drop, drop_minC = RainRenderer.crop_drop(drop, drop_minC, region)
+
         rainy_bg_occ = rainy_bg[drop_minC[1]:drop_minC[1] + drop.shape[0],
                                 drop_minC[0]:drop_minC[0] + drop.shape[1], :].copy()
         rainy_mask_occ = rainy_mask[drop_minC[1]:drop_minC[1] + drop.shape[0],
                                     drop_minC[0]:drop_minC[0] + drop.shape[1]].copy()
-        rainy_sat_mask_occ = rainy_saturation_mask[drop_minC[1]:drop_minC[1] + drop.shape[0],
-                                                   drop_minC[0]:drop_minC[0] + drop.shape[1]].copy()
 
         # Blending is directly applied on the rainy_bg. Hence, no conditions for application is later required.
         # Which seems more correct and faster.
         # The bias is that it is drop-order dependent
         drop_vis = drop[:rainy_bg_occ.shape[0], :rainy_bg_occ.shape[1]]
-        drop_vis_alpha = drop_vis[:, :, 3]
+        drop_vis_alpha = drop_vis
         drop_vis_alpha_ = np.expand_dims(drop_vis_alpha, axis=-1)
+        drop_vis_color = drop_vis_alpha_ * np.asarray(drop_color_bgr, dtype=rainy_bg.dtype)
 
-        rainy_bg_occ = ((1. - ((drop_vis_alpha_ * tau_one) / exposure_time)) * rainy_bg_occ) + drop_vis[:, :, :3] * (
+        rainy_bg_occ = ((1. - ((drop_vis_alpha_ * tau_one) / exposure_time)) * rainy_bg_occ) + drop_vis_color * (
                     tau_one / tau_zero)
 
         rainy_bg_occ = np.clip(rainy_bg_occ, 0, 1)
@@ -449,17 +852,64 @@ class RainRenderer:
 
         rainy_mask_occ += drop_vis_alpha
 
-        drop_viz_sat = drop_vis[..., :3].copy()
-        rainy_sat_mask_occ += np.clip(drop_viz_sat.astype(np.float64), 0, 1)
+        if rainy_saturation_mask is not None:
+            rainy_saturation_mask[drop_minC[1]:drop_minC[1] + drop.shape[0],
+                                  drop_minC[0]:drop_minC[0] + drop.shape[1]] += np.clip(drop_vis_color.astype(rainy_saturation_mask.dtype), 0, 1)
 
         rainy_bg[drop_minC[1]:drop_minC[1] + drop_blend.shape[0],
                  drop_minC[0]:drop_minC[0] + drop_blend.shape[1]] = rainy_bg_occ
         rainy_mask[drop_minC[1]:drop_minC[1] + drop.shape[0],
                    drop_minC[0]:drop_minC[0] + drop.shape[1]] = rainy_mask_occ
-        rainy_saturation_mask[drop_minC[1]:drop_minC[1] + drop.shape[0],
-                              drop_minC[0]:drop_minC[0] + drop.shape[1]] = rainy_sat_mask_occ
 
-        return rainy_bg, rainy_mask, rainy_saturation_mask, drop_vis, drop_blend, drop_minC
+        return drop_vis, drop_blend
+
+    def add_streaks_to_image(self, splats, drops, drops_fov_pts, rainy_bg, rainy_mask, rainy_saturation_mask,
+                             irrad_type, env_integral, exposure_time, opacity_attenuation=1.0, buffer=None):
+        '''
+        Vectorized version of add_drop_to_image for the Gaussian streaks of a frame, rendered as splats (see
+        streak_splat). Streaks are blended at once instead of in order, see TransmittanceBuffer.
+        :param splats: Splats of the streaks, see StreakSplatter.fit.
+        :param drops: Drops arrays of the streaks (see DBManager.drops_from_columns).
+        :param drops_fov_pts: Envmap polygon of each streak (empty array if the drop is skipped).
+        :param rainy_saturation_mask: Saturation mask, or None if not computed.
+        :param buffer: Optional TransmittanceBuffer of the frame (blend_mode "oit"), otherwise streaks are resolved
+        into rainy_bg right away.
+        :return: Tuple (rainy_bg, rainy_mask, rainy_saturation_mask), updated in place.
+        '''
+        drop_size = 1.16 * 1e-3  # Photorealistic Rendering of Rain Streaks (section 4)
+        H, W = rainy_bg.shape[:2]
+
+        # Colours of unit drops, drops with an empty FOV are skipped (as erroneous drops of the per drop path)
+        fov_solid_angle_sum, fov_xyY = env_integral.integrate_many(drops_fov_pts)
+        valid = fov_solid_angle_sum > 0
+        drop_color_bgr = np.zeros((len(drops["pid"]), 3))
+        drop_color_bgr[valid] = self.drop_color(fov_solid_angle_sum[valid], fov_xyY[valid], env_integral.ambient_lum,
+                                                env_integral.solid_angle_sum, irrad_type)
+
+        # Compute the rain blending
+        d_avg = (drops["image_diameter_start"] + drops["image_diameter_end"]) / 2.
+        length = drops["length"]
+        tau_zero = np.sqrt(drop_size) / 50  # correct vr appendix (10.2) sec
+        length_opacity = opacity_attenuation * d_avg / (length + d_avg)  # pr pg 5 camera effects
+        tau_one = exposure_time * length_opacity
+        occlusion = np.where(valid, tau_one / exposure_time, 0.)
+        radiance = drop_color_bgr * (tau_one / tau_zero)[:, None]
+
+        streaks_buffer = TransmittanceBuffer((H, W), rainy_bg.dtype) if buffer is None else buffer
+        mask = rainy_mask.reshape(-1)
+        for pix, idx, alpha in StreakSplatter.rasterize(splats, (H, W)):
+            alpha = np.where(valid[idx], alpha, 0.)
+            streaks_buffer.add_samples(pix, alpha, occlusion[idx], radiance[idx])
+            mask += np.bincount(pix, alpha, minlength=H * W)
+            if rainy_saturation_mask is not None:
+                saturation = rainy_saturation_mask.reshape((-1, 3))  # View
+                for c in range(3):
+                    saturation[:, c] += np.bincount(pix, np.clip(alpha * drop_color_bgr[idx, c], 0, 1), minlength=H * W)
+
+        if buffer is None:
+            streaks_buffer.resolve(rainy_bg)
+
+        return rainy_bg, rainy_mask, rainy_saturation_mask
 
     def compute_circle(self, o, is_infinity=False):
         if is_infinity:
@@ -537,6 +987,18 @@ class FovComputation:
         m3 = (c * np.identity(3)) + s * (skv - skv.T) + ((1 - c) * np.outer(axis, axis))
         return m3
 
+    @staticmethod
+    def rotation_matrices(axes, thetas):
+        # Batched rotation_matrix: axes (..., 3) and thetas (...) broadcast together, returns (..., 3, 3)
+        axes = np.asarray(axes)
+        c, s = np.cos(thetas)[..., None, None], np.sin(thetas)[..., None, None]
+        x, y, z = axes[..., 0], axes[..., 1], axes[..., 2]
+        zero = np.zeros_like(x)
+        skv = np.stack([np.stack([zero, -z, y], axis=-1),
+                        np.stack([z, zero, -x], axis=-1),
+                        np.stack([-y, x, zero], axis=-1)], axis=-2)
+        return (c * np.identity(3)) + s * skv + ((1 - c) * (axes[..., :, None] * axes[..., None, :]))
+
     @staticmethod
     def intersection_sphere(position, direction, radius):
         dx = direction[0]
@@ -704,14 +1166,115 @@ class FovComputation:
             return np.array([]), np.array([]), drop_direction, drop_position
 
 
+    def compute_fov_plane_points_batch(self, drops, radius, fov, N, env_shape):
+        '''
+        Vectorized version of compute_fov_plane_points, computing the envmap polygons of all drops of a frame at once.
+        :param drops: Drops arrays (see DBManager.drops_from_columns).
+        :return: List with the envmap polygon points of each drop (empty array if the drop is skipped).
+        '''
+        if len(drops["pid"]) == 0:
+            return []
+
+        drop_position = (drops["world_position_start"] + drops["world_position_end"]) / 2
+        drop_position[:, [1, 2]] = drop_position[:, [2, 1]]
+        drop_direction = drop_position - self.camera
+        drop_direction = drop_direction / np.linalg.norm(drop_direction, axis=1, keepdims=True)
+
+        theta = np.deg2rad(fov / 2)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # 2 Compute the plane for which u is the normal and lies in
+            a, b, c = drop_direction[:, 0], drop_direction[:, 1], drop_direction[:, 2]
+            d = np.sum(drop_position * drop_direction, axis=1)
+            b = np.where(b == 0, 0.001, b)
+
+            # 3 Find point P on the plane
+            px = drop_position[:, 1]
+            pz = 0
+            py = (-a * px + d - c * pz) / b
+            point = np.stack([px, py, np.zeros_like(px)], axis=1)
+
+            # Compute U = p-drop_dict
+            u = drop_position - point
+            u = u / np.linalg.norm(u, axis=1, keepdims=True)
+            valid = np.all(~np.isnan(u), axis=1)
+
+            # 4 Compute v so angle between v-n is FOV/2
+            rot_vec = np.cross(u, drop_direction)
+            rot_mat = self.rotation_matrices(rot_vec, np.full(len(drop_position), -theta))
+            v = np.einsum('ni,nij->nj', drop_direction, rot_mat)
+
+            # 5 Rotate v along dropdirection
+            phi = np.arange(0, 2 * np.pi, (2 * np.pi) / N)
+            M = self.rotation_matrices(drop_direction[:, None, :], phi[None, :])
+            vectors = np.einsum('ni,nkij->nkj', v, M)
+
+            # 6 Intersections (see intersection_sphere, with the sphere centered on the camera)
+            position = drop_position[:, None, :]
+            a = np.sum(vectors * vectors, axis=2)
+            b = 2 * np.sum(vectors * position, axis=2)
+            c = np.sum(position * position, axis=2) - radius * radius
+            t1 = (-b + np.sqrt(b ** 2 - 4 * a * c)) / (2 * a)
+            points = position + (t1[..., None] * vectors)
+
+            # 3D TO PLANE MAPPING (see cart2sph)
+            x, y, z = points[..., 0], points[..., 1], points[..., 2]
+            el = np.arctan2(z, np.sqrt(x ** 2 + y ** 2))
+            az = np.arctan2(y, x)
+            az = np.where(az < 0, az + 2 * np.pi, az)
+            el = np.where(el < 0, el + 2 * np.pi, el)
+            az = np.where(az > np.pi * 2, az - 2 * np.pi, az)
+            el = np.where(el > np.pi * 2, el - 2 * np.pi, el)
+
+            # Convert to the image encoding azimuth angle and shift: [-pi/2, 3*pi/2], modulo to [0, 2*pi]
+            azimuth = ((2 * np.pi - az) - np.pi / 2) % (2 * np.pi)
+            # Coordinate space change, modulo to convert to elevation: [0, 2*pi]
+            elevation = (el + np.pi / 2) % (2 * np.pi)
+            points_image = np.stack([azimuth / (2 * np.pi) * env_shape[1], (1. - elevation / np.pi) * env_shape[0]], axis=2)
+
+            azs = np.concatenate([azimuth, azimuth[:, :1]], axis=1)
+            cond = np.bitwise_or(np.isclose(np.diff(azs), 0), np.diff(azs) < 0)
+
+        count_true = np.sum(cond, axis=1)
+        count_false = np.sum(~cond, axis=1)
+        pos_true = np.argmax(cond, axis=1)
+        pos_false = np.argmax(~cond, axis=1)
+        valid &= (count_true > 0) & (count_false > 0)
+
+        rows, cols = env_shape[:2]
+        K = points_image.shape[1]
+        drops_fov_pts = []
+        for i in range(len(drop_position)):
+            if not valid[i]:
+                print('Drop skipped')
+                drops_fov_pts.append(np.array([]))
+                continue
+
+            pts = points_image[i]
+            if count_true[i] == 1:  # top
+                p = pos_true[i]
+                final_pts = np.vstack([pts[:p + 1], [cols, pts[p][1]], [cols, 0], [0, 0],
+                                       [0, pts[np.mod(p + 1, K)][1]], pts[p + 1:]])  # Top left
+            elif count_false[i] == 1:  # bottom
+                p = pos_false[i]
+                final_pts = np.vstack([pts[:p + 1], [0, pts[p][1]], [0, rows], [cols, rows],
+                                       [cols, pts[np.mod(p + 1, K)][1]], pts[p + 1:]])  # bot left
+            else:
+                final_pts = pts
+            drops_fov_pts.append(final_pts)
+
+        return drops_fov_pts
+
+
 class EnvironmentMapGenerator:
-    def __init__(self, f, image_width, image_height):
+    def __init__(self, f, image_width, image_height, cache_dir=None):
         # http://answers.opencv.org/question/17076/conversion-focal-distance-from-mm-to-pixels/
         self.image_width = image_width
         self.image_height = image_height
         self.focal = int(((f * 1000) / 12.7) * image_width)
         self.fillMatUp = 0
         self.fillMatDown = 0
+        self.cache_dir = cache_dir
 
     def convert2cyl(self, xyz, center):
         s = self.focal
@@ -739,9 +1302,64 @@ class EnvironmentMapGenerator:
         y = s * (-center[1] / np.sqrt(center[0] ** 2 + self.focal ** 2)) + center[1]
         return round(x), round(y)
 
-    def generate_map(self, background):
+    def geometry(self, shape):
+        '''
+        Function to get the geometry bundle of the environment map, which only depends on the focal and image size.
+        It is computed once and persisted in the cache directory (if any), then memory-mapped.
+        :param shape: Image shape.
+        :return: Dictionary with map_x, map_y (nearest neighbour remapping of the image, -1 when black), mask,
+                 fill_up, fill_down (see fill_matrices) and solid_angles of the environment map.
+        '''
+        h, w = shape[:2]
+        bundle = geometry_cache.load(self.cache_dir, 'envmap_f{}_{}x{}_v1'.format(self.focal, w, h),
+                                     lambda: self.build_geometry(h, w))
+        self.fillMatUp, self.fillMatDown = bundle["fill_up"], bundle["fill_down"]
+
+        return bundle
+
+    def build_geometry(self, h, w):
+        # Every step of the projection is a copy of pixels, so projecting pixel indices gives a lookup table
+        index = np.arange(1, h * w + 1, dtype=np.float64).reshape((h, w))
+        result, mask = self.project(index)
+        src = result.astype(np.int64) - 1
+
+        return {"map_x": np.where(src >= 0, src % w, -1).astype(np.float32),
+                "map_y": np.where(src >= 0, src // w, -1).astype(np.float32),
+                "mask": mask,
+                "fill_up": self.fillMatUp,
+                "fill_down": self.fillMatDown,
+                "solid_angles": solid_angle.get_solid_angles(result)}
+
+    def generate_map(self, background, dtype=np.float64):
         # Easier if everything is in int due to cv2 calls
         background = (background * 255).astype(np.uint8)
+        geometry = self.geometry(background.shape)
+
+        result = cv2.remap(background, geometry["map_x"], geometry["map_y"], cv2.INTER_NEAREST,
+                           borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        if result.ndim == 3:
+            blur = cv2.GaussianBlur(result, (15, 15), 0)  # TODO: check issue with float values ?
+            result = result + ((blur - result) & ~np.expand_dims(geometry["mask"], axis=-1))
+
+        return np.divide(result, 255.0, dtype=dtype)
+
+    def solid_angles(self, shape):
+        return self.geometry(shape)["solid_angles"]
+
+    def generate_map_reference(self, background):
+        # Original implementation of generate_map, computing the whole projection on every call
+        background = (background * 255).astype(np.uint8)
+        result, mask_result = self.project(background)
+
+        if result.ndim == 3:
+            blur = cv2.GaussianBlur(result, (15, 15), 0)  # TODO: check issue with float values ?
+            mask_result = np.tile(np.expand_dims(mask_result, axis=-1), (1, 1, 3))
+            result = result + ((blur - result) & ~mask_result)
+
+        return result / 255.0
+
+    def project(self, background):
         center = np.array([int(background.shape[1] // 2), int(background.shape[0] // 2)])
 
         max_x, max_y = self.max_coord(center)
@@ -811,12 +1429,7 @@ class EnvironmentMapGenerator:
         mask_side = cv2.flip(mask_side, 1)  # TODO: check issue with float values ?
         mask_result[:, mask_result.shape[1] - side.shape[1]:] = mask_side
 
-        if result.ndim == 3:
-            blur = cv2.GaussianBlur(result, (15, 15), 0)  # TODO: check issue with float values ?
-            mask_result = np.tile(np.expand_dims(mask_result, axis=-1), (1, 1, 3))
-            result = result + ((blur - result) & ~mask_result)
-
-        return result / 255.0
+        return result, mask_result
 
     @staticmethod
     def fill_matrices(cyl, mask):
@@ -831,10 +1444,7 @@ class EnvironmentMapGenerator:
         # indices which are empty
         ind_not_filled = np.where(mask_temp == 0)
 
-        fill_mat_up = np.zeros((ind_not_filled[0].shape[0], 2)).astype(np.int)
-        for i in range(fill_mat_up.shape[0]):
-            x_ind = ind_not_filled[1][i]
-            fill_mat_up[i] = xy_fill[x_ind]
+        fill_mat_up = xy_fill[ind_not_filled[1]].astype(np.int)
 
         mask_temp = cv2.flip(mask[mask.shape[0] // 2:, :], 0)
         cyl_temp = cv2.flip(cyl[cyl.shape[0] // 2:, :], 0)
@@ -845,10 +1455,7 @@ class EnvironmentMapGenerator:
         # indices which are empty
         ind_not_filled = np.where(mask_temp == 0)
 
-        fill_mat_down = np.zeros((ind_not_filled[0].shape[0], 2)).astype(np.int)
-        for i in range(fill_mat_down.shape[0]):
-            x_ind = ind_not_filled[1][i]
-            fill_mat_down[i] = xy_fill[x_ind]
+        fill_mat_down = xy_fill[ind_not_filled[1]].astype(np.int)
 
         return fill_mat_up, fill_mat_down
 
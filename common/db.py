@@ -61,6 +61,7 @@ _settings_defaults["render_scale"] = 1  # Scale down applied at rendering (1 = f
 #           At simulation step i, the ith parameter of above customizable parameters is applied (if it exists),
 #           and remains applied unless later changed.
 
+_settings_defaults["sim_backend"] = "ahl"  # ahl|numpy|sampler. ahl runs the AHLSimulation binary (3rdparty/weather-particle-simulator), numpy runs the vectorized simulator of common/particles_physics.py (no external dependency, much faster, sim_hz is ignored), sampler draws each frame independently at rendering (no simulation file, for still images datasets)
 _settings_defaults["sim_hz"] = 2000  # Update frequency (Hz) of the time-discrete discrete particle simulator. Lowering this number may significantly speed up, but also lower simulation precision. We do not recommand value below 1000. / cam_exposure as particles may not be updated during camera shutter opening.
 _settings_defaults["sim_mode"] = "normal"  # normal|steps (refer to above help)
 _settings_defaults["sim_duration"] = 34.  # Simulation duration (sec), will be overridden if "steps" is provided
@@ -105,6 +106,7 @@ def assert_settings(settings):
     assert settings["cam_exposure"] <= 1000./settings["cam_hz"], "Exposure should be lower than 1000./Hz otherwise camera frames temporally overlaps (non-tested behavior, remove assertion at your own risk)."
     assert settings["cam_lookat"][2] < 0, "Z axis should be negative (other systems were not tested, remove assertion at your own risk)."
     assert np.isclose(np.linalg.norm(settings["cam_up"]), 1), "cam_up must be of norm 1"
+    assert settings["sim_backend"] in ["ahl", "numpy", "sampler"], "sim_backend must be ahl, numpy or sampler"
 
 def sim(db_s, seq, particles_root):
     db_settings = settings(db_s)
@@ -0,0 +1,127 @@
+import numpy as np
+
+from common.bad_weather import DropType
+
+'''
+Per frame preprocessing of drops, on the arrays decoded by DBManager.frame_drops.
+
+Culling, random textures and wind noise, and the geometry of the drops sprites (Gaussian streaks) or perspective
+warpings (Big drops) are computed for all drops of a frame at once, so that the renderer only indexes arrays.
+
+Random draws are not vectorized: textures and wind noises are drawn drop after drop, in the order of the per drop
+renderer (texture, then noise of Gaussian streaks only), so that frames are identical to versions prior to this
+preprocessing.
+'''
+
+
+def visible(drops, image_shape_WH):
+    '''
+    Function to select the drops to render: sizes within the image and start or end point inside the image.
+    :return: Boolean mask (N,).
+    '''
+    imW, imH = image_shape_WH
+    size_max = max(imH, imW)
+    start, end = drops["image_position_start"], drops["image_position_end"]
+    inside_start = (0 <= start[:, 0]) & (start[:, 0] < imW) & (0 <= start[:, 1]) & (start[:, 1] < imH)
+    inside_end = (0 <= end[:, 0]) & (end[:, 0] < imW) & (0 <= end[:, 1]) & (end[:, 1] < imH)
+    return (1 <= drops["max_width"]) & (drops["max_width"] < size_max) & \
+           (1 <= drops["length"]) & (drops["length"] < size_max) & (inside_start | inside_end)
+
+
+def select(drops, mask):
+    return {k: v[mask] for k, v in drops.items()}
+
+
+def sprite_geometry(drops, noise, image_width):
+    '''
+    Function to compute the sprites of Gaussian streaks: the streak is rotated around its center by the wind noise
+    (positions being truncated as stored in integer arrays), the texture angle being the angle before noise.
+    :param noise: Wind noise of each drop (degrees).
+    :return: Tuple (minC (N, 2), angle (N,), flip (N,), width (N,), height (N,)) of the sprites.
+    '''
+    start = drops["image_position_start"].astype(np.float64)
+    end = drops["image_position_end"].astype(np.float64)
+
+    dir1 = start - end
+    dir1 = dir1 / np.linalg.norm(dir1, axis=1, keepdims=True)
+    theta = np.rad2deg(np.arccos(-dir1[:, 1]))
+
+    nx, ny = np.cos(np.deg2rad(noise)), np.sin(np.deg2rad(noise))
+    mean = (start + end) / 2
+
+    def rotate(p):
+        return np.trunc(np.stack([(p[:, 0] - mean[:, 0]) * nx - (p[:, 1] - mean[:, 1]) * ny + mean[:, 0],
+                                  (p[:, 0] - mean[:, 0]) * ny + (p[:, 1] - mean[:, 1]) * nx + mean[:, 1]], axis=1))
+
+    start, end = rotate(start), rotate(end)
+    flip = end[:, 0] > image_width // 2
+    height = np.maximum(np.abs(end[:, 1] - start[:, 1]), 2).astype(np.int64)
+    width = np.maximum(np.abs(end[:, 0] - start[:, 0]), drops["max_width"] + 2).astype(np.int64)
+    return start.astype(np.int64), theta + noise, flip, width, height
+
+
+def warping_geometry(drops, texture_shapes, image_width, image_height):
+    '''
+    Vectorized version of RainRenderer.warping_points, for the perspective warping of Big drops.
+    :param texture_shapes: Shape (height, width) of the texture of each drop (N, 2).
+    :return: Tuple (pts1 (N, 4, 2), pts2 (N, 4, 2), maxC (N, 2), minC (N, 2)).
+    '''
+    x0, y0 = drops["image_position_start"][:, 0], drops["image_position_start"][:, 1]
+    x1, y1 = drops["image_position_end"][:, 0], drops["image_position_end"][:, 1]
+    d0, d1 = np.floor(drops["image_diameter_start"]), np.floor(drops["image_diameter_end"])
+
+    minx = np.maximum(np.minimum(x0, x1), 0)
+    miny = np.maximum(np.minimum(y0, y1), 0)
+    maxx = np.minimum(np.maximum(x0 + d0, x1 + d1), image_width)
+    maxy = np.minimum(np.maximum(y0, y1), image_height)
+
+    # to prevent singularity of pers matrix
+    epsilon = 0.001
+
+    th, tw = texture_shapes[:, 0], texture_shapes[:, 1]
+    zero = np.zeros_like(tw)
+    pts1 = np.stack([np.stack([zero, zero], axis=1), np.stack([tw, zero], axis=1),
+                     np.stack([tw, th], axis=1), np.stack([zero, th], axis=1)], axis=1).astype(np.float32)
+    pts2 = np.stack([np.stack([x0 - minx, y0 - miny], axis=1),
+                     np.stack([x0 - minx + d0, y0 - miny], axis=1),
+                     np.stack([x1 - minx + d1 + epsilon, y1 - miny], axis=1),
+                     np.stack([x1 - minx + epsilon, y1 - miny], axis=1)], axis=1).astype(np.float32)
+
+    return pts1, pts2, np.stack([maxx, maxy], axis=1), np.stack([minx, miny], axis=1)
+
+
+def prepare_drops(drops, db, image_shape_WH, noise_std=0., noise_scale=0.):
+    '''
+    Function to cull the drops of a frame and compute everything the renderer needs per drop.
+    :param drops: Drops arrays, see DBManager.frame_drops.
+    :param db: DBManager with the streaks database loaded.
+    :param image_shape_WH: Image width and height.
+    :param noise_std: Standard deviation of the wind noise (degrees).
+    :param noise_scale: Scale of the wind noise.
+    :return: Drops arrays of the visible drops, with the additional keys texture_idx, noise, gaussian, sprite_minC,
+    sprite_angle, sprite_flip, sprite_width, sprite_height (Gaussian streaks) and warp_pts1, warp_pts2, warp_maxC,
+    warp_minC (Big drops).
+    '''
+    imW, imH = image_shape_WH
+    drops = select(drops, visible(drops, image_shape_WH))
+    n = len(drops["pid"])
+
+    drops["gaussian"] = drops["drop_type"] != DropType.Big.value
+
+    # Random textures and noises are drawn drop by drop, in the order of the per drop renderer (texture, then noise of
+    # Gaussian streaks only), so that renderings remain reproducible
+    texture_bins = db.drops_texture_bin(drops["ratio"])
+    drops["texture_idx"], drops["noise"] = np.zeros(n, dtype=np.int64), np.zeros(n)
+    for drop_idx in range(n):
+        drops["texture_idx"][drop_idx] = np.random.randint(texture_bins[drop_idx] * 10, texture_bins[drop_idx] * 10 + 10)
+        if drops["gaussian"][drop_idx]:
+            drops["noise"][drop_idx] = np.random.normal(0.0, noise_std) * noise_scale
+
+    # Both geometries are computed for all drops, which is cheaper than selecting them
+    drops["sprite_minC"], drops["sprite_angle"], drops["sprite_flip"], drops["sprite_width"], drops["sprite_height"] = \
+        sprite_geometry(drops, np.where(drops["gaussian"], drops["noise"], 0.), imW)
+    texture_shapes = np.array([t.shape[:2] for t in db.streaks_light])[drops["texture_idx"]].reshape((-1, 2))
+    drops["warp_pts1"], drops["warp_pts2"], drops["warp_maxC"], drops["warp_minC"] = \
+        warping_geometry(drops, texture_shapes, imW, imH)
+
+    return drops
@@ -0,0 +1,231 @@
+import numpy as np
+
+'''
+Integration of the environment map over convex polygons (the drops field of view), in O(polygon height).
+
+The environment map xyY and solid angles are accumulated once per frame in row-wise prefix sums. The polygon is then
+rasterized into one [left, right] span per row, following exactly the pixels cv2.fillConvexPoly would set (scanline
+fill in 16-bit fixed point, plus the 8-connected outline clipped to the image), so that integrals match a mask
+computed with OpenCV.
+'''
+
+XY_SHIFT = 16
+XY_ONE = 1 << XY_SHIFT
+
+
+def _clip_line(W, H, pt1, pt2):
+    # Same as cv2.clipLine, clip segment to the image [0, W-1] x [0, H-1]
+    (x1, y1), (x2, y2) = pt1, pt2
+    right, bottom = W - 1, H - 1
+    c1 = (x1 < 0) + (x1 > right) * 2 + (y1 < 0) * 4 + (y1 > bottom) * 8
+    c2 = (x2 < 0) + (x2 > right) * 2 + (y2 < 0) * 4 + (y2 > bottom) * 8
+    if (c1 & c2) == 0 and (c1 | c2) != 0:
+        if c1 & 12:
+            a = 0 if c1 < 8 else bottom
+            x1 += int(float(a - y1) * (x2 - x1) / (y2 - y1))
+            y1 = a
+            c1 = (x1 < 0) + (x1 > right) * 2
+        if c2 & 12:
+            a = 0 if c2 < 8 else bottom
+            x2 += int(float(a - y2) * (x2 - x1) / (y2 - y1))
+            y2 = a
+            c2 = (x2 < 0) + (x2 > right) * 2
+        if (c1 & c2) == 0 and (c1 | c2) != 0:
+            if c1:
+                a = 0 if c1 == 1 else right
+                y1 += int(float(a - x1) * (y2 - y1) / (x2 - x1))
+                x1 = a
+                c1 = 0
+            if c2:
+                a = 0 if c2 == 1 else right
+                y2 += int(float(a - x2) * (y2 - y1) / (x2 - x1))
+                x2 = a
+                c2 = 0
+
+    return (c1 | c2) == 0, (x1, y1), (x2, y2)
+
+
+def _ceil_div(a, b):
+    return -((-a) // b)
+
+
+def line_pixels(pt1, pt2, W, H):
+    '''
+    Pixels of an 8-connected line, as drawn by OpenCV (clipped to the image, Bresenham from left to right).
+    :return: Arrays of x and y coordinates.
+    '''
+    visible, (x1, y1), (x2, y2) = _clip_line(W, H, pt1, pt2)
+    if not visible:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    if x2 < x1:
+        x1, y1, x2, y2 = x2, y2, x1, y1
+    dx, dy = x2 - x1, abs(y2 - y1)
+    sy = -1 if y2 < y1 else 1
+
+    # Closed form of the Bresenham error accumulation: minor axis is stepped m_k times after k major axis steps
+    k = np.arange(max(dx, dy) + 1, dtype=np.int64)
+    major, minor = max(dx, dy), min(dx, dy)
+    m = np.maximum(0, _ceil_div(2 * minor * k - major, 2 * major)) if major > 0 else k
+    if dy > dx:
+        return x1 + m, y1 + sy * k
+    return x1 + k, y1 + sy * m
+
+
+def convex_poly_spans(pts, W, H):
+    '''
+    Function to rasterize a convex polygon into row spans, identical to cv2.fillConvexPoly (8-connected, no shift).
+    :param pts: Integer polygon points (N, 2).
+    :param W: Image width.
+    :param H: Image height.
+    :return: Arrays left and right (H,) of the first and last pixel of each row, left > right for empty rows.
+    '''
+    pts = np.asarray(pts, dtype=np.int64).reshape((-1, 2))
+    npts = len(pts)
+    left = np.full(H, W, dtype=np.int64)
+    right = np.full(H, -1, dtype=np.int64)
+
+    # Outline
+    for i in range(npts):
+        xs, ys = line_pixels(tuple(pts[i - 1].tolist()), tuple(pts[i].tolist()), W, H)
+        np.minimum.at(left, ys, xs)
+        np.maximum.at(right, ys, xs)
+
+    if npts < 3:
+        return left, right
+    xmin, ymin = pts.min(axis=0).tolist()
+    xmax, ymax = pts.max(axis=0).tolist()
+    if xmax < 0 or ymin >= H or xmin >= W or ymax < 0:
+        return left, right
+    ymax = min(ymax, H - 1)
+
+    # Scanline fill, walking the left and right chains from the top vertex. Rows between two vertices are filled at
+    # once, the edges x being stepped in fixed point as OpenCV does.
+    imin = int(np.argmin(pts[:, 1]))
+    edges_left = npts
+    edge = [{"idx": imin, "di": 1, "x": -XY_ONE, "dx": 0, "ye": ymin},
+            {"idx": imin, "di": npts - 1, "x": -XY_ONE, "dx": 0, "ye": ymin}]
+    y = ymin
+    while True:
+        for e in edge:
+            if y >= e["ye"]:
+                idx0 = e["idx"]
+                idx = (idx0 + e["di"]) % npts
+                while edges_left > 0:
+                    edges_left -= 1
+                    ty = int(pts[idx, 1])
+                    if ty > y:
+                        xs, xe = int(pts[idx0, 0]) << XY_SHIFT, int(pts[idx, 0]) << XY_SHIFT
+                        num, den = (xe - xs) * 2 + (ty - y), 2 * (ty - y)
+                        e["dx"] = abs(num) // den * (1 if num >= 0 else -1)  # C division (truncation)
+                        e["x"], e["ye"], e["idx"] = xs, ty, idx
+                        break
+                    idx0 = idx
+                    idx = (idx + e["di"]) % npts
+                else:
+                    edges_left = -1
+        if edges_left < 0:
+            break
+
+        y_next = min(edge[0]["ye"], edge[1]["ye"], ymax + 1)
+        steps = np.arange(y_next - y, dtype=np.int64)
+        xa, xb = edge[0]["x"] + steps * edge[0]["dx"], edge[1]["x"] + steps * edge[1]["dx"]
+        xx1 = (np.minimum(xa, xb) + (XY_ONE >> 1)) >> XY_SHIFT
+        xx2 = (np.maximum(xa, xb) + (XY_ONE >> 1)) >> XY_SHIFT
+        rows = y + steps
+        visible = (rows >= 0) & (xx2 >= 0) & (xx1 < W)
+        rows = rows[visible]
+        left[rows] = np.minimum(left[rows], np.maximum(xx1[visible], 0))
+        right[rows] = np.maximum(right[rows], np.minimum(xx2[visible], W - 1))
+
+        edge[0]["x"] += (y_next - y) * edge[0]["dx"]
+        edge[1]["x"] += (y_next - y) * edge[1]["dx"]
+        y = y_next
+        if y > ymax:
+            break
+
+    return left, right
+
+
+class EnvMapIntegral:
+    def __init__(self, env_map_xyY, solid_angle_map):
+        '''
+        Per frame precomputation to integrate the environment map over drops FOV.
+        :param env_map_xyY: Environment map in xyY (H, W, 3).
+        :param solid_angle_map: Solid angle of each pixel of the environment map (H, W).
+        '''
+        self.H, self.W = solid_angle_map.shape[:2]
+
+        # Row-wise prefix sums of [solid angle, x * solid angle, y * solid angle, Y * solid angle], with a leading
+        # zero column so that the sum of row r over [x1, x2] is cumsum[r, x2 + 1] - cumsum[r, x1]
+        weighted = np.concatenate([solid_angle_map[..., None], env_map_xyY * solid_angle_map[..., None]], axis=-1)
+        self.cumsum = np.zeros((self.H, self.W + 1, 4), dtype=np.float64)
+        np.cumsum(weighted, axis=1, out=self.cumsum[:, 1:])
+
+        # Frame constants
+        self.solid_angle_sum = np.sum(solid_angle_map)
+        self.ambient_lum = np.sum(env_map_xyY[..., 2] * solid_angle_map) / self.solid_angle_sum
+
+    def __repr__(self):
+        return "EnvMapIntegral({}x{})".format(self.W, self.H)
+
+    def integrate(self, pts):
+        '''
+        Function to integrate the environment map over a convex polygon.
+        :param pts: Integer polygon points, in environment map pixels.
+        :return: Tuple (solid angle, xyY weighted by solid angle) summed over the polygon pixels.
+        '''
+        left, right = convex_poly_spans(pts, self.W, self.H)
+        rows = np.nonzero(right >= left)[0]
+        sums = np.sum(self.cumsum[rows, right[rows] + 1] - self.cumsum[rows, left[rows]], axis=0)
+
+        return sums[0], sums[1:]
+
+    def integrate_many(self, polygons, max_cells=1 << 22):
+        '''
+        Vectorized approximation of integrate, over many polygons at once. Points are truncated to integers (as
+        pyclipper does) and each row spans from the floor of its leftmost to the ceil of its rightmost edges crossing,
+        which approximates the outline cv2.fillConvexPoly adds (solid angles within ~0.3%, more for tiny polygons).
+        :param polygons: List of polygons points (N_i, 2), in environment map pixels. Empty polygons are skipped.
+        :param max_cells: Bound on the (row, edge) pairs processed at once, to limit memory.
+        :return: Tuple (solid angles (N,), xyY weighted by solid angle (N, 3)) summed over the polygons pixels.
+        '''
+        sums = np.zeros((len(polygons), 4), dtype=np.float64)
+        valid = [i for i, p in enumerate(polygons) if len(p) >= 3]
+        if len(valid) == 0:
+            return sums[:, 0], sums[:, 1:]
+
+        # Polygons padded to the same number of points by repeating their last point (degenerate edges never cross rows)
+        polygons = [np.trunc(np.asarray(polygons[i], dtype=np.float64)).reshape((-1, 2)) for i in valid]
+        K = max([len(p) for p in polygons])
+        pts = np.stack([np.concatenate([p, np.repeat(p[-1:], K - len(p), axis=0)]) for p in polygons])
+        valid = np.asarray(valid)
+
+        y0 = np.maximum(np.ceil(pts[..., 1].min(axis=1)), 0).astype(np.int64)
+        y1 = np.minimum(np.floor(pts[..., 1].max(axis=1)), self.H - 1).astype(np.int64)
+        nrows = np.maximum(y1 - y0 + 1, 0)
+
+        # Chunks of polygons with at most max_cells (row, edge) pairs
+        bounds = np.searchsorted(np.cumsum(nrows * K), np.arange(1, (np.sum(nrows) * K) // max_cells + 1) * max_cells)
+        for chunk in np.split(np.arange(len(pts)), np.unique(bounds)):
+            if len(chunk) == 0 or np.sum(nrows[chunk]) == 0:
+                continue
+            poly = np.repeat(chunk, nrows[chunk])
+            y = (y0[chunk].repeat(nrows[chunk]) + np.arange(len(poly)) - np.repeat(np.cumsum(nrows[chunk]) - nrows[chunk], nrows[chunk]))[:, None]
+            xa, ya = pts[poly, :, 0], pts[poly, :, 1]
+            xb, yb = np.roll(xa, -1, axis=1), np.roll(ya, -1, axis=1)
+
+            crossing = (np.minimum(ya, yb) <= y) & (y <= np.maximum(ya, yb)) & (ya != yb)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = xa + (y - ya) * (xb - xa) / (yb - ya)
+            left = np.floor(np.where(crossing, x, np.inf).min(axis=1))
+            right = np.ceil(np.where(crossing, x, -np.inf).max(axis=1))
+            left, right = np.maximum(left, 0), np.minimum(right, self.W - 1)
+            ok = right >= left
+
+            rows, left, right = y[ok, 0], left[ok].astype(np.int64), right[ok].astype(np.int64)
+            span_sums = self.cumsum[rows, right + 1] - self.cumsum[rows, left]
+            for k in range(4):
+                sums[valid, k] += np.bincount(poly[ok], weights=span_sums[:, k], minlength=len(pts))
+
+        return sums[:, 0], sums[:, 1:]
@@ -0,0 +1,121 @@
+import collections
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from matplotlib import cm
+from natsort import natsorted
+
+from common import my_utils
+
+'''
+Frames input / output helpers, to overlap disk access with rendering.
+
+Decoding of the upcoming frames and encoding of the rendered ones run in threads (OpenCV releases the GIL), both with
+bounded queues so that memory stays bounded whatever the speed of the disk.
+'''
+
+
+def sequence_images(dataset, images, settings):
+    '''
+    Function to list the images of a sequence, and get their size at rendering.
+    :param images: Images of the sequence as resolved by the dataset configuration, a folder (list of files for nuscenes).
+    :param settings: Dataset settings (see db.settings).
+    :return: Tuple (files, imW, imH).
+    '''
+    if "nuscenes" in dataset:
+        files = images
+        if "gan" in dataset:
+            # HARDCODED since these values are not known in nuscenes_gan
+            imW, imH = (1600, 900)
+        else:
+            img = cv2.imread(files[0])
+            imH, imW = img.shape[0:2]
+    else:
+        files = natsorted(np.array([os.path.join(images, picture) for picture in my_utils.os_listdir(images)]))
+        im = files[0]
+        if im.endswith(".png"):
+            imH, imW = cv2.imread(im).shape[0:2]
+        elif im.endswith(".npy"):
+            imH, imW = np.load(im).shape[0:2]
+        else:
+            raise Exception("Invalid extension", im)
+        imH = imH//settings["render_scale"]
+        imW = imW//settings["render_scale"]
+
+    return files, imW, imH
+
+
+def imsave(path, arr, cmap=None, compression=3):
+    '''
+    Drop-in replacement of plt.imsave for PNG files, encoded with OpenCV (much faster).
+    Pixels are identical: arrays are converted to RGBA by matplotlib exactly as plt.imsave does (RGB arrays as is,
+    single channel arrays through the colormap scaled to their min/max).
+    :param path: Output path.
+    :param arr: RGB(A) or single channel image.
+    :param cmap: Colormap for single channel images (None for matplotlib default).
+    :param compression: PNG compression level (0-9).
+    '''
+    sm = cm.ScalarMappable(cmap=cmap)
+    sm.set_clim(None, None)
+    rgba = sm.to_rgba(arr, bytes=True)
+
+    if not cv2.imwrite(path, cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA), [cv2.IMWRITE_PNG_COMPRESSION, compression]):
+        raise IOError("Could not write {}".format(path))
+
+
+def prefetch(executor, fn, items, depth):
+    '''
+    Generator applying fn to items in background, at most depth items ahead of the consumer.
+    :param executor: Executor running fn.
+    :return: Futures of fn(item), in items order.
+    '''
+    items = iter(items)
+    pending = collections.deque(executor.submit(fn, item) for item in itertools.islice(items, depth))
+    while pending:
+        future = pending.popleft()
+        pending.extend(executor.submit(fn, item) for item in itertools.islice(items, 1))
+        yield future
+
+
+class AsyncWriter:
+    def __init__(self, workers=2, max_pending=4):
+        '''
+        Run write functions in background threads.
+        Submitting blocks once max_pending writes are queued (backpressure), errors are raised back to the caller at
+        the next submission or when closing.
+        :param workers: Number of writing threads.
+        :param max_pending: Maximum number of writes queued or running.
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # On error, drop queued writes but let running ones complete
+        self.close(cancel=exc_type is not None)
+
+    def _done(self, future):
+        self.slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def raise_errors(self):
+        if len(self.errors):
+            raise self.errors[0]
+
+    def submit(self, fn, *args, **kwargs):
+        self.raise_errors()
+        self.slots.acquire()
+        self.executor.submit(fn, *args, **kwargs).add_done_callback(self._done)
+
+    def close(self, cancel=False):
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+        if not cancel:
+            self.raise_errors()
@@ -1,18 +1,30 @@
+import collections
+import functools
+import multiprocessing
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
-import imutils
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image, ImageChops
 from natsort import natsorted
 
-from common import add_attenuation, my_utils
+from common import add_attenuation, my_utils, db, frame_io, asset_cache
 from common import solid_angle
-from common.bad_weather import DBManager, DropType, RainRenderer, EnvironmentMapGenerator, FovComputation
+from common.bad_weather import DBManager, RainRenderer, EnvironmentMapGenerator, FovComputation, Streak
 from common.drop_depth_map import DropDepthMap
+from common.drop_preprocessing import prepare_drops
+from common.envmap_integral import EnvMapIntegral
+from common.sprite_bank import SpriteBank
+from common.streak_sampler import sequence_seed
+from common.streak_splat import StreakSplatter
+from common.tile_compositor import TileCompositor, TILE_BATCH
+from common.transmittance import TransmittanceBuffer
+from common.precision import PRECISIONS
+from common.stages import OUTPUTS, required_stages
 
 plt.ion()
 
@@ -38,10 +50,12 @@ class Generator:
         self.sequences = args.sequences
         self.depth = args.depth
         self.particles = args.particles
+        self.sim_options = args.sim_options
         self.weather = args.weather
         self.texture = args.texture
         self.norm_coeff = args.norm_coeff
-        self.save_envmap = args.save_envmap
+        self.outputs = args.outputs
+        self.cache_dir = args.cache_dir
         self.settings = args.settings
 
         # dataset specific
@@ -65,6 +79,21 @@ class Generator:
         self.frame_step = args.frame_step
         self.frames = args.frames
         self.verbose = args.verbose
+        self.log_frames = args.log_frames
+        self.workers = args.workers
+        self.io_threads = args.io_threads
+        self.png_compression = args.png_compression
+        self.sprite_angle_step = args.sprite_angle_step
+        self.sprite_cache_mb = args.sprite_cache_mb
+        self.defocus_sigma_step = args.defocus_sigma_step
+        self.fast_streaks = args.fast_streaks
+        self.tile_threads = args.tile_threads
+        self.blend_mode = args.blend_mode
+        self.precision = PRECISIONS[args.precision]
+        self.fanout = args.fanout
+        self.pipeline = args.pipeline
+        asset_cache.assets.max_bytes = args.asset_cache_mb << 20
+        self.stages = required_stages(self.outputs, self.rendering_strategy)
 
         # options for environment map and irradiance types
         self.env_type = 'ours'  # 'pano' | 'ours'
@@ -78,6 +107,14 @@ class Generator:
         self.BGR_env_map = None
         self.env_map_xyY = None
         self.solid_angle_map = None
+        self.env_integral = None
+        self.exposure_time = None
+        self.fog = None
+        self.map_generator = None
+        self.sprites = None
+        self.splatter = None
+        self.compositor = None
+        self.simulations = collections.OrderedDict()
 
         # check if everything is fine
         self.check_folders()
@@ -116,174 +153,565 @@ class Generator:
         im_cropped = np.asarray(im_cropped) / 255
         return im_cropped.astype(np.float64)
 
-    def compute_drop(self, bg, drop_dict, rainy_bg, rainy_mask, rainy_saturation_mask):
-        # Drop taken from database
-        streak_db_drop = self.db.take_drop_texture(drop_dict)
+    def compute_drop(self, bg, drops, i, rainy_bg, rainy_mask, rainy_saturation_mask, drop_fov_pts=None, coc=None):
+        '''
+        Function to render one drop.
+        :param drops: Drops arrays of the frame, see drop_preprocessing.prepare_drops.
+        :param i: Index of the drop.
+        '''
+        prepared = self.prepare_drop(bg.shape, drops, i, drop_fov_pts, coc)
+        if prepared is None:
+            return rainy_bg, rainy_mask, rainy_saturation_mask, None, None, None
+
+        drop, minC, blending = prepared
+        drop, blended_drop = self.renderer.blend_drop(rainy_bg, rainy_mask, rainy_saturation_mask, drop, minC, *blending)
+        return rainy_bg, rainy_mask, rainy_saturation_mask, drop, blended_drop, minC
 
-        image_height, image_width = bg.shape[:2]
+    def prepare_drop(self, image_shape, drops, i, drop_fov_pts=None, coc=None):
+        '''
+        Function to compute the sprite of one drop, coloured and defocused (see RainRenderer.prepare_drop).
+        Drops are prepared independently of each other, hence concurrently in tile mode.
+        :return: Tuple (drop, minC, blending), None if the drop is erroneous.
+        '''
+        drop_dict = Streak.from_drops(drops, i)
+
+        # Drop taken from database
+        texture_idx = drops["texture_idx"][i]
 
         # Gaussian streaks do not need a perspective warping. If strak is not BIG -> Gaussian streak
-        if drop_dict.drop_type == DropType.Big:
-            pts1, pts2, maxC, minC = self.renderer.warping_points(drop_dict, streak_db_drop, image_width, image_height)
+        if not drops["gaussian"][i]:
+            streak_db_drop = self.db.streaks_light[texture_idx]
+            pts1, pts2, maxC, minC = drops["warp_pts1"][i], drops["warp_pts2"][i], drops["warp_maxC"][i], drops["warp_minC"][i]
             shape = np.subtract(maxC, minC).astype(int)
             perspective_matrix = cv2.getPerspectiveTransform(pts1, pts2)
             drop = cv2.warpPerspective(streak_db_drop, perspective_matrix, (max(shape[0], 1), max(shape[1], 1)),
                                        flags=cv2.INTER_CUBIC)
             drop = np.clip(drop, 0, 1)
         else:
-            # in case of drops from database
-            # Gaussian noise to simulate soft wind (in degrees)
-            noise = np.random.normal(0.0, self.noise_std) * self.noise_scale
-
-            dir1 = drop_dict.image_position_start - drop_dict.image_position_end
-            n1 = np.linalg.norm(dir1)
-            dir1 = dir1 / n1
-            dir2 = np.array([0, -1])
-
-            # Drop angle in degrees; add small random gaussian noise to represent localized wind
-            theta = np.rad2deg(np.arccos(np.dot(dir1, dir2)))
-
-            # Note: The noise is added to the drop coordinates AFTER the drop angle is calculated so the rotate_bound
-            # function, which uses interpolation (contrarily to the drop position which are in integers),
-            # would be more accurate
-            nx, ny = np.cos(np.deg2rad(noise)), np.sin(np.deg2rad(noise))
-            mean_x = (drop_dict.image_position_end[0] + drop_dict.image_position_start[0]) / 2
-            mean_y = (drop_dict.image_position_end[1] + drop_dict.image_position_start[1]) / 2
-            drop_dict.image_position_start[:] = \
-                (drop_dict.image_position_start[0] - mean_x) * nx - \
-                (drop_dict.image_position_start[1] - mean_y) * ny + mean_x,\
-                (drop_dict.image_position_start[0] - mean_x) * ny + \
-                (drop_dict.image_position_start[1] - mean_y) * nx + mean_y
-            drop_dict.image_position_end[:] = \
-                (drop_dict.image_position_end[0] - mean_x) * nx - \
-                (drop_dict.image_position_end[1] - mean_y) * ny + mean_x,\
-                (drop_dict.image_position_end[0] - mean_x) * ny + \
-                (drop_dict.image_position_end[1] - mean_y) * nx + mean_y
-
-            drop = imutils.rotate_bound(streak_db_drop, theta + noise)
-
-            drop = cv2.flip(drop, 0) if drop_dict.image_position_end[0] > rainy_bg.shape[1] // 2 else drop
-            height = max(abs(drop_dict.image_position_end[1] - drop_dict.image_position_start[1]), 2)
-            width = max(abs(
-                drop_dict.image_position_end[0] - drop_dict.image_position_start[0]), drop_dict.max_width + 2)
-            drop = cv2.resize(drop, (width, height), interpolation=cv2.INTER_AREA)
-            drop = np.clip(drop, 0, 1)
-            minC = drop_dict.image_position_start
-
-        # Compute alpha channel from any other channel (since it was gray)
-        drop = np.dstack([drop, drop[..., 0]])
+            # Rotated, flipped and resized texture (cached), the angle including a small random gaussian noise to
+            # simulate soft wind (see drop_preprocessing.sprite_geometry)
+            drop = self.sprites.get(texture_idx, drops["sprite_angle"][i], int(drops["sprite_width"][i]),
+                                    int(drops["sprite_height"][i]), bool(drops["sprite_flip"][i]))
+            minC = drops["sprite_minC"][i]
 
         ###########################################   COLOUR DROP  #################################################
-        drop_fov_pts, drop_fov_pts3d, drop_direction, drop_position = \
-            self.fov_comp.compute_fov_plane_points(drop_dict, self.renderer.radius, self.renderer.fov,
-                                                   20, self.BGR_env_map.shape)
+        if drop_fov_pts is None and 'envmap_integral' in self.stages:
+            drop_fov_pts, drop_fov_pts3d, drop_direction, drop_position = \
+                self.fov_comp.compute_fov_plane_points(drop_dict, self.renderer.radius, self.renderer.fov,
+                                                       20, self.BGR_env_map.shape)
         try:
-            rainy_bg, rainy_mask, rainy_saturation_mask, drop, blended_drop, minC = \
-                self.renderer.add_drop_to_image(self.dataset, self.env_map_xyY, self.solid_angle_map, drop_fov_pts,
-                                                minC, bg, rainy_bg, rainy_mask, rainy_saturation_mask, drop, drop_dict,
-                                                self.irrad_type, self.rendering_strategy, self.opacity_attenuation)
+            return self.renderer.prepare_drop(self.dataset, self.env_map_xyY, self.solid_angle_map, drop_fov_pts, minC,
+                                              image_shape, drop, drop_dict, self.irrad_type, self.rendering_strategy,
+                                              self.opacity_attenuation, env_integral=self.env_integral,
+                                              exposure_time=self.exposure_time, coc=coc)
         except Exception as e:
             import traceback
             print('Erroneous drop (' + str(e) + ')')
             print(traceback.print_exc())
-            blended_drop = None
+            return None
+
+    def prepare_simulation(self, sequence, sim_idx, sim_weather):
+        '''
+        Function to resolve everything needed to render a sequence with a given weather (done once, in main process).
+        :return: Dictionary describing the simulation, passed along to load_simulation and render_frame.
+        '''
+        weather, fallrate = sim_weather["weather"], sim_weather["fallrate"]
+        depth_folder = self.depth[sequence]
+
+        out_seq_dir = os.path.join(self.output_root, sequence)
+        out_dir = os.path.join(out_seq_dir, weather, '{}mm'.format(fallrate))
+        sim_file = self.particles[sequence][sim_idx]
+
+        # Resolve output path
+        path_exists = os.path.exists(out_dir)
+        if path_exists:
+            if self.conflict_strategy == "skip":
+                pass
+            elif self.conflict_strategy == "overwrite":
+                pass
+            elif self.conflict_strategy == "rename_folder":
+                out_dir_, out_shift = out_dir, 0
+                while os.path.exists(out_dir_ + '_copy%05d' % out_shift):
+                    out_shift += 1
+
+                out_dir = out_dir_ + '_copy%05d' % out_shift
+            else:
+                raise NotImplementedError
+
+        # Create directory
+        os.makedirs(out_dir, exist_ok=True)
+
+        # Default fog-like rain parameters
+        fog_params = {"rain_intensity": fallrate, "focal": self.focal, "f_number": self.f_number, "angle": 90,
+                      "exposure": self.exposure, "camera_gain": self.camera_gain}
+
+        files, imW, imH = frame_io.sequence_images(self.dataset, self.images[sequence], self.settings)
+        if "nuscenes" in self.dataset:
+            depth_files = self.depth[sequence]
+            depth_file = depth_files[0]
+            assert depth_file.endswith(".npy"), "nuscenes processing only works with .npy for depth"
+            # depth = np.load(depth_file)
+        else:
+            depth_files = natsorted(np.array([os.path.join(depth_folder, depth) for depth in my_utils.os_listdir(depth_folder)]))
+
+        if self.camera_gain:
+            fog_params["camera_gain"] = self.camera_gain
+
+        return {"sequence": sequence, "sim_idx": sim_idx, "weather": weather, "fallrate": fallrate,
+                "out_dir": out_dir, "out_seq_dir": out_seq_dir, "sim_file": sim_file,
+                "sim_options": self.sim_options[sequence], "fog_params": fog_params,
+                "files": files, "depth_files": depth_files, "calib_files": self.calib[sequence],
+                "imW": imW, "imH": imH}
+
+    def load_simulation(self, sim, render=True):
+        '''
+        Function to load the particles simulation, and unless render is False the renderer objects.
+        :param sim: Simulation, see prepare_simulation.
+        :param render: Whether to load what is needed to render frames (streaks database, fog, etc.).
+        '''
+        imW, imH = sim["imW"], sim["imH"]
+
+        # loading StreaksDBManager, RainRenderer, FOVComputation and EnvMapGenerator
+        self.db = DBManager(streaks_path_xml=sim["sim_file"], streaks_path=self.texture,
+                            norm_coeff_path=self.norm_coeff)
+
+        # creating drops based on the simulator file (memory-mapped, frames are decoded on demand), or sampled per frame
+        if sim["sim_options"]["sim_backend"] == "sampler":
+            fallrate = sim["fallrate"] if sim["weather"] == "rain" else 0.
+            seed = sequence_seed(self.dataset, sim["sequence"], sim["weather"], sim["fallrate"])
+            self.db.load_sampler(self.dataset, self.settings, [imW, imH], sim["sim_options"], fallrate, seed)
+        else:
+            self.db.load_particles(self.dataset, self.settings, [imW, imH], verbose=self.verbose)
+
+        if not render:
+            return
+
+        self.renderer = RainRenderer(focal=self.focal, f_number=self.f_number, focus_plane=6, radius=10, fov=165,
+                                     defocus_sigma_step=self.defocus_sigma_step)
+        self.fov_comp = FovComputation(camera=np.array([0, 0, 0]))
+        self.exposure_time = db.settings(self.dataset)["cam_exposure"] / 1000.
+        self.map_generator = EnvironmentMapGenerator(self.focal, imW, imH, cache_dir=self.cache_dir)
+
+        # loading fog class
+        self.fog = add_attenuation.FogRain(**sim["fog_params"])
+
+        # loading streaks from Streaks Database (read once per process, see asset_cache)
+        self.db.load_streak_database()
+
+        # Sprites only depend on the streaks database, hence they are kept across simulations
+        if self.sprites is None:
+            self.sprites = SpriteBank(self.db.streaks_light, self.sprite_angle_step, self.sprite_cache_mb << 20)
+        if self.splatter is None and self.fast_streaks:
+            self.splatter = StreakSplatter(self.db.streaks_light)
+
+    def select_simulation(self, sim, capacity=1):
+        '''
+        Function to make sim the simulation to render, loading it unless it is among the capacity last simulations
+        selected (which are kept loaded, e.g. the simulations of all intensities of a sequence with fan-out).
+        '''
+        key = (sim["sequence"], sim["sim_idx"], sim["out_dir"])
+        if key not in self.simulations:
+            self.load_simulation(sim)
+            self.simulations[key] = (self.db, self.fog)
+            while len(self.simulations) > capacity:
+                self.simulations.popitem(last=False)
+
+        self.simulations.move_to_end(key)
+        self.db, self.fog = self.simulations[key]
 
-        return rainy_bg, rainy_mask, rainy_saturation_mask, drop, blended_drop, minC
+    @staticmethod
+    def frame_paths(sim, i):
+        '''
+        :return: Dictionary, Key: output (see stages.OUTPUTS), Value: path of the output of frame i.
+        '''
+        file_name = os.path.split(sim["files"][i])[-1]
+
+        # The envmap does not depend on the weather
+        return {o: os.path.join(sim["out_seq_dir"] if o == 'envmap' else sim["out_dir"], o, '{}.png'.format(file_name[:-4]))
+                for o in OUTPUTS}
+
+    def frame_skipped(self, sim, i):
+        paths = self.frame_paths(sim, i)
+        frame_exists = np.any([os.path.exists(paths[o]) for o in self.outputs if o != 'envmap'])
+        if frame_exists:
+            if self.conflict_strategy == "skip":
+                return True
+            elif self.conflict_strategy == "overwrite":
+                pass
+            else:
+                raise NotImplementedError
+
+        return False
+
+    def read_frame(self, sim, i):
+        '''
+        Function to read the inputs of a frame (thread safe, used to prefetch frames).
+        :param sim: Simulation, see prepare_simulation.
+        :param i: Frame index in the sequence.
+        :return: Tuple (bg, depth), or None if depth is missing.
+        '''
+        image_file = sim["files"][i]
+        depth_file = sim["depth_files"][i]
+
+        assert os.path.exists(image_file), "Image file {} does not exist".format(image_file)
+        assert os.path.exists(depth_file), "Depth file {} does not exist".format(depth_file)
+
+        # two copies of bg because one is used for rain drop calculation
+        # and the other is changed after adding each drop
+        bg = np.divide(cv2.imread(image_file), 255.0, dtype=self.precision.image)
+
+        if self.settings["render_scale"] != 1:
+            bg = cv2.resize(bg, (int(bg.shape[1]//self.settings["render_scale"]), int(bg.shape[0]//self.settings["render_scale"])))
+
+        if FOG_ATT == 1:
+            # Depth map is used in weighting the luminance effect of the environment map on a single drop
+            if depth_file.endswith(".png"):
+                depth = cv2.imread(depth_file, cv2.IMREAD_UNCHANGED)
+                if depth is None:
+                    print('Missing/Corrupted depth data (%s)' % depth_file)
+                    return None
+
+                depth = depth.astype(np.float32) / 256.
+            elif depth_file.endswith(".npy"):
+                depth = np.load(depth_file)
+            else:
+                raise Exception("Invalid extension")
+
+            # Apply depth and render scale
+            depthHW = np.array([int((depth.shape[0] * self.settings["depth_scale"]) // self.settings["render_scale"]), int((depth.shape[1] * self.settings["depth_scale"]) // self.settings["render_scale"])])
+            if not np.all(depth.shape[:2] == depthHW):
+                depth = cv2.resize(depth, (depthHW[1], depthHW[0]))
+
+            assert (np.all(depth.shape[:2] <= bg.shape[:2])), "Depth cannot be larger than the image"
+
+            # Strategy to apply if RGB and Depth size mismatch
+            if not np.all(depth.shape[:2] == bg.shape[:2]):
+                # print("\nDepth {} size ({},{}) differs from image ({},{}). Will assume depth is crop centered.".format(image_file, depth.shape[0], depth.shape[1], bg.shape[0], bg.shape[1]))
+                bg = my_utils.crop_center(bg, depth.shape[0], depth.shape[1])
+        else:
+            # In that case, no need for depth, but it's still used down in the code, for more less nothing
+            depth = np.zeros((bg.shape[1], bg.shape[0]), np.float)
+
+        return bg, depth
+
+    def _read_frame_unless_skipped(self, sims, i):
+        return None if np.all([self.frame_skipped(sim, i) for sim in sims]) else self.read_frame(sims[0], i)
+
+    def render_frames(self, sims, f_idx, i, eta=None, inputs=None, writer=None):
+        '''
+        Function to render one frame for several simulations of a sequence (e.g. all intensities with fan-out), the
+        frame inputs being read once and shared, as well as the fog extinction base.
+        :param sims: Simulations of the same sequence, see prepare_simulation.
+        :return: Number of simulations for which the frame was skipped because it was already rendered.
+        '''
+        if np.all([self.frame_skipped(sim, i) for sim in sims]):
+            return len(sims)
+
+        inputs = self.read_frame(sims[0], i) if inputs is None else inputs()
+        fog_base = None if inputs is None else add_attenuation.FogRain.extinction_base(*inputs)
+
+        frames_exist_nb = 0
+        for sim in sims:
+            self.select_simulation(sim, capacity=len(sims))
+            frames_exist_nb += self.render_frame(sim, f_idx, i, eta=eta, inputs=lambda: inputs, writer=writer,
+                                                 fog_base=fog_base)
+
+        return frames_exist_nb
+
+    def render_frame(self, sim, f_idx, i, eta=None, inputs=None, writer=None, fog_base=None):
+        '''
+        Function to render one frame of a loaded simulation (see load_simulation).
+        :param sim: Simulation, see prepare_simulation.
+        :param f_idx: Position of the frame in the frames to render (only used for logs).
+        :param i: Frame index in the sequence.
+        :param eta: Optional function returning the progress message, given frame_t0, drop_idx and drop_num.
+        :param inputs: Optional function returning the frame inputs (see read_frame), e.g. prefetched in background.
+        :param writer: Optional AsyncWriter to save outputs in background.
+        :param fog_base: Optional fog extinction base of the inputs, see FogRain.extinction_base.
+        :return: True if the frame was skipped because it was already rendered.
+        '''
+        sequence = sim["sequence"]
+        files, calib_files = sim["files"], sim["calib_files"]
+        imW, imH = sim["imW"], sim["imH"]
+        FOG, map_generator = self.fog, self.map_generator
+        env_map_input = self.env_type if self.irrad_type == 'garg' else self.env_type + '_' + self.irrad_type
+        sim_frames_num = self.db.frames_count()
+
+        image_file = files[i]
+
+        # Compute frame index (independent of starting frame) to allow deterministic / reproducible rendering
+        f_name_idx, sim_frame_idx = my_utils.sim_frame_index(self.dataset, i, len(files), sim_frames_num)
+
+        # Ensure deterministic behavior
+        np.random.seed(f_name_idx)
+
+        frame_t0 = time.time()
+        file_name = os.path.split(image_file)[-1]
+
+        out_paths = self.frame_paths(sim, i)
+        if self.frame_skipped(sim, i):
+            return True
+
+        _, drops = self.db.frame_drops(sim_frame_idx)
+
+        # TODO adding functions of depth weighting for other dataset
+        if USE_DEPTH_WEIGHTING == 1 and calib_files is not None:
+            # Compute the drop depth map to allow weighting envmap from drop FOV
+            depth_drop_evaluator = DropDepthMap(filename=calib_files[0])
+
+        # flush should happens after a while
+        if self.verbose and eta is not None:
+            sys.stdout.write('\r' + eta(frame_t0) + '                        ')
+
+        inputs = self.read_frame(sim, i) if inputs is None else inputs()
+        if inputs is None:
+            return False
+        bg, depth = inputs
+
+        rainy_bg = FOG.fog_rain_layer(bg, depth, fog_base)
+
+        # rain layer is the image of the rendered rain drops blended with the background
+        rain_layer = None
+        if 'rain_layer' in self.stages:
+            rain_layer = np.zeros((bg.shape[0], bg.shape[1], 4), self.precision.layer)
+
+        # rainy_mask keeps track of the pixels of the background that have already been occupied by rain.
+        # This is used in cases of occluding or partially occluded drops
+        rainy_mask = np.zeros((bg.shape[0], bg.shape[1]), self.precision.mask)
+        rainy_saturation_mask = None
+        if 'saturation' in self.stages:
+            rainy_saturation_mask = np.zeros((bg.shape[0], bg.shape[1], 3), self.precision.mask)
+
+        # Order-independent blending: drops accumulate into a transmittance buffer, resolved once all drops are in
+        buffer = TransmittanceBuffer(bg.shape, self.precision.mask) if self.blend_mode == 'oit' else None
+
+        # Environment map of the frame using (Christopher Cameron, 2005):
+        # http://www.cs.cmu.edu/afs/andrew/scs/cs/15-463/f05/pub/www/projects/fproj/cmcamero/report.pdf
+        self.BGR_env_map, self.env_map_xyY, self.solid_angle_map, self.env_integral = None, None, None, None
+        if 'envmap' not in self.stages:
+            pass
+        elif 'ours' in env_map_input:
+            # print('\nGenerating environment map')
+            self.BGR_env_map = map_generator.generate_map(rainy_bg, self.precision.image)
+        elif 'pano' in env_map_input:
+            # print('\nLoading Environment Pano')
+            self.BGR_env_map = np.divide(cv2.imread(os.path.join('../data', 'panos', file_name)), 255.0, dtype=self.precision.image)
+        else:
+            raise NotImplementedError
+
+        if 'envmap_integral' in self.stages:
+            self.env_map_xyY = my_utils.convert_rgb_to_xyY(self.BGR_env_map[..., ::-1])
+            self.env_map_xyY[np.isnan(self.env_map_xyY)] = 0
+
+            if 'ours' in env_map_input:
+                self.solid_angle_map = map_generator.solid_angles(rainy_bg.shape)
+            else:
+                self.solid_angle_map = solid_angle.get_solid_angles(self.BGR_env_map)
+            self.env_integral = EnvMapIntegral(self.env_map_xyY, self.solid_angle_map)
+
+        # Render only streaks inside the frame, drawing their textures and wind noise and computing their geometry
+        if 'drops' not in self.stages:
+            drops = {k: v[:0] for k, v in drops.items()}
+        drops = prepare_drops(drops, self.db, (imW, imH), self.noise_std, self.noise_scale)
+
+        if USE_DEPTH_WEIGHTING == 1:
+            xyz_coord = depth_drop_evaluator.get_world_points(depth)
+
+        drop_num = len(drops["pid"])
+        assert drop_num <= 2 ** 16, \
+            "Assert that the number of drops doesn't overpass the uint16 rain_mask capacity"
+
+        drop_process_t0 = time.time()
+
+        # Envmap polygons of all drops at once
+        drops_fov_pts = [None] * drop_num
+        if 'envmap_integral' in self.stages:
+            drops_fov_pts = self.fov_comp.compute_fov_plane_points_batch(drops, self.renderer.radius,
+                                                                         self.renderer.fov, 20,
+                                                                         self.BGR_env_map.shape)
+        # Circles of confusion of all drops at once
+        drops_coc = np.abs(self.renderer.compute_circle(np.abs(drops["world_position_start"][:, 2])))
+        self.renderer.defocus_time = 0.
+
+        # Fast path: Gaussian streaks are splatted all at once, and only Big drops are rendered one by one
+        drops_idx = np.arange(drop_num)
+        if self.fast_streaks and self.rendering_strategy is None:
+            gaussian_idx = np.flatnonzero(drops["gaussian"])
+            if len(gaussian_idx) != 0:
+                streaks = {k: v[gaussian_idx] for k, v in drops.items()}
+                splats = self.splatter.fit(streaks["texture_idx"], streaks["sprite_minC"], streaks["sprite_angle"],
+                                           streaks["sprite_flip"], streaks["sprite_width"], streaks["sprite_height"],
+                                           drops_coc[gaussian_idx])
+                rainy_bg, rainy_mask, rainy_saturation_mask = self.renderer.add_streaks_to_image(
+                    splats, streaks, [drops_fov_pts[j] for j in gaussian_idx], rainy_bg, rainy_mask, rainy_saturation_mask,
+                    self.irrad_type, self.env_integral, self.exposure_time, self.opacity_attenuation, buffer=buffer)
+            drops_idx = np.flatnonzero(~drops["gaussian"])
+
+        # Tile mode: batches of drops are prepared concurrently, then composited tile by tile (identical output). The
+        # rain layer, which depends on the drops order, is not computed.
+        if self.tile_threads > 1:
+            if self.compositor is None:
+                self.compositor = TileCompositor(self.tile_threads)
+            for start in range(0, len(drops_idx), TILE_BATCH):
+                batch = drops_idx[start:start + TILE_BATCH]
+                prepared = self.compositor.map(lambda j: self.prepare_drop(bg.shape, drops, j, drops_fov_pts[j], drops_coc[j]), batch)
+                for drop_idx, p in zip(batch, prepared):
+                    if p is None:
+                        print("Trace: rain drop {} in sequence {} in image {} ({})".format(drop_idx, sequence, f_idx, f_name_idx))
+                prepared = [p for p in prepared if p is not None]
+
+                boxes = [(minC[0], minC[1], minC[0] + drop.shape[1], minC[1] + drop.shape[0]) for drop, minC, _ in prepared]
+                if buffer is not None:
+                    self.compositor.composite(lambda k, region: self.renderer.accumulate_drop(
+                        buffer, rainy_mask, rainy_saturation_mask, prepared[k][0], prepared[k][1], *prepared[k][2],
+                        region=region), boxes, bg.shape)
+                else:
+                    self.compositor.composite(lambda k, region: self.renderer.blend_drop(
+                        rainy_bg, rainy_mask, rainy_saturation_mask, prepared[k][0], prepared[k][1], *prepared[k][2],
+                        region=region), boxes, bg.shape)
+
+                # Compute progress
+                drop_idx = batch[-1]
+                avg_drop_time = (time.time() - drop_process_t0) / (drop_idx + 1)
+                if eta is not None:
+                    sys.stdout.write('\r' + eta(frame_t0, drop_idx, drop_num) + '\t\t' + '%.1fms /drop (defocus %.0fms)' % (
+                            1000. * avg_drop_time, 1000. * self.renderer.defocus_time) + '       ')
+            drops_idx = []
+
+        for drop_idx in drops_idx:
+            if buffer is not None:
+                # The rain layer, which depends on the drops order, is not computed
+                prepared = self.prepare_drop(bg.shape, drops, drop_idx, drops_fov_pts[drop_idx], drops_coc[drop_idx])
+                drop = blended_drop = None
+                if prepared is not None:
+                    drop, minC, blending = prepared
+                    self.renderer.accumulate_drop(buffer, rainy_mask, rainy_saturation_mask, drop, minC, *blending)
+            else:
+                # Returns the rainy image, rainy_mask, drop, blended drop and the starting coord of
+                # the drop in image
+                rainy_bg, rainy_mask, rainy_saturation_mask, \
+                drop, blended_drop, minC = self.compute_drop(bg, drops, drop_idx, rainy_bg,
+                                                             rainy_mask, rainy_saturation_mask,
+                                                             drop_fov_pts=drops_fov_pts[drop_idx],
+                                                             coc=drops_coc[drop_idx])
+            if blended_drop is not None and rain_layer is not None:
+                rain_layer = self.renderer.make_rain_layer(drop, blended_drop, rain_layer, rainy_mask, minC)
+            elif drop is None:
+                print("Trace: rain drop {} in sequence {} in image {} ({})".format(drop_idx,
+                                                                                   sequence, f_idx,
+                                                                                   f_name_idx))
+
+            # Compute progress
+            avg_drop_time = (time.time() - drop_process_t0) / (drop_idx + 1)
+            if eta is not None and (self.verbose or drop_idx == drops_idx[0]):
+                sys.stdout.write('\r' + eta(frame_t0, drop_idx, drop_num) + '\t\t' + '%.1fms /drop (defocus %.0fms)' % (
+                        1000. * avg_drop_time, 1000. * self.renderer.defocus_time) + '       ')
+
+        if buffer is not None:
+            buffer.resolve(rainy_bg)
+        drops_time = time.time() - drop_process_t0
+
+        outputs = []
+        if 'rainy_image' in self.outputs:
+            # mean contrast adjusted image
+            rainy_bg_mean = np.mean(rainy_bg, dtype=np.float64)
+            bg_mean = np.mean(bg, dtype=np.float64)
+            difference_mean = rainy_bg_mean - bg_mean
+            rainy_bg_copy = rainy_bg - difference_mean
+            outputs.append(('rainy_image', np.clip(rainy_bg_copy[..., ::-1], 0, 1)))
+        if 'rain_mask' in self.outputs:
+            outputs.append(('rain_mask', rainy_mask))
+        if 'envmap' in self.outputs:
+            outputs.append(('envmap', self.BGR_env_map[..., ::-1]))
+        if 'rain_layer' in self.outputs:
+            # Alpha is 255 on drops pixels
+            outputs.append(('rain_layer', np.concatenate([rain_layer[..., 2::-1], rain_layer[..., 3:] / 255], axis=-1).astype(np.float32)))
+        if 'saturation' in self.outputs:
+            outputs.append(('saturation', np.clip(rainy_saturation_mask[..., ::-1], 0, 1)))
+
+        for output, image in outputs:
+            # Create output directory
+            path = out_paths[output]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if writer is not None:
+                writer.submit(frame_io.imsave, path, image, compression=self.png_compression)
+            else:
+                frame_io.imsave(path, image, compression=self.png_compression)
+
+        # Logged to calibrate the cost model of main_threaded.py (see work_planner.calibrate)
+        if self.log_frames:
+            print("\nFrame {}: {} drops in {:.0f}ms, {:.0f}ms /frame".format(i, drop_num, 1000. * drops_time,
+                                                                            1000. * (time.time() - frame_t0)))
+
+        return False
+
+    def next_job(self, jobs):
+        '''
+        Function to pick the next job to render: the first one whose particles simulations are ready, waiting for one to
+        be if all of them are still simulated (see sim_pipeline).
+        :param jobs: List of (folder_idx, sim_idx, sim_num, group) tuples, in rendering order.
+        '''
+        if self.pipeline is None:
+            return jobs[0]
+
+        pending = [sim["sim_file"] for job in jobs for sim in job[3] if self.pipeline.is_pending(sim["sim_file"])]
+        while True:
+            for job in jobs:
+                if not any(self.pipeline.is_pending(sim["sim_file"]) for sim in job[3]):
+                    for sim in job[3]:
+                        sim["sim_file"] = self.pipeline.resolve(sim["sim_file"])
+                    return job
+
+            print("\nWaiting for particles simulations ({} pending)...".format(len(set(pending))))
+            self.pipeline.wait(pending)
+            pending = [f for f in pending if self.pipeline.is_pending(f)]
 
     def run(self):
         process_t0 = time.time()
 
         folders_num = len(self.images)
 
-        # case for any number of sequences and supported rain intensities
-        for folder_idx, sequence in enumerate(self.sequences):
-            folder_t0 = time.time()
-            print('\nSequence: ' + sequence)
-            sim_num = len(self.particles[sequence])
-            depth_folder = self.depth[sequence]
-
-            for sim_idx, sim_weather in enumerate(self.weather):
-                weather, fallrate = sim_weather["weather"], sim_weather["fallrate"]
-
-                out_seq_dir = os.path.join(self.output_root, sequence)
-                out_dir = os.path.join(out_seq_dir, weather, '{}mm'.format(fallrate))
-                sim_file = self.particles[sequence][sim_idx]
-
-                # Resolve output path
-                path_exists = os.path.exists(out_dir)
-                if path_exists:
-                    if self.conflict_strategy == "skip":
-                        pass
-                    elif self.conflict_strategy == "overwrite":
-                        pass
-                    elif self.conflict_strategy == "rename_folder":
-                        out_dir_, out_shift = out_dir, 0
-                        while os.path.exists(out_dir_ + '_copy%05d' % out_shift):
-                            out_shift += 1
-
-                        out_dir = out_dir_ + '_copy%05d' % out_shift
-                    else:
-                        raise NotImplementedError
-
-                # Create directory
-                os.makedirs(out_dir, exist_ok=True)
-
-                # Default fog-like rain parameters
-                fog_params = {"rain_intensity": fallrate, "focal": self.focal, "f_number": self.f_number, "angle": 90,
-                              "exposure": self.exposure, "camera_gain": self.camera_gain}
-
-                if "nuscenes" in self.dataset:
-                    files = self.images[sequence]
-                    depth_files = self.depth[sequence]
-                    depth_file = depth_files[0]
-                    assert depth_file.endswith(".npy"), "nuscenes processing only works with .npy for depth"
-                    # depth = np.load(depth_file)
-                    if "gan" in self.dataset:
-                        # HARDCODED since these values are not known in nuscenes_gan
-                        imW, imH = (1600, 900)
-                    else:
-                        img = cv2.imread(files[0])
-                        imH, imW = img.shape[0:2]
-                else:
-                    files = natsorted(np.array([os.path.join(self.images[sequence], picture) for picture in my_utils.os_listdir(self.images[sequence])]))
-                    depth_files = natsorted(np.array([os.path.join(depth_folder, depth) for depth in my_utils.os_listdir(depth_folder)]))
-                    im = files[0]
-                    if im.endswith(".png"):
-                        imH, imW = cv2.imread(im).shape[0:2]
-                    elif im.endswith(".npy"):
-                        imH, imW = np.load(im).shape[0:2]
-                    else:
-                        raise Exception("Invalid extension", im)
-                    imH = imH//self.settings["render_scale"]
-                    imW = imW//self.settings["render_scale"]
-
-                if self.camera_gain:
-                    fog_params["camera_gain"] = self.camera_gain
-
-                print('Simulation: rain {}mm/hr'.format(fallrate))
-                # loading StreaksDBManager, RainRenderer, FOVComputation and EnvMapGenerator
-                self.db = DBManager(streaks_path_xml=sim_file, streaks_path=self.texture,
-                                    norm_coeff_path=self.norm_coeff)
-                self.renderer = RainRenderer(focal=self.focal, f_number=self.f_number, focus_plane=6, radius=10, fov=165)
-                self.fov_comp = FovComputation(camera=np.array([0, 0, 0]))
-                map_generator = EnvironmentMapGenerator(self.focal, imW, imH)
+        # Frames are independent (seeded per frame), so they may be rendered by a pool of processes, each worker keeping
+        # its own loaded simulation, renderer and caches
+        pool = None
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self,))
 
-                # loading fog class
-                FOG = add_attenuation.FogRain(**fog_params)
+        # Background simulations start once workers are forked
+        if self.pipeline is not None:
+            self.pipeline.start()
 
-                # loading calib files for frames
-                calib_files = self.calib[sequence]
-
-                # loading streaks from Streaks Database
-                self.db.load_streak_database()
-
-                # creating drops based on the simulator file
-                self.db.load_streaks_from_xml(self.dataset, self.settings, [imW, imH], use_pickle=False, verbose=self.verbose)
-
-                env_map_input = self.env_type if self.irrad_type == 'garg' else self.env_type + '_' + self.irrad_type
-
-                frame_render_dict = list(self.db.streaks_simulator.values())
+        try:
+            # case for any number of sequences and supported rain intensities
+            jobs = []
+            for folder_idx, sequence in enumerate(self.sequences):
+                sims = [self.prepare_simulation(sequence, sim_idx, sim_weather) for sim_idx, sim_weather in enumerate(self.weather)]
+
+                # With fan-out, each frame is read once and rendered for all intensities
+                groups = [sims] if self.fanout else [[sim] for sim in sims]
+                jobs += [(folder_idx, sim_idx, len(groups), group) for sim_idx, group in enumerate(groups)]
+
+            # Jobs are rendered in order, unless their particles are not simulated yet
+            folders_t0 = {}
+            while len(jobs) > 0:
+                job = self.next_job(jobs)
+                jobs.remove(job)
+                folder_idx, sim_idx, sim_num, group = job
+                sequence = group[0]["sequence"]
+                if folder_idx not in folders_t0:
+                    folders_t0[folder_idx] = time.time()
+                    print('\nSequence: ' + sequence)
+                folder_t0 = folders_t0[folder_idx]
+
+                print('Simulation: rain {}mm/hr'.format(','.join(str(sim["fallrate"]) for sim in group)))
+                # Workers load their own renderer, only resolve (and convert if needed) particles here
+                for sim in group:
+                    if pool is None:
+                        self.select_simulation(sim, capacity=len(group))
+                    else:
+                        self.load_simulation(sim, render=False)
 
+                files = group[0]["files"]
                 f_start, f_end, f_step = self.frame_start, self.frame_end, self.frame_step
                 f_end = len(files) if f_end is None else min(f_end, len(files))
                 if self.frames:
@@ -296,185 +724,60 @@ class Generator:
                 sim_t0 = time.time()
                 print("{} images".format(len(idx)))
                 frames_exist_nb = 0
-                for f_idx, i in enumerate(idx):
-                    image_file = files[i]
-                    depth_file = depth_files[i]
-
-                    # Compute frame index (independent of starting frame) to allow deterministic / reproducible rendering
-                    if self.dataset == 'nuscenes':
-                        # It could be useful for other dataset, but, for the moment, lets consign this little gem of a
-                        # code to nuscenes
-                        # If f_end was not supplied, we could see if the number of file is not equal to the number of
-                        # simulated drop... if so, lets remap them
-                        render_ix = np.linspace(0, len(frame_render_dict), len(files), endpoint=False, dtype=int)
-                        f_name_idx = render_ix[i]
-                    else:
-                        f_name_idx = i
-
-                    assert os.path.exists(image_file), "Image file {} does not exist".format(image_file)
-                    assert os.path.exists(depth_file), "Depth file {} does not exist".format(depth_file)
-
-                    # Ensure deterministic behavior
-                    np.random.seed(f_name_idx)
-
-                    frame_t0 = time.time()
-                    frame = frame_render_dict[f_name_idx % len(frame_render_dict)]
-                    file_name = os.path.split(image_file)[-1]
-
-                    out_rainy_path = os.path.join(out_dir, 'rainy_image', '{}.png'.format(file_name[:-4]))
-                    out_rainy_mask_path = os.path.join(out_dir, 'rain_mask', '{}.png'.format(file_name[:-4]))
-                    out_env_path = os.path.join(out_seq_dir, 'envmap', '{}.png'.format(file_name[:-4]))
-
-                    frame_exists = os.path.exists(out_rainy_path) or os.path.exists(out_rainy_mask_path)
-                    if frame_exists:
-                        if self.conflict_strategy == "skip":
-                            frames_exist_nb += 1
-                            continue
-                        elif self.conflict_strategy == "overwrite":
-                            pass
-                        else:
-                            raise NotImplementedError
-
-                    # TODO adding functions of depth weighting for other dataset
-                    if USE_DEPTH_WEIGHTING == 1 and calib_files is not None:
-                        # Compute the drop depth map to allow weighting envmap from drop FOV
-                        depth_drop_evaluator = DropDepthMap(filename=calib_files[0])
-
-                    # flush should happens after a while
-                    if self.verbose:
-                        sys.stdout.write(
-                            '\r' + my_utils.process_eta_str(process_t0, folder_idx, folders_num, folder_t0, sim_idx,
-                                                            sim_num, sim_t0, f_idx,
-                                                            f_num, frame_t0) + '                        ')
-
-                    # two copies of bg because one is used for rain drop calculation
-                    # and the other is changed after adding each drop
-                    bg = cv2.imread(image_file) / 255.0
-
-                    if self.settings["render_scale"] != 1:
-                        bg = cv2.resize(bg, (int(bg.shape[1]//self.settings["render_scale"]), int(bg.shape[0]//self.settings["render_scale"])))
-
-                    if FOG_ATT == 1:
-                        # Depth map is used in weighting the luminance effect of the environment map on a single drop
-                        if depth_file.endswith(".png"):
-                            depth = cv2.imread(depth_file, cv2.IMREAD_UNCHANGED)
-                            if depth is None:
-                                print('Missing/Corrupted depth data (%s)' % depth_file)
-                                continue
-
-                            depth = depth.astype(np.float32) / 256.
-                        elif depth_file.endswith(".npy"):
-                            depth = np.load(depth_file)
-                        else:
-                            raise Exception("Invalid extension")
-
-                        # Apply depth and render scale
-                        depthHW = np.array([int((depth.shape[0] * self.settings["depth_scale"]) // self.settings["render_scale"]), int((depth.shape[1] * self.settings["depth_scale"]) // self.settings["render_scale"])])
-                        if not np.all(depth.shape[:2] == depthHW):
-                            depth = cv2.resize(depth, (depthHW[1], depthHW[0]))
-
-                        assert (np.all(depth.shape[:2] <= bg.shape[:2])), "Depth cannot be larger than the image"
-
-                        # Strategy to apply if RGB and Depth size mismatch
-                        if not np.all(depth.shape[:2] == bg.shape[:2]):
-                            # print("\nDepth {} size ({},{}) differs from image ({},{}). Will assume depth is crop centered.".format(image_file, depth.shape[0], depth.shape[1], bg.shape[0], bg.shape[1]))
-                            bg = my_utils.crop_center(bg, depth.shape[0], depth.shape[1])
-                    else:
-                        # In that case, no need for depth, but it's still used down in the code, for more less nothing
-                        depth = np.zeros((bg.shape[1], bg.shape[0]), np.float)
-
-                    rainy_bg = FOG.fog_rain_layer(bg, depth)
-
-                    # rain layer is the image of the rendered rain drops blended with the background
-                    rain_layer = np.zeros((bg.shape[0], bg.shape[1], 4), np.float64)
-
-                    # rainy_mask keeps track of the pixels of the background that have already been occupied by rain.
-                    # This is used in cases of occluding or partially occluded drops
-                    rainy_mask = np.zeros((bg.shape[0], bg.shape[1]), np.float64)
-                    rainy_saturation_mask = np.zeros((bg.shape[0], bg.shape[1], 3), np.float64)
-
-                    # Environment map of the frame using (Christopher Cameron, 2005):
-                    # http://www.cs.cmu.edu/afs/andrew/scs/cs/15-463/f05/pub/www/projects/fproj/cmcamero/report.pdf
-                    if 'ours' in env_map_input:
-                        # print('\nGenerating environment map')
-                        self.BGR_env_map = map_generator.generate_map(rainy_bg)
-                    elif 'pano' in env_map_input:
-                        # print('\nLoading Environment Pano')
-                        self.BGR_env_map = cv2.imread(os.path.join('../data', 'panos', file_name)) / 255.0
-                    else:
-                        raise NotImplementedError
-
-                    self.env_map_xyY = my_utils.convert_rgb_to_xyY(self.BGR_env_map[..., ::-1])
-                    self.env_map_xyY[np.isnan(self.env_map_xyY)] = 0
-
-                    self.solid_angle_map = solid_angle.get_solid_angles(self.BGR_env_map)
-
-                    # Render only streaks inside the frame
-                    streak_dict = frame.streaks
-                    streak_dict = {keys: values for keys, values in streak_dict.items() if
-                                   1 <= values.max_width < max(imH, imW) and
-                                   1 <= values.length < max(imH, imW) and
-                                   ((0 <= values.image_position_start[0] < imW
-                                     and 0 <= values.image_position_start[1] < imH) or
-                                    (0 <= values.image_position_end[0] < imW
-                                     and 0 <= values.image_position_end[1] < imH))}
-
-                    if USE_DEPTH_WEIGHTING == 1:
-                        xyz_coord = depth_drop_evaluator.get_world_points(depth)
-
-                    assert streak_dict.__len__() <= 2 ** 16, \
-                        "Assert that the number of drops doesn't overpass the uint16 rain_mask capacity"
-
-                    streak_list = list(streak_dict.values())
-                    drop_num = len(streak_list)
-                    drop_process_t0 = time.time()
-                    for drop_idx, drop_dict in enumerate(streak_list):
-                        # Returns the rainy image, rainy_mask, drop, blended drop and the starting coord of
-                        # the drop in image
-                        rainy_bg, rainy_mask, rainy_saturation_mask, \
-                        drop, blended_drop, minC = self.compute_drop(bg, drop_dict, rainy_bg,
-                                                                     rainy_mask, rainy_saturation_mask)
-                        if blended_drop is not None:
-                            rain_layer = self.renderer.make_rain_layer(drop, blended_drop, rain_layer, rainy_mask, minC)
-                        else:
-                            print("Trace: rain drop {} in sequence {} in image {} ({})".format(drop_idx,
-                                                                                               sequence, f_idx,
-                                                                                               f_name_idx))
-
-                        # Compute progress
-                        avg_drop_time = (time.time() - drop_process_t0) / (drop_idx + 1)
-                        if self.verbose or drop_idx == 0:
-                            sys.stdout.write(
-                                '\r' + my_utils.process_eta_str(process_t0, folder_idx, folders_num, folder_t0, sim_idx,
-                                                                sim_num,
-                                                                sim_t0, f_idx, f_num, frame_t0, drop_idx,
-                                                                drop_num) + '\t\t' + '%.1fms /drop' % (
-                                        1000. * avg_drop_time) + '       ')
-
-                    # Create all output directories
-                    os.makedirs(os.path.dirname(out_rainy_path), exist_ok=True)
-                    os.makedirs(os.path.dirname(out_rainy_mask_path), exist_ok=True)
-                    if self.save_envmap:
-                        os.makedirs(os.path.dirname(out_env_path), exist_ok=True)
-
-                    # mean contrast adjusted image
-                    rainy_bg_mean = np.mean(rainy_bg)
-                    bg_mean = np.mean(bg)
-                    difference_mean = rainy_bg_mean - bg_mean
-                    rainy_bg_copy = rainy_bg - difference_mean
-
-                    plt.imsave(out_rainy_path, np.clip(rainy_bg_copy[..., ::-1], 0, 1))
-                    plt.imsave(out_rainy_mask_path, rainy_mask)
-                    if self.save_envmap:
-                        plt.imsave(out_env_path, self.BGR_env_map[..., ::-1])
-                if frames_exist_nb > 0:
-                    print("Skipped {}/{} already existing renderings".format(frames_exist_nb, len(idx)))
-
-            print("\n\nEnd of the simulation")
-
-
-
-
-
-
+                if pool is None and self.io_threads > 0:
+                    # Decode upcoming frames and encode rendered ones in background threads
+                    with ThreadPoolExecutor(self.io_threads) as reader, \
+                            frame_io.AsyncWriter(self.io_threads, max_pending=2 * self.io_threads) as writer:
+                        read = functools.partial(self._read_frame_unless_skipped, group)
+                        prefetched = frame_io.prefetch(reader, read, idx, depth=self.io_threads)
+                        for f_idx, (i, inputs) in enumerate(zip(idx, prefetched)):
+                            eta = functools.partial(my_utils.process_eta_str, process_t0, folder_idx,
+                                                    folders_num, folder_t0, sim_idx, sim_num, sim_t0, f_idx, f_num)
+                            frames_exist_nb += self.render_frames(group, f_idx, i, eta=eta, inputs=inputs.result,
+                                                                  writer=writer)
+                elif pool is None:
+                    for f_idx, i in enumerate(idx):
+                        eta = functools.partial(my_utils.process_eta_str, process_t0, folder_idx, folders_num,
+                                                folder_t0, sim_idx, sim_num, sim_t0, f_idx, f_num)
+                        frames_exist_nb += self.render_frames(group, f_idx, i, eta=eta)
+                else:
+                    tasks = [(group, f_idx, i) for f_idx, i in enumerate(idx)]
+                    for f_done, frame_exists in enumerate(pool.imap_unordered(_render_frame_worker, tasks)):
+                        frames_exist_nb += frame_exists
+                        sys.stdout.write('\r' + my_utils.process_eta_str(process_t0, folder_idx, folders_num,
+                                                                         folder_t0, sim_idx, sim_num, sim_t0,
+                                                                         f_done, f_num) + '        ')
 
+                if frames_exist_nb > 0:
+                    print("Skipped {}/{} already existing renderings".format(frames_exist_nb, len(idx) * len(group)))
+
+                # Last job of the sequence
+                if not any(job[0] == folder_idx for job in jobs):
+                    print("\n\nEnd of the simulation")
+                    if self.verbose and self.sprites is not None:
+                        print(self.sprites)
+                        print(asset_cache.assets)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if self.pipeline is not None:
+                self.pipeline.shutdown()
+            if self.compositor is not None:
+                self.compositor.shutdown()
+                self.compositor = None
+
+
+# Process pool workers, each one holds its own Generator (hence loaded simulation, streaks database and caches)
+_worker = None
+
+
+def _init_worker(generator):
+    global _worker
+    _worker = generator
+    _worker.verbose = False
+
+
+def _render_frame_worker(task):
+    sims, f_idx, i = task
+    return _worker.render_frames(sims, f_idx, i)
@@ -0,0 +1,64 @@
+import os
+import shutil
+
+import numpy as np
+
+'''
+Cache of arrays which only depend on the camera geometry (e.g. environment map remapping, solid angles).
+
+A bundle is a dictionary of arrays identified by a name encoding all its parameters. It is computed once, saved as
+plain .npy files in cache_dir/name and memory-mapped afterwards, so that it is shared by all frames, runs and
+processes rendering with the same camera.
+'''
+
+_bundles = {}
+
+
+def _save(path, bundle):
+    # Write in a process specific folder then rename, so that concurrent processes never see partial bundles
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for k, v in bundle.items():
+        np.save(os.path.join(tmp_path, k + '.npy'), v)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Already saved by another process
+        shutil.rmtree(tmp_path)
+
+
+def load(cache_dir, name, build):
+    '''
+    Function to load a geometry bundle, building it if needed.
+    :param cache_dir: Cache root folder, None to only keep the bundle in memory.
+    :param name: Name of the bundle, must be unique for a given set of parameters.
+    :param build: Function returning the bundle (dictionary of arrays), called if it is not cached.
+    :return: Bundle dictionary, arrays are read-only memory maps if persisted.
+    '''
+    key = (cache_dir, name)
+    if key in _bundles:
+        return _bundles[key]
+
+    bundle = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, name)
+        if not os.path.exists(path):
+            bundle = build()
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                _save(path, bundle)
+            except OSError as e:
+                print("WARNING: Could not save geometry cache {} ({})".format(path, e))
+
+        if os.path.exists(path):
+            bundle = {os.path.splitext(f)[0]: np.load(os.path.join(path, f), mmap_mode='r')
+                      for f in os.listdir(path) if f.endswith('.npy')}
+
+    if bundle is None:
+        bundle = build()
+
+    _bundles[key] = bundle
+    return bundle
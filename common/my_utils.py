@@ -56,7 +56,8 @@ def convert_rgb_to_xyY(array):
     mat = np.array([[0.49000, 0.31000, 0.20000], [0.17697, 0.81240, 0.01063], [0.00000, 0.01000, 0.99000]])
     factor = 0.17697
 
-    XYZ = np.dot(array, mat)/factor
+    # float32 images stay in float32 (see precision)
+    XYZ = np.dot(array, mat.astype(array.dtype if array.dtype == np.float32 else np.float64))/factor
     X = XYZ[..., 0]
     Y = XYZ[..., 1]
     Z = XYZ[..., 2]
@@ -169,5 +170,22 @@ def hash_(obj, path=False, isclose=-1):
     else:
         return hl.md5(obj).hexdigest()
 
-def particles_path(path, weather):
+# Return the index of frame i (independent of starting frame, to seed its random draws) and its simulation frame index.
+def sim_frame_index(dataset, i, files_num, sim_frames_num=None):
+    if dataset == 'nuscenes' and sim_frames_num is not None:
+        # It could be useful for other dataset, but, for the moment, lets consign this little gem of a
+        # code to nuscenes
+        # If f_end was not supplied, we could see if the number of file is not equal to the number of
+        # simulated drop... if so, lets remap them
+        render_ix = np.linspace(0, sim_frames_num, files_num, endpoint=False, dtype=int)
+        f_name_idx = render_ix[i]
+    else:
+        f_name_idx = i
+
+    # Simulation frames are unlimited if sim_frames_num is None (sampler)
+    return f_name_idx, f_name_idx if sim_frames_num is None else f_name_idx % sim_frames_num
+
+def particles_path(path, weather, backend="ahl"):
+    if backend == "numpy":
+        return os.path.join(path, weather["weather"], "{}mm".format(weather["fallrate"]), 'numpy_camera0.npsim')
     return os.path.join(path, weather["weather"], "{}mm".format(weather["fallrate"]),  '*_camera0.xml')
\ No newline at end of file
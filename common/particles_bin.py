@@ -0,0 +1,212 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+'''
+Columnar (structure-of-arrays) storage of particles simulations.
+
+A simulation is stored in a folder of plain .npy files, with one row per drop for all frames concatenated:
+    pid                 (N,)    int64
+    wp1, wp2            (N, 3)  float64     world positions (start, end)
+    wd1, wd2            (N,)    float64     world diameters (start, end)
+    ip1, ip2            (N, 2)  float64     image positions (start, end)
+    iw1, iw2            (N,)    float64     image diameters (start, end)
+    frame_offsets       (F+1,)  int64       drops of frame i are rows [frame_offsets[i], frame_offsets[i+1])
+    frame_attrs         (F, 4)  int64       id, t, d, rs of each frame
+    meta.json                               format version and source file signature
+
+Values are the raw simulator outputs (no render scale, axis flip, etc.), so one binary file serves any rendering.
+Arrays are memory-mapped when loading: fetching a frame only touches its own rows, and several processes rendering
+the same simulation share a single copy through the page cache.
+'''
+
+FORMAT_VERSION = 1
+COLUMNS = {"pid": (np.int64, ()), "wp1": (np.float64, (3,)), "wp2": (np.float64, (3,)),
+           "wd1": (np.float64, ()), "wd2": (np.float64, ()), "ip1": (np.float64, (2,)), "ip2": (np.float64, (2,)),
+           "iw1": (np.float64, ()), "iw2": (np.float64, ())}
+FRAME_ATTRS = ["id", "t", "d", "rs"]
+
+
+def bin_path(xml_path):
+    return os.path.splitext(xml_path)[0] + '.npsim'
+
+
+def source_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def is_up_to_date(path, source_path=None):
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+
+    meta = _read_meta(path)
+    if meta.get("version") != FORMAT_VERSION:
+        return False
+
+    if source_path is not None and meta.get("source") != source_signature(source_path):
+        return False
+
+    return is_complete(path)
+
+
+def is_complete(path):
+    '''
+    Function to check that all the columns of a simulation hold the drops indexed by its frame offsets (e.g. files
+    truncated by an interrupted copy are not).
+    '''
+    try:
+        drops = np.load(os.path.join(path, 'frame_offsets.npy'))[-1]
+        for k, (dtype, shape) in COLUMNS.items():
+            column = np.load(os.path.join(path, k + '.npy'), mmap_mode='r')
+            if column.shape != (drops,) + shape or column.dtype != dtype:
+                return False
+    except (OSError, ValueError, IndexError):
+        return False
+
+    return True
+
+
+def _read_meta(path):
+    with open(os.path.join(path, 'meta.json'), 'r') as fp:
+        return json.load(fp)
+
+
+def _write_npy(path, raw_path, dtype, shape):
+    # Prepend the .npy header to raw data written incrementally
+    with open(path, 'wb') as fp:
+        np.lib.format.write_array_header_1_0(fp, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                  'fortran_order': False, 'shape': shape})
+        with open(raw_path, 'rb') as raw:
+            shutil.copyfileobj(raw, fp, 1 << 20)
+    os.remove(raw_path)
+
+
+def write(path, frames, meta=None):
+    '''
+    Function to write a simulation in the columnar format.
+    Frames are appended to disk one at a time, so memory stays bounded by the size of one frame.
+    :param path: Output folder.
+    :param frames: Iterable of (frame_attrs, columns), frame_attrs being (id, t, d, rs) and columns a dictionary of
+                   arrays with COLUMNS keys.
+    :param meta: Optional dictionary stored along in meta.json (e.g. "source": source_signature(xml_path), to detect
+                 out-dated conversions). It is only read once all frames are consumed, so frames may fill it.
+    :return: Number of frames and drops written.
+    '''
+    # Write in a process specific folder, simulations may be converted by several processes at once
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    t0 = time.time()
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    raw = {k: open(os.path.join(tmp_path, k + '.raw'), 'wb') for k in COLUMNS}
+    offsets, attrs = [0], []
+    try:
+        for frame_attrs, columns in frames:
+            for k, (dtype, shape) in COLUMNS.items():
+                np.ascontiguousarray(columns[k], dtype=dtype).reshape((-1,) + shape).tofile(raw[k])
+            offsets.append(offsets[-1] + len(columns["pid"]))
+            attrs.append(frame_attrs)
+    finally:
+        for fp in raw.values():
+            fp.close()
+
+    for k, (dtype, shape) in COLUMNS.items():
+        _write_npy(os.path.join(tmp_path, k + '.npy'), os.path.join(tmp_path, k + '.raw'), dtype, (offsets[-1],) + shape)
+    np.save(os.path.join(tmp_path, 'frame_offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_path, 'frame_attrs.npy'), np.array(attrs, dtype=np.int64).reshape((-1, len(FRAME_ATTRS))))
+
+    meta = {**(meta if meta is not None else {}), "version": FORMAT_VERSION, "frames": len(attrs), "drops": offsets[-1]}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+
+    # Swap folders only once complete, so that an interrupted conversion never looks valid
+    meta_path = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_path) and os.stat(meta_path).st_mtime >= t0 and is_up_to_date(path):
+        # Written by another process while converting, which may be reading it already
+        shutil.rmtree(tmp_path)
+        return len(attrs), offsets[-1]
+
+    # An out-dated (or incomplete) version is moved aside first: processes reading it keep their memory maps
+    old_path = '{}.old{}'.format(path, os.getpid())
+    try:
+        os.rename(path, old_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Written by another process meanwhile
+        shutil.rmtree(tmp_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+    return len(attrs), offsets[-1]
+
+
+class ParticlesSim:
+    def __init__(self, columns, frame_offsets, frame_attrs, meta=None):
+        '''
+        Simulation stored as columns, with O(1) access to any frame.
+        :param columns: Dictionary of arrays (possibly memory-mapped) of all drops.
+        :param frame_offsets: Array of F+1 offsets in the columns.
+        :param frame_attrs: Array (F, 4) of id, t, d, rs of each frame.
+        :param meta: Meta data dictionary.
+        '''
+        self.columns = columns
+        self.frame_offsets = frame_offsets
+        self.frame_attrs = frame_attrs
+        self.meta = meta if meta is not None else {}
+
+    def __repr__(self):
+        return "ParticlesSim({} frames, {} drops)".format(len(self), self.frame_offsets[-1])
+
+    def __len__(self):
+        return len(self.frame_attrs)
+
+    @staticmethod
+    def open(path, mmap=True):
+        meta = _read_meta(path)
+        mmap_mode = 'r' if mmap else None
+        columns = {k: np.load(os.path.join(path, k + '.npy'), mmap_mode=mmap_mode) for k in COLUMNS}
+        frame_offsets = np.load(os.path.join(path, 'frame_offsets.npy'))
+        frame_attrs = np.load(os.path.join(path, 'frame_attrs.npy'))
+        for k, (_, shape) in COLUMNS.items():
+            if columns[k].shape != (frame_offsets[-1],) + shape:
+                raise ValueError("Column {} of {} holds {} drops instead of {}, the simulation must be converted again".format(
+                    k, path, len(columns[k]), frame_offsets[-1]))
+
+        return ParticlesSim(columns, frame_offsets, frame_attrs, meta)
+
+    @staticmethod
+    def from_frames(frames):
+        # In-memory equivalent of write() + open()
+        offsets, attrs, chunks = [0], [], {k: [] for k in COLUMNS}
+        for frame_attrs, columns in frames:
+            for k, (dtype, shape) in COLUMNS.items():
+                chunks[k].append(np.asarray(columns[k], dtype=dtype).reshape((-1,) + shape))
+            offsets.append(offsets[-1] + len(columns["pid"]))
+            attrs.append(frame_attrs)
+
+        columns = {k: np.concatenate(chunks[k]) if len(chunks[k]) else np.zeros((0,) + shape, dtype)
+                   for k, (dtype, shape) in COLUMNS.items()}
+        return ParticlesSim(columns, np.array(offsets, dtype=np.int64),
+                            np.array(attrs, dtype=np.int64).reshape((-1, len(FRAME_ATTRS))))
+
+    def frame_columns(self, idx):
+        '''
+        Function to fetch one frame, without reading the other ones.
+        :param idx: Frame index (position in the simulation, not frame id).
+        :return: Tuple (frame_attrs, columns), columns being copied in memory.
+        '''
+        start, end = self.frame_offsets[idx], self.frame_offsets[idx + 1]
+        columns = {k: np.array(v[start:end]) for k, v in self.columns.items()}
+        return dict(zip(FRAME_ATTRS, self.frame_attrs[idx].tolist())), columns
+
+    def streaks_counts(self):
+        return np.diff(self.frame_offsets)
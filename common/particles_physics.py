@@ -0,0 +1,228 @@
+import numpy as np
+
+'''
+Vectorized rain particles simulation, a pure NumPy alternative to the AHLSimulation binary.
+
+Drops are simulated in the camera frame (x right, y up, z backward, as the simulator outputs), each drop living in a
+box covering the part of the camera frustum where it is visible (i.e. where its image diameter is at least one pixel).
+Boxes are periodic: a drop leaving its box re-enters on the opposite side as a new drop (new pid, other coordinates
+resampled), so that drops density stays uniform without any warm-up. Drops fall at terminal velocity along the world
+vertical and move towards the camera when it moves.
+
+Physical models:
+    Drop size distribution      Marshall & Palmer (1948): N(D) = N0 exp(-4.1 R^-0.21 D), N0 = 8000 m^-3 mm^-1
+    Terminal velocity           Atlas et al. (1973): v(D) = 9.65 - 10.3 exp(-0.6 D) m/s, D in mm
+
+Frames are output as (frame_attrs, columns) in the particles_bin format, with the same conventions as the simulator
+XML files: world positions in meters (camera frame), world diameters in mm, image positions in pixels (origin at the
+bottom left) and image diameters in pixels.
+'''
+
+MP_N0 = 8000.  # Marshall-Palmer intercept (m^-3 mm^-1)
+DROP_DIAMETER_MAX = 6.  # Larger drops break up (mm)
+NEAR_PLANE = 0.2  # Drops closer to the camera are not simulated (m)
+MIN_IMAGE_DIAMETER = 1.  # Drops smaller in image are not output, the renderer ignores them anyway (px)
+
+
+def mp_slope(fallrate):
+    '''
+    Slope of the Marshall-Palmer drop size distribution.
+    :param fallrate: Rain fall rate (mm/hr).
+    :return: Lambda (mm^-1).
+    '''
+    return 4.1 * fallrate ** -0.21
+
+
+def terminal_velocity(diameter):
+    '''
+    Terminal velocity of rain drops (Atlas et al. 1973).
+    :param diameter: Drop diameters (mm).
+    :return: Velocities (m/s).
+    '''
+    return np.maximum(9.65 - 10.3 * np.exp(-0.6 * diameter), 0.)
+
+
+def camera_rotation(pos, lookat, up):
+    '''
+    Rotation from world to camera frame (x right, y up, z backward).
+    '''
+    forward = np.asarray(lookat, dtype=float) - np.asarray(pos, dtype=float)
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, up)
+    right /= np.linalg.norm(right)
+    return np.stack([right, np.cross(right, forward), -forward])
+
+
+def focal_pixels(settings, focal=None):
+    '''
+    Focal length in image pixels.
+    :param settings: Simulation settings (cam_* keys, see db._settings_defaults).
+    :param focal: Focal length (mm), defaults to settings["cam_focal"].
+    '''
+    focal = settings["cam_focal"] if focal is None else focal
+    return focal / (settings["cam_CCD_pixsize"] * 1e-3) * settings["cam_WH"][0] / settings["cam_CCD_WH"][0]
+
+
+def frame_steps(settings):
+    '''
+    Function to expand the simulation settings into per frame camera and rain parameters.
+    In "steps" mode, the ith value of each sim_steps list applies from frame i onwards.
+    :return: Dictionary of arrays (frames,): cam_motion (km/h), cam_exposure (ms), cam_focal (mm), rain_fallrate (mm/hr).
+    '''
+    defaults = {"cam_motion": 0., "cam_exposure": settings["cam_exposure"], "cam_focal": settings["cam_focal"],
+                "rain_fallrate": settings["rain_fallrate"]}
+
+    if settings["sim_mode"] == "steps":
+        steps = settings["sim_steps"]
+        assert type(steps) == dict and len(steps.keys()) != 0, "[ERROR]: sim_steps must be provided and be a non-empty dictionary."
+        assert np.all([k in defaults for k in steps]), "[ERROR]: supported sim_steps are {}".format(list(defaults.keys()))
+        frames = max([len(v) for v in steps.values()]) + 1  # Last step lasts one more frame, as with AHLSimulation
+    else:
+        assert settings["sim_mode"] == "normal"
+        steps = {}
+        frames = int(round(settings["sim_duration"] * settings["cam_hz"]))
+
+    values = {}
+    for k, default in defaults.items():
+        v = np.full(frames, default, dtype=float)
+        if k in steps and len(steps[k]) != 0:
+            v[:len(steps[k])] = steps[k]
+            v[len(steps[k]):] = steps[k][-1]
+        values[k] = v
+
+    return values
+
+
+class RainSimulator:
+    def __init__(self, settings, fallrate, seed=0):
+        '''
+        Rain particles simulator.
+        :param settings: Simulation settings (cam_* and sim_* keys, see db._settings_defaults).
+        :param fallrate: Rain fall rate (mm/hr), may be overridden per frame by "rain_fallrate" steps.
+        :param seed: Seed of the random generator.
+        '''
+        self.settings = settings
+        self.rng = np.random.RandomState(seed)
+        self.steps = frame_steps({**settings, "rain_fallrate": fallrate})
+        self.frames = len(self.steps["cam_exposure"])
+        self.W, self.H = settings["cam_WH"]
+        self.R = camera_rotation(settings["cam_pos"], settings["cam_lookat"], settings["cam_up"])
+        self.gravity = self.R @ np.array([0., -1., 0.])
+
+        # Boxes are sized for the extreme focals, and extended by the largest displacement during exposure so that
+        # drops entering the frustum while the shutter is open are simulated
+        focals = focal_pixels(settings, self.steps["cam_focal"])
+        self.f_far, self.f_wide = focals.max(), focals.min()
+        speed_max = terminal_velocity(DROP_DIAMETER_MAX) + self.steps["cam_motion"].max() / 3.6
+        self.margin = speed_max * self.steps["cam_exposure"].max() * 1e-3
+
+        self.next_pid = 0
+        self.fallrate = None
+
+    def __repr__(self):
+        return "RainSimulator({} frames, {}x{})".format(self.frames, self.W, self.H)
+
+    def boxes(self, diameter):
+        '''
+        Simulation boxes of drops (camera frame), covering the frustum up to the depth where they become sub-pixel.
+        :return: Arrays lo and hi (N, 3).
+        '''
+        far = np.maximum(self.f_far * diameter * 1e-3 / MIN_IMAGE_DIAMETER, NEAR_PLANE) + self.margin
+        half_w = far * (self.W / 2.) / self.f_wide + self.margin
+        half_h = far * (self.H / 2.) / self.f_wide + self.margin
+        lo = np.stack([-half_w, -half_h, -far], axis=1)
+        hi = np.stack([half_w, half_h, np.full_like(far, -NEAR_PLANE + self.margin)], axis=1)
+        return lo, hi
+
+    def spawn(self, fallrate):
+        '''
+        Function to (re)generate the whole drops population for a given fall rate.
+        Diameters are drawn from the Marshall-Palmer distribution weighted by the volume of their box, hence drops
+        density is N(D) everywhere in the visible frustum.
+        '''
+        self.fallrate = fallrate
+        if fallrate <= 0:
+            self.diameter = np.zeros(0)
+        else:
+            d = np.linspace(NEAR_PLANE * MIN_IMAGE_DIAMETER / self.f_far * 1e3, DROP_DIAMETER_MAX, 2048)
+            lo, hi = self.boxes(d)
+            density = MP_N0 * np.exp(-mp_slope(fallrate) * d) * np.prod(hi - lo, axis=1)
+            cdf = np.concatenate([[0.], np.cumsum((density[1:] + density[:-1]) / 2. * np.diff(d))])
+            count = self.rng.poisson(cdf[-1])
+            self.diameter = np.interp(self.rng.uniform(0., cdf[-1], count), cdf, d)
+
+        self.lo, self.hi = self.boxes(self.diameter)
+        self.position = self.lo + self.rng.uniform(size=self.lo.shape) * (self.hi - self.lo)
+        self.pid = self.next_pid + np.arange(len(self.diameter), dtype=np.int64)
+        self.next_pid += len(self.diameter)
+
+    def velocity(self, cam_motion):
+        # Drops fall along the world vertical, and move backward when the camera moves forward
+        v = terminal_velocity(self.diameter)[:, None] * self.gravity
+        v[:, 2] += cam_motion / 3.6
+        return v
+
+    def advance(self, dt, cam_motion):
+        '''
+        Function to move drops of dt seconds, wrapping them in their box.
+        '''
+        size = self.hi - self.lo
+        position = self.position + self.velocity(cam_motion) * dt
+        wrapped = (position < self.lo) | (position >= self.hi)
+        position = self.lo + np.mod(position - self.lo, size)
+
+        # Re-entering drops are new drops, coordinates along which they did not leave are resampled
+        renew = wrapped.any(axis=1)
+        resample = renew[:, None] & ~wrapped
+        position[resample] = (self.lo + self.rng.uniform(size=size.shape) * size)[resample]
+        self.pid[renew] = self.next_pid + np.arange(np.count_nonzero(renew), dtype=np.int64)
+        self.next_pid += np.count_nonzero(renew)
+        self.position = position
+
+    def project(self, position, f_px):
+        depth = -position[:, 2]
+        image = np.stack([self.W / 2. + f_px * position[:, 0] / depth, self.H / 2. + f_px * position[:, 1] / depth], axis=1)
+        return image, f_px * self.diameter * 1e-3 / depth
+
+    def frame(self, idx):
+        '''
+        Function to simulate the next frame.
+        :param idx: Frame index, frames must be simulated in order.
+        :return: Tuple (frame_attrs, columns) as expected by particles_bin.write.
+        '''
+        if self.steps["rain_fallrate"][idx] != self.fallrate:
+            self.spawn(self.steps["rain_fallrate"][idx])
+        elif idx > 0:
+            self.advance(1. / self.settings["cam_hz"], self.steps["cam_motion"][idx - 1])
+
+        return self.capture(idx)
+
+    def capture(self, idx):
+        '''
+        Function to capture the current drops seen by the camera while the shutter is open.
+        :param idx: Frame index, selects the camera parameters.
+        :return: Tuple (frame_attrs, columns) as expected by particles_bin.write.
+        '''
+        cam_hz = self.settings["cam_hz"]
+        exposure = self.steps["cam_exposure"][idx]
+        f_px = focal_pixels(self.settings, self.steps["cam_focal"][idx])
+        wp1 = self.position
+        wp2 = self.position + self.velocity(self.steps["cam_motion"][idx]) * exposure * 1e-3
+        ip1, iw1 = self.project(wp1, f_px)
+        ip2, iw2 = self.project(wp2, f_px)
+
+        # Keep drops in front of the camera, large enough and overlapping the image
+        radius = np.maximum(iw1, iw2) / 2.
+        visible = (-wp1[:, 2] > NEAR_PLANE) & (-wp2[:, 2] > NEAR_PLANE) & (radius * 2 >= MIN_IMAGE_DIAMETER)
+        visible &= (np.maximum(ip1[:, 0], ip2[:, 0]) + radius >= 0) & (np.minimum(ip1[:, 0], ip2[:, 0]) - radius < self.W)
+        visible &= (np.maximum(ip1[:, 1], ip2[:, 1]) + radius >= 0) & (np.minimum(ip1[:, 1], ip2[:, 1]) - radius < self.H)
+
+        columns = {"pid": self.pid[visible], "wp1": wp1[visible], "wp2": wp2[visible],
+                   "wd1": self.diameter[visible], "wd2": self.diameter[visible],
+                   "ip1": ip1[visible], "ip2": ip2[visible], "iw1": iw1[visible], "iw2": iw2[visible]}
+        attrs = (idx + 1, int(round(exposure)), int(round(idx * 1000. / cam_hz)), int(np.count_nonzero(visible)))
+        return attrs, columns
+
+    def __iter__(self):
+        for idx in range(self.frames):
+            yield self.frame(idx)
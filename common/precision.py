@@ -0,0 +1,21 @@
+import collections
+
+import numpy as np
+
+'''
+Precision policy of the rendering (--precision), i.e. the types of the image sized buffers of a frame.
+
+"float64" is the reference precision. "float32" halves the memory (and bandwidth) of the images, masks and envmap,
+while the values which accumulate rounding errors over the frame or the sequence (envmap prefix sums, drops colours and
+simulation) remain in float64. The rain layer, which is saved (--outputs rain_layer), is in float32 as well.
+'''
+
+Precision = collections.namedtuple('Precision', ['image', 'mask', 'layer'])
+
+PRECISIONS = {
+    # image: background, rainy image, environment map and its xyY conversion, fog
+    # mask: rain mask, saturation mask, transmittance buffers (--blend_mode oit)
+    # layer: rain layer
+    'float64': Precision(image=np.float64, mask=np.float64, layer=np.float64),
+    'float32': Precision(image=np.float32, mask=np.float32, layer=np.float32),
+}
@@ -0,0 +1,106 @@
+import collections
+import concurrent.futures
+
+import glob2
+
+from common import my_utils, particles_bin
+
+'''
+Pipeline of the particles simulations and the rendering (--pipeline).
+
+Each simulation (particles path and weather) is a job, run in a background thread: the simulation itself when missing,
+then the conversion of the XML output to the binary format (see particles_bin) when needed. Jobs are identified by the
+pattern of their particles file (see my_utils.particles_path), which stands for the particles file of the sequences
+until the job is done, so that the generator renders any simulation whose particles are ready while others are still
+being simulated, instead of waiting for all the simulations to complete beforehand.
+'''
+
+
+class SimulationPipeline:
+    def __init__(self, max_threads=None):
+        '''
+        :param max_threads: Maximum number of jobs run concurrently, default is bound by the CPU cores and the available
+        memory (see tools/particles_simulation.py).
+        '''
+        self.max_threads = max_threads
+        self.pending = collections.OrderedDict()
+        self.jobs = {}
+        self.executor = None
+
+    def __repr__(self):
+        done = sum(job.done() for job in self.jobs.values())
+        return "SimulationPipeline({} jobs, {} done)".format(len(self.pending) + len(self.jobs), done)
+
+    def __len__(self):
+        return len(self.pending) + len(self.jobs)
+
+    def submit(self, path, options, weather, simulate=True):
+        '''
+        Function to schedule a simulation job, run once start is called.
+        :param path: Simulation path (see my_utils.particles_path).
+        :param options: Simulation options (see db.sim).
+        :param weather: Weather, e.g. {"weather": "rain", "fallrate": 25}.
+        :param simulate: Whether to run the simulation, otherwise only convert its existing output.
+        :return: Pattern of the particles file, which identifies the job.
+        '''
+        pattern = my_utils.particles_path(path, weather, options["sim_backend"])
+        if pattern not in self.pending and pattern not in self.jobs:
+            self.pending[pattern] = (len(self), path, options, weather, simulate)
+
+        return pattern
+
+    def start(self):
+        '''
+        Function to start the scheduled jobs. It is called once processes are forked, if any (see Generator.run).
+        '''
+        if len(self.pending) == 0:
+            return
+        if self.executor is None:
+            import tools.particles_simulation
+            max_threads = tools.particles_simulation.max_concurrency() if self.max_threads is None else self.max_threads
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_threads)
+
+        while len(self.pending) > 0:
+            pattern, job = self.pending.popitem(last=False)
+            self.jobs[pattern] = self.executor.submit(self._run, pattern, *job)
+
+    def _run(self, pattern, id, path, options, weather, simulate):
+        if simulate:
+            import tools.particles_simulation
+            tools.particles_simulation.create_simulation(id, path, options, weather, redo=True).run()
+
+        files = glob2.glob(pattern)
+        assert len(files) != 0, "Simulation did not output any particles file {}".format(pattern)
+        sim_file = files[0]
+
+        # Simulations of the numpy backend are already in the binary format
+        bin_path = particles_bin.bin_path(sim_file)
+        if options["sim_backend"] != "numpy" and not particles_bin.is_up_to_date(bin_path, sim_file):
+            from common.bad_weather import DBManager
+            DBManager(streaks_path_xml=sim_file).convert_xml(bin_path, verbose=False)
+
+        return sim_file
+
+    def is_pending(self, sim_file):
+        '''
+        :return: Whether sim_file is the pattern of a job not done yet.
+        '''
+        return sim_file in self.pending or (sim_file in self.jobs and not self.jobs[sim_file].done())
+
+    def resolve(self, sim_file):
+        '''
+        Function to resolve the particles file of a done job (raising its error if it failed).
+        :return: Particles file, sim_file itself if it is not a job.
+        '''
+        return self.jobs[sim_file].result() if sim_file in self.jobs else sim_file
+
+    def wait(self, sim_files):
+        '''
+        Function to wait until one of the jobs of sim_files is done.
+        '''
+        jobs = [self.jobs[f] for f in sim_files if f in self.jobs]
+        concurrent.futures.wait(jobs, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
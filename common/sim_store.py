@@ -0,0 +1,103 @@
+import json
+import os
+
+from common import my_utils
+
+'''
+Content-addressed store of particles simulations (--sim_store).
+
+A simulation only depends on its effective options (database settings merged with the sequence specific ones, see
+db.sim) and on the weather, so it is stored in root/<hash of options and weather>, with the usual layout
+(see my_utils.particles_path). Options which are not passed to the simulators (RENDER_OPTIONS, e.g. the sequence
+specific settings table of the database) are left out of the hash. Sequences sharing their settings, within or across datasets, point to the same stored
+simulation which is run once. The hash is computed with my_utils.hash_.
+
+root/index.json maps each dataset/sequence and weather to its simulation hash, and root/<hash>/options.json keeps the
+options of the simulation, which allows to find out which sequences a simulation is used by (e.g. before deleting it).
+'''
+
+INDEX_FILE = 'index.json'
+OPTIONS_FILE = 'options.json'
+
+# Options only used at rendering, or to resolve the sequence specific options, which do not change the simulation
+RENDER_OPTIONS = ['sequences', 'render_scale', 'depth_scale', 'cam_gain', 'cam_f_number', 'cam_focus_plane']
+
+
+def weather_name(weather):
+    return '{}/{}mm'.format(weather["weather"], weather["fallrate"])
+
+
+def simulation_options(options):
+    '''
+    :return: Options which change the simulation, i.e. without RENDER_OPTIONS.
+    '''
+    return {k: v for k, v in options.items() if k not in RENDER_OPTIONS}
+
+
+class SimStore:
+    def __init__(self, root):
+        '''
+        :param root: Store folder, e.g. data/particles/store.
+        '''
+        self.root = root
+        self.entries = {}
+
+    def __repr__(self):
+        return "SimStore({}, {} simulations)".format(self.root, len(set(h for e in self.entries.values() for h in e.values())))
+
+    @staticmethod
+    def key(options, weather):
+        '''
+        Function to compute the hash identifying a simulation.
+        :param options: Effective simulation options (see db.sim).
+        :param weather: Weather, e.g. {"weather": "rain", "fallrate": 25}.
+        '''
+        weather = {"weather": str(weather["weather"]), "fallrate": float(weather["fallrate"])}
+        return my_utils.hash_({"options": simulation_options(options), "weather": weather})[0]
+
+    def path(self, options, weather):
+        '''
+        :return: Path of the simulation, to use as the simulation path (see my_utils.particles_path).
+        '''
+        return os.path.join(self.root, self.key(options, weather))
+
+    def register(self, name, options, weather):
+        '''
+        Function to record that a sequence uses a simulation (see save).
+        :param name: Name of the sequence, e.g. dataset/sequence.
+        :return: Path of the simulation, see path.
+        '''
+        key = self.key(options, weather)
+        self.entries.setdefault(name, {})[weather_name(weather)] = key
+
+        path = os.path.join(self.root, key)
+        options_path = os.path.join(path, OPTIONS_FILE)
+        if not os.path.exists(options_path):
+            os.makedirs(path, exist_ok=True)
+            with open(options_path, 'w') as fp:
+                json.dump({"options": simulation_options(options), "weather": weather}, fp, indent=2, sort_keys=True, default=str)
+
+        return path
+
+    def save(self):
+        '''
+        Function to merge the registered sequences into the index file. The index is re-read and atomically replaced,
+        so that processes sharing the store (e.g. main_threaded.py) only lose entries when saving at the same time.
+        '''
+        index_path = os.path.join(self.root, INDEX_FILE)
+        index = {}
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as fp:
+                    index = json.load(fp)
+            except ValueError:
+                print("WARNING: Simulation store index {} is corrupted, it will be rebuilt".format(index_path))
+
+        for name, weathers in self.entries.items():
+            index.setdefault(name, {}).update(weathers)
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = '{}.tmp{}'.format(index_path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(index, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, index_path)
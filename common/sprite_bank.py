@@ -0,0 +1,81 @@
+import collections
+import threading
+
+import cv2
+import imutils
+import numpy as np
+
+'''
+Cache of streak sprites, i.e. database textures rotated, flipped and resized to the streak geometry.
+
+Streaks angles and sizes cluster heavily (image positions are integers), so most drops reuse a sprite computed for a
+previous drop, frame or image. Sprites are keyed by (texture index, angle, width, height, flip), the angle being
+optionally quantized to trade accuracy for hit rate, and evicted in least recently used order beyond a memory budget.
+The bank may be shared by threads, sprites being built outside of the lock.
+'''
+
+
+class SpriteBank:
+    def __init__(self, textures, angle_step=0., max_bytes=256 << 20):
+        '''
+        :param textures: Streak textures as stored in the database, single channel float32 in [0, 1].
+        :param angle_step: Angle quantization step (degrees), 0 to use exact angles (identical to uncached sprites).
+        :param max_bytes: Memory budget of cached sprites.
+        '''
+        self.textures = textures
+        self.angle_step = angle_step
+        self.max_bytes = max_bytes
+        self.sprites = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "SpriteBank({} sprites, {:.1f}MB, hit rate {:.1%})".format(len(self.sprites), self.bytes / 2 ** 20, self.hit_rate())
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def quantize(self, angle):
+        return angle if self.angle_step <= 0 else round(angle / self.angle_step) * self.angle_step
+
+    def build(self, idx, angle, width, height, flip):
+        drop = imutils.rotate_bound(self.textures[idx], angle)
+        drop = cv2.flip(drop, 0) if flip else drop
+        drop = cv2.resize(drop, (width, height), interpolation=cv2.INTER_AREA)
+        return np.clip(drop, 0, 1).astype(np.float32)
+
+    def get(self, idx, angle, width, height, flip):
+        '''
+        Function to fetch a sprite, computing it if not cached.
+        :param idx: Texture index.
+        :param angle: Rotation angle (degrees).
+        :param width: Sprite width (pixels).
+        :param height: Sprite height (pixels).
+        :param flip: Whether the rotated texture is flipped vertically.
+        :return: Read-only single channel sprite (height, width) float32, in [0, 1].
+        '''
+        key = (idx, self.quantize(angle), width, height, bool(flip))
+        with self.lock:
+            sprite = self.sprites.get(key)
+            if sprite is not None:
+                self.hits += 1
+                self.sprites.move_to_end(key)
+                return sprite
+            self.misses += 1
+
+        sprite = self.build(*key)
+        sprite.setflags(write=False)
+        with self.lock:
+            if sprite.nbytes <= self.max_bytes and key not in self.sprites:
+                self.sprites[key] = sprite
+                self.bytes += sprite.nbytes
+                while self.bytes > self.max_bytes:
+                    _, evicted = self.sprites.popitem(last=False)
+                    self.bytes -= evicted.nbytes
+
+        return sprite
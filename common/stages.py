@@ -0,0 +1,44 @@
+'''
+Stages of the rendering of a frame, and the outputs which can be saved (--outputs).
+
+Each stage lists the stages it needs. Only the stages needed by the selected outputs are computed, e.g. the environment
+map is not generated when drops are not coloured from it (rendering strategies 'white' and 'naive_db') and not saved,
+and the rain layer and saturation mask are only accumulated when saved.
+'''
+
+OUTPUTS = ['rainy_image', 'rain_mask', 'envmap', 'rain_layer', 'saturation']
+DEFAULT_OUTPUTS = ['rainy_image', 'rain_mask']
+
+STAGES = {
+    # Stages
+    'fog': [],  # Fog-like rain, the image drops are blended into
+    'envmap': ['fog'],  # Environment map, generated from the fogged image
+    'envmap_integral': ['envmap'],  # xyY environment map, solid angles and prefix sums, to colour drops
+    'drops': ['fog', 'envmap_integral'],  # Drops blending (and rain mask)
+    # Outputs (envmap is both)
+    'rainy_image': ['drops'],
+    'rain_mask': ['drops'],
+    'rain_layer': ['drops'],  # Blended drops over a transparent background
+    'saturation': ['drops'],  # Sum of the drops colours
+}
+
+
+def required_stages(outputs, rendering_strategy=None):
+    '''
+    Function to resolve the stages needed to compute outputs.
+    :param outputs: Selected outputs (see OUTPUTS).
+    :param rendering_strategy: Rendering strategy, drops are only coloured from the environment map by default (None).
+    :return: Set of the stages to compute, outputs included.
+    '''
+    needs = dict(STAGES)
+    if rendering_strategy is not None:
+        needs['drops'] = ['fog']
+
+    stages, todo = set(), list(outputs)
+    while todo:
+        stage = todo.pop()
+        if stage not in stages:
+            stages.add(stage)
+            todo.extend(needs[stage])
+
+    return stages
@@ -0,0 +1,54 @@
+import numpy as np
+
+from common import my_utils
+from common.particles_bin import FRAME_ATTRS
+from common.particles_physics import RainSimulator
+
+'''
+Direct sampling of the drops visible during one exposure, without time-stepped simulation.
+
+Each frame is drawn independently from the fall rate size distribution and the camera frustum, with a random generator
+seeded by the frame index and a seed derived from the dataset, sequence and weather (see sequence_seed): frames are
+reproducible, unlimited and differ across frames, sequences and intensities, which suits still images datasets.
+Frames are served with the same interface as particles_bin.ParticlesSim.
+'''
+
+
+def sequence_seed(dataset, sequence, weather, fallrate):
+    '''
+    Function to derive the seed of the frames of a sequence, so that sequences sharing the same settings (e.g. all
+    Cityscapes cities) are not rendered with the same drops.
+    '''
+    return int(my_utils.hash_([dataset, sequence, weather, fallrate], path=True)[0][:7], 16) + 1
+
+
+class StreakSampler:
+    def __init__(self, settings, fallrate, seed=0):
+        '''
+        Per frame streaks sampler.
+        :param settings: Simulation settings (cam_* and sim_* keys, see db._settings_defaults).
+        :param fallrate: Rain fall rate (mm/hr).
+        :param seed: Seed shared by all frames, the frame index is appended to it.
+        '''
+        self.sim = RainSimulator(settings, fallrate, seed)
+        self.seed = seed
+        self.meta = {"simulator": "sampler", "seed": seed}
+
+    def __repr__(self):
+        return "StreakSampler(seed {}, {}x{})".format(self.seed, self.sim.W, self.sim.H)
+
+    def frame_columns(self, idx):
+        '''
+        Function to sample one frame.
+        :param idx: Frame index, any non negative integer. In "steps" mode, camera and rain parameters cycle over steps.
+        :return: Tuple (frame_attrs, columns).
+        '''
+        step = idx % self.sim.frames
+        self.sim.rng = np.random.RandomState([self.seed, idx])
+        self.sim.next_pid = 0
+        self.sim.spawn(self.sim.steps["rain_fallrate"][step])
+        attrs, columns = self.sim.capture(step)
+
+        # Frame timing follows the index, as if frames were consecutive
+        attrs = (idx + 1, attrs[1], int(round(idx * 1000. / self.sim.settings["cam_hz"])), attrs[3])
+        return dict(zip(FRAME_ATTRS, attrs)), columns
@@ -0,0 +1,138 @@
+import numpy as np
+from scipy.special import erf
+
+'''
+Vectorized rendering of Gaussian streaks (Small and Medium drops), an approximation of their per drop sprites.
+
+A sprite is the database texture rotated, flipped and resized to the streak box (see SpriteBank.build), then blurred
+by defocus. Its footprint is modeled analytically as an anti-aliased line segment: a box along the streak axis
+convolved with a gaussian, times a gaussian cross-profile. The segment length, profile widths, centroid and mass are
+fitted to the moments of the sprite, derived from the moments of the texture. All streaks of a frame are then
+rasterized at once, as (pixel, streak, alpha) samples which are accumulated with scatter-adds.
+'''
+
+SPLAT_EXTENT = 3.5  # Splats are evaluated up to SPLAT_EXTENT sigmas away from the segment
+SPLAT_CHUNK = 1 << 21  # Pixel samples evaluated at once (memory bound)
+
+
+def texture_moments(textures):
+    '''
+    Function to compute the moments of the streaks textures, in texture pixels (x, y).
+    :param textures: Single channel textures.
+    :return: Tuple (mass (T,), centroid (T, 2), covariance (T, 2, 2)).
+    '''
+    mass, centroid, cov = [], [], []
+    for t in textures:
+        t = t.astype(np.float64)
+        y, x = np.mgrid[:t.shape[0], :t.shape[1]]
+        m = t.sum()
+        c = np.array([(t * x).sum(), (t * y).sum()]) / m
+        dx, dy = x - c[0], y - c[1]
+        mass.append(m)
+        centroid.append(c)
+        cov.append(np.array([[(t * dx * dx).sum(), (t * dx * dy).sum()], [(t * dx * dy).sum(), (t * dy * dy).sum()]]) / m)
+
+    return np.array(mass), np.array(centroid), np.array(cov)
+
+
+class StreakSplatter:
+    def __init__(self, textures):
+        '''
+        :param textures: Streak textures as stored in the database (see SpriteBank).
+        '''
+        self.shape = np.array([t.shape[:2] for t in textures])  # (height, width)
+        self.mass, self.centroid, self.cov = texture_moments(textures)
+
+    def __repr__(self):
+        return "StreakSplatter({} textures)".format(len(self.mass))
+
+    def fit(self, texture_idx, minC, angle, flip, width, height, coc):
+        '''
+        Function to fit splats to the sprites of streaks.
+        :param texture_idx: Texture index of each streak (N,).
+        :param minC: Top left corner of the sprites (N, 2).
+        :param angle: Rotation angles (degrees).
+        :param flip: Whether the rotated textures are flipped vertically.
+        :param width: Sprites width (pixels).
+        :param height: Sprites height (pixels).
+        :param coc: Circles of confusion (pixels), defocus blurs sprites by coc vertically and coc / 2 horizontally.
+        :return: Dictionary of arrays: mass, center (N, 2), axis (N, 2) unit, length, sigma_along, sigma_across.
+        '''
+        texture_idx = np.asarray(texture_idx, dtype=np.int64)
+        th, tw = self.shape[texture_idx, 0], self.shape[texture_idx, 1]
+
+        # imutils.rotate_bound (clockwise rotation around the texture center, into the rotated bounds)
+        a = np.deg2rad(angle)
+        cos, sin = np.cos(a), np.sin(a)
+        nW = np.floor(th * np.abs(sin) + tw * np.abs(cos))
+        nH = np.floor(th * np.abs(cos) + tw * np.abs(sin))
+        R = np.stack([np.stack([cos, -sin], axis=1), np.stack([sin, cos], axis=1)], axis=1)
+        p = self.centroid[texture_idx] - np.stack([tw // 2, th // 2], axis=1)
+        center = np.einsum('nij,nj->ni', R, p) + np.stack([nW / 2, nH / 2], axis=1)
+        cov = np.einsum('nij,njk,nlk->nil', R, self.cov[texture_idx], R)
+
+        # Vertical flip
+        center[:, 1] = np.where(flip, nH - 1 - center[:, 1], center[:, 1])
+        cov[:, 0, 1] = cov[:, 1, 0] = np.where(flip, -cov[:, 0, 1], cov[:, 0, 1])
+
+        # Resize to the sprite box (area interpolation preserves the mean intensity)
+        scale = np.stack([width / nW, height / nH], axis=1)
+        center = (center + 0.5) * scale - 0.5
+        cov = cov * scale[:, :, None] * scale[:, None, :]
+        mass = self.mass[texture_idx] * (width * height) / (nW * nH)
+
+        # Segment along the major axis, the texture being uniform along the streak
+        half_trace = (cov[:, 0, 0] + cov[:, 1, 1]) / 2
+        delta = np.sqrt(((cov[:, 0, 0] - cov[:, 1, 1]) / 2) ** 2 + cov[:, 0, 1] ** 2)
+        major, minor = half_trace + delta, np.maximum(half_trace - delta, 0)
+        phi = np.arctan2(2 * cov[:, 0, 1], cov[:, 0, 0] - cov[:, 1, 1]) / 2
+        axis = np.stack([np.cos(phi), np.sin(phi)], axis=1)
+
+        # Pixel area filter and defocus widen the profiles
+        var_x, var_y = (np.asarray(coc) / 2) ** 2 + 1. / 12, np.asarray(coc) ** 2 + 1. / 12
+        return {"mass": mass,
+                "center": np.asarray(minC) + center,
+                "axis": axis,
+                "length": np.sqrt(12 * major),
+                "sigma_along": np.sqrt(axis[:, 0] ** 2 * var_x + axis[:, 1] ** 2 * var_y),
+                "sigma_across": np.sqrt(minor + axis[:, 1] ** 2 * var_x + axis[:, 0] ** 2 * var_y)}
+
+    @staticmethod
+    def rasterize(splats, shape, chunk=SPLAT_CHUNK):
+        '''
+        Function to evaluate splats over the image pixels they cover.
+        :param splats: Splats, see fit.
+        :param shape: Image shape (H, W).
+        :param chunk: Maximum number of pixel samples per yield.
+        :return: Generator of tuples (flat pixel index, splat index, alpha), alpha in [0, 1].
+        '''
+        H, W = shape[:2]
+        center, axis, length = splats["center"], splats["axis"], splats["length"]
+        sigma_a, sigma_c = splats["sigma_along"], splats["sigma_across"]
+        amplitude = splats["mass"] / (length * np.sqrt(2 * np.pi) * sigma_c)
+
+        # Bounding boxes, clipped to the image
+        extent = np.abs(axis) * (length / 2 + SPLAT_EXTENT * sigma_a)[:, None] + \
+                 np.abs(axis[:, ::-1]) * (SPLAT_EXTENT * sigma_c)[:, None]
+        lo = np.maximum(np.ceil(center - extent), 0).astype(np.int64)
+        hi = np.minimum(np.floor(center + extent), [W - 1, H - 1]).astype(np.int64)
+        nx, ny = np.maximum(hi[:, 0] - lo[:, 0] + 1, 0), np.maximum(hi[:, 1] - lo[:, 1] + 1, 0)
+        count = nx * ny
+
+        # Chunks of splats with at most chunk samples (a larger splat makes its own chunk)
+        ends = np.cumsum(count)
+        start = 0
+        while start < len(count):
+            stop = max(np.searchsorted(ends, (ends[start - 1] if start > 0 else 0) + chunk, side='right'), start + 1)
+            idx = np.repeat(np.arange(start, stop), count[start:stop])
+            local = np.arange(len(idx)) - np.repeat(ends[start:stop] - count[start:stop], count[start:stop])
+            x, y = lo[idx, 0] + local % nx[idx], lo[idx, 1] + local // nx[idx]
+
+            dx, dy = x - center[idx, 0], y - center[idx, 1]
+            t = dx * axis[idx, 0] + dy * axis[idx, 1]
+            r = dy * axis[idx, 0] - dx * axis[idx, 1]
+            half, s = length[idx] / 2, np.sqrt(2) * sigma_a[idx]
+            alpha = amplitude[idx] * np.exp(-0.5 * (r / sigma_c[idx]) ** 2) * 0.5 * (erf((t + half) / s) - erf((t - half) / s))
+
+            yield y * W + x, idx, np.minimum(alpha, 1.)
+            start = stop
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+'''
+Intra-frame parallel compositing of drops.
+
+Drops are binned by the screen tiles their bounding boxes (defocus included) cover, and tiles are composited
+concurrently by a thread pool, each thread only writing the pixels of its tile. Within a tile, drops are blended in
+the frame drop order, and blending is per pixel, so the result is identical to sequential compositing whatever the
+number of threads. Blending relies on NumPy kernels which release the GIL on large enough arrays, hence this mostly
+pays off for large frames and drops (e.g. full resolution images with strong defocus).
+'''
+
+TILE_SIZE = 128  # Tiles width and height (pixels)
+TILE_BATCH = 256  # Drops prepared and composited at once, which bounds the memory of prepared drops
+
+
+class TileCompositor:
+    def __init__(self, threads, tile_size=TILE_SIZE):
+        '''
+        :param threads: Number of threads.
+        :param tile_size: Tiles width and height (pixels).
+        '''
+        self.threads = threads
+        self.tile_size = tile_size
+        self.pool = ThreadPoolExecutor(threads)
+
+    def __repr__(self):
+        return "TileCompositor({} threads, {}px tiles)".format(self.threads, self.tile_size)
+
+    def map(self, fn, *iterables):
+        # Ordered results, as the built-in map
+        return list(self.pool.map(fn, *iterables))
+
+    def bin(self, boxes, shape):
+        '''
+        Function to bin drops by tiles.
+        :param boxes: Drops bounding boxes (N, 4) as (x0, y0, x1, y1), x1 and y1 excluded.
+        :param shape: Image shape (H, W).
+        :return: Dictionary, Key: tile region (x0, y0, x1, y1), Value: indices of the drops covering it, in order.
+        '''
+        H, W = shape[:2]
+        boxes = np.asarray(boxes, dtype=np.int64).reshape((-1, 4))
+        lo = np.maximum(boxes[:, :2], 0) // self.tile_size
+        hi = (np.minimum(boxes[:, 2:], [W, H]) - 1) // self.tile_size
+
+        tiles = {}
+        for i in np.flatnonzero(np.all(hi >= lo, axis=1)):
+            for ty in range(lo[i, 1], hi[i, 1] + 1):
+                for tx in range(lo[i, 0], hi[i, 0] + 1):
+                    tiles.setdefault((tx, ty), []).append(i)
+
+        s = self.tile_size
+        return {(tx * s, ty * s, min((tx + 1) * s, W), min((ty + 1) * s, H)): idx for (tx, ty), idx in sorted(tiles.items())}
+
+    def composite(self, blend, boxes, shape):
+        '''
+        Function to composite drops, tile by tile in parallel.
+        :param blend: Function blending one drop in a region, called as blend(drop index, region).
+        :param boxes: Drops bounding boxes (N, 4), see bin.
+        :param shape: Image shape (H, W).
+        '''
+        def composite_tile(item):
+            region, idx = item
+            for i in idx:
+                blend(i, region)
+
+        # Exceptions are raised here
+        self.map(composite_tile, self.bin(boxes, shape).items())
+
+    def shutdown(self):
+        self.pool.shutdown()
@@ -0,0 +1,71 @@
+import numpy as np
+
+'''
+Order-independent blending of drops (--blend_mode oit).
+
+Sequential blending applies, drop after drop, bg = clip((1 - alpha * occlusion) * bg + alpha * radiance), which
+depends on the drops order. Here, drops accumulate their log-transmittance log(1 - alpha * occlusion) and their
+radiance alpha * radiance into separate buffers, with additions only, and the image is resolved once per frame:
+bg = clip(bg * exp(sum of log-transmittances) + sum of radiances). Drops may then be blended in any order, in batches
+or in parallel (up to float rounding). Compared to sequential blending, the radiance of a drop is not attenuated by the
+drops blended after it, and clipping happens once: both only matter where drops overlap.
+'''
+
+MIN_TRANSMITTANCE = 1e-12  # Avoids log(0) for fully opaque pixels
+
+
+class TransmittanceBuffer:
+    def __init__(self, shape, dtype=np.float64):
+        '''
+        :param shape: Image shape (H, W).
+        :param dtype: Type of the buffers (see precision).
+        '''
+        H, W = shape[:2]
+        self.log_transmittance = np.zeros((H, W), dtype=dtype)
+        self.radiance = np.zeros((H, W, 3), dtype=dtype)
+        self.touched = np.zeros((H, W), dtype=bool)
+
+    def __repr__(self):
+        return "TransmittanceBuffer({}x{}, {} pixels touched)".format(self.touched.shape[1], self.touched.shape[0],
+                                                                      np.count_nonzero(self.touched))
+
+    def add(self, alpha, minC, occlusion, radiance):
+        '''
+        Function to accumulate a drop.
+        :param alpha: Drop alpha (h, w), inside the image.
+        :param minC: Top left corner (x, y) of the drop in the image.
+        :param occlusion: Occlusion of the background by a fully opaque drop pixel (tau_one / exposure_time).
+        :param radiance: Radiance of a fully opaque drop pixel (3,), i.e. drop colour * tau_one / tau_zero.
+        '''
+        region = (slice(minC[1], minC[1] + alpha.shape[0]), slice(minC[0], minC[0] + alpha.shape[1]))
+        self.log_transmittance[region] += np.log(np.maximum(1. - alpha * occlusion, MIN_TRANSMITTANCE))
+        self.radiance[region] += np.expand_dims(alpha, axis=-1) * np.asarray(radiance, dtype=self.radiance.dtype)
+        self.touched[region] |= alpha > 0
+
+    def add_samples(self, pix, alpha, occlusion, radiance):
+        '''
+        Function to accumulate pixel samples of drops (e.g. splats, see streak_splat).
+        :param pix: Flat pixel indices (N,).
+        :param alpha: Alpha of the samples (N,).
+        :param occlusion: Occlusion of the samples drops (N,), see add.
+        :param radiance: Radiance of the samples drops (N, 3), see add.
+        '''
+        size = self.touched.size
+        log_transmittance, radiance_ = self.log_transmittance.reshape(-1), self.radiance.reshape((-1, 3))  # Views
+        log_transmittance += np.bincount(pix, np.log(np.maximum(1. - alpha * occlusion, MIN_TRANSMITTANCE)), minlength=size)
+        for c in range(3):
+            radiance_[:, c] += np.bincount(pix, alpha * radiance[:, c], minlength=size)
+        self.touched.reshape(-1)[pix[alpha > 0]] = True
+
+    def resolve(self, rainy_bg):
+        '''
+        Function to blend the accumulated drops into the image (in place), and reset the buffers.
+        :return: rainy_bg
+        '''
+        t = self.touched
+        rainy_bg[t] = np.clip(rainy_bg[t] * np.exp(self.log_transmittance[t])[:, None] + self.radiance[t], 0, 1)
+
+        self.log_transmittance[:] = 0.
+        self.radiance[:] = 0.
+        self.touched[:] = False
+        return rainy_bg
@@ -0,0 +1,214 @@
+import argparse
+import collections
+import glob
+import heapq
+import os
+import re
+
+import numpy as np
+
+from common import db, frame_io, my_utils, particles_bin
+from common.bad_weather import DBManager
+from common.drop_preprocessing import select, visible
+from common.sim_store import SimStore
+
+'''
+Cost model and scheduling of rendering work units (see main_threaded.py).
+
+The rendering time of a frame is modelled as ms_per_frame (reading, fog, environment map, saving) plus ms_per_drop for
+each drop rendered, weighted by the drop size: a share (SIZE_SHARE) of the drop time is proportional to the area of its
+streak, relative to the mean area. The drops rendered are those of the simulation frame mapped to the frame, as the
+generator does (see my_utils.sim_frame_index), which are visible in the image (see drop_preprocessing.visible), hence
+the cost reflects both the fall rate and the simulation frame chosen. When the simulation or the images are not
+available (not simulated yet, not converted, or sampled at rendering), drops are assumed to be proportional to the fall
+rate.
+
+ms_per_drop and ms_per_frame are fitted on the frames reported by main.py (--log_frames, which main_threaded.py sets)
+in the logs of previous runs. Frames are cut in contiguous units of balanced cost, which are scheduled longest first
+(LPT) to predict the makespan.
+'''
+
+MS_PER_DROP = 5.  # Rendering time of a drop of mean size
+MS_PER_FRAME = 300.  # Rendering time of a frame without drops
+SIZE_SHARE = 0.5  # Share of the drop rendering time proportional to the streak area
+DROPS_PER_MM = 10.  # Drops per frame and mm/hr, when no simulation is available to estimate it
+ESTIMATE_FRAMES = 100  # Frames the costs are estimated on, when the frames rendered are not known
+
+Unit = collections.namedtuple('Unit', ['intensity', 'sequences', 'frames', 'cost'])
+
+
+def calibrate(log_paths, ms_per_drop=MS_PER_DROP, ms_per_frame=MS_PER_FRAME):
+    '''
+    Function to calibrate the cost model from the drops and rendering time of each frame reported by main.py in logs.
+    :param log_paths: Log files, e.g. automate_log_*.txt of main_threaded.py.
+    :return: Tuple (ms_per_drop, ms_per_frame) fitted by least squares, the defaults if frames do not vary in drops.
+    '''
+    drops, times = [], []
+    for log_path in log_paths:
+        with open(log_path, 'r', errors='replace') as fp:
+            for drops_num, frame_ms in re.findall(r'Frame [0-9]+: ([0-9]+) drops in [0-9.]+ms, ([0-9.]+)ms /frame', fp.read()):
+                drops.append(float(drops_num))
+                times.append(float(frame_ms))
+
+    drops, times = np.array(drops), np.array(times)
+    if len(np.unique(drops)) < 2:
+        return ms_per_drop, ms_per_frame
+
+    slope, intercept = np.polyfit(drops, times, 1)
+    if slope <= 0:
+        return ms_per_drop, ms_per_frame
+    if intercept < 0:
+        # Fit through the origin, the rendering time of a frame cannot be negative
+        return float(np.sum(drops * times) / np.sum(drops ** 2)), 0.
+
+    return float(slope), float(intercept)
+
+
+def sequences_images(dataset, dataset_root, depth_root, settings):
+    '''
+    Function to resolve the images of the sequences, as main.py does.
+    :param dataset_root: Path to database root (main.py --dataset_root).
+    :param depth_root: Path to depths (main.py --depth).
+    :return: Dict of the images of each sequence (see frame_io.sequence_images), empty if they cannot be resolved.
+    '''
+    dataset_name = dataset if "_gan" not in dataset else dataset[:-4]
+    params = argparse.Namespace(dataset=dataset, dataset_root=os.path.join(dataset_root, dataset_name),
+                                images_root=os.path.join(dataset_root, dataset_name),
+                                depth=depth_root, depth_root=os.path.join(depth_root, dataset_name), calib=None)
+    try:
+        params = db.resolve_paths(dataset, params)
+    except (AssertionError, OSError):
+        return {}
+
+    images = {}
+    for sequence in params.sequences:
+        try:
+            images[sequence] = frame_io.sequence_images(dataset, params.images[sequence], settings)
+        except (IndexError, AttributeError, OSError):
+            continue  # Missing or empty images folder, the sequence is skipped by main.py
+
+    return images
+
+
+def open_simulation(dataset, sequence, particles_root, weather, image_shape_WH, sim_store=False):
+    '''
+    Function to open the particles simulation of a sequence, as resolved by main.py.
+    :param image_shape_WH: Image size at rendering.
+    :return: DBManager with the particles loaded, None if they are not available in the binary format.
+    '''
+    sim = db.sim(dataset, sequence, os.path.join(particles_root, dataset))
+    backend = sim["options"]["sim_backend"]
+    if backend == "sampler":
+        return None
+
+    path = SimStore(os.path.join(particles_root, 'store')).path(sim["options"], weather) if sim_store else sim["path"]
+    files = glob.glob(my_utils.particles_path(path, weather, backend))
+    if len(files) == 0:
+        return None
+
+    bin_path = files[0] if backend == "numpy" else particles_bin.bin_path(files[0])
+    if not particles_bin.is_up_to_date(bin_path, None if backend == "numpy" else files[0]):
+        return None
+
+    sim_db = DBManager(streaks_path_xml=bin_path)
+    sim_db.load_particles(dataset, db.settings(dataset), image_shape_WH, verbose=False)
+    return sim_db
+
+
+def frame_drops(sim_db, dataset, frames, files_num):
+    '''
+    Function to measure the drops rendered for frames, i.e. the visible drops of the simulation frame they are mapped to.
+    :param sim_db: DBManager with the particles loaded (see open_simulation).
+    :param files_num: Number of images of the sequence, frames beyond are not rendered.
+    :return: Arrays of the number of drops, and of the sum of their streak areas (pixels^2), per frame.
+    '''
+    counts, areas = np.zeros(len(frames)), np.zeros(len(frames))
+    measured = {}
+    for idx, i in enumerate(frames):
+        if i >= files_num:
+            continue
+        _, sim_frame_idx = my_utils.sim_frame_index(dataset, i, files_num, sim_db.frames_count())
+        if sim_frame_idx not in measured:
+            _, drops = sim_db.frame_drops(sim_frame_idx)
+            drops = select(drops, visible(drops, sim_db.particles_settings[2]))
+            measured[sim_frame_idx] = (len(drops["pid"]), np.sum((drops["length"] + drops["max_width"]) * drops["max_width"]))
+        counts[idx], areas[idx] = measured[sim_frame_idx]
+
+    return counts, areas
+
+
+class CostModel:
+    def __init__(self, ms_per_drop=MS_PER_DROP, ms_per_frame=MS_PER_FRAME):
+        self.ms_per_drop = ms_per_drop
+        self.ms_per_frame = ms_per_frame
+        self.drops = {}
+
+    def __repr__(self):
+        return "CostModel({:.1f}ms /drop, {:.0f}ms /frame, {} simulations)".format(
+            self.ms_per_drop, self.ms_per_frame, sum(d is not None for _, _, d in self.drops.values()))
+
+    def add(self, sequence, intensity, frames, sim_db=None, dataset=None, files_num=None):
+        '''
+        Function to measure the drops of frames of a sequence and intensity.
+        :param sim_db: DBManager with the particles loaded (see open_simulation), None if not available.
+        :param files_num: Number of images of the sequence, None if not known.
+        '''
+        drops = None if sim_db is None else frame_drops(sim_db, dataset, frames, files_num)
+        self.drops[(sequence, intensity)] = (frames, files_num, drops)
+
+    def costs(self, sequence, intensity):
+        '''
+        :return: Frames of sequence and intensity, and their estimated rendering time (ms).
+        '''
+        measured = [(rendered(f, n), d, i) for (_, i), (f, n, d) in self.drops.items() if d is not None]
+        drops_num = sum(d[0].sum() for _, d, _ in measured)
+        mean_area = sum(d[1].sum() for _, d, _ in measured) / drops_num if drops_num > 0 else 1.
+        density = drops_num / sum(r.sum() * i for r, _, i in measured) if drops_num > 0 else DROPS_PER_MM
+
+        frames, files_num, drops = self.drops[(sequence, intensity)]
+        if drops is None:
+            counts = np.full(len(frames), density * intensity)
+            areas = counts * mean_area
+        else:
+            counts, areas = drops
+
+        weights = (1. - SIZE_SHARE) * counts + SIZE_SHARE * areas / mean_area
+        return frames, (self.ms_per_frame + self.ms_per_drop * weights) * rendered(frames, files_num)
+
+
+def rendered(frames, files_num):
+    '''
+    :return: Mask of the frames rendered, i.e. within the images of the sequence if their number is known.
+    '''
+    return np.ones(len(frames), dtype=bool) if files_num is None else np.asarray(frames) < files_num
+
+
+def cut(frames, costs, target):
+    '''
+    Function to cut frames in contiguous chunks of about target cost.
+    :return: List of (frames, cost) chunks.
+    '''
+    chunks, start, acc = [], 0, 0.
+    for idx, cost in enumerate(costs):
+        acc += cost
+        if acc >= target or idx == len(costs) - 1:
+            chunks.append((frames[start:idx + 1], acc))
+            start, acc = idx + 1, 0.
+
+    return chunks
+
+
+def schedule(units, workers):
+    '''
+    Function to order units longest first (LPT) and predict when they run on workers.
+    :return: Units ordered, their predicted (start, end) times (ms), and the predicted makespan (ms).
+    '''
+    units = sorted(units, key=lambda u: -u.cost)
+    free_at = [0.] * workers
+    times = []
+    for unit in units:
+        start = heapq.heappop(free_at)
+        times.append((start, start + unit.cost))
+        heapq.heappush(free_at, start + unit.cost)
+
+    return units, times, max(free_at) if len(units) != 0 else 0.
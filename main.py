@@ -6,8 +6,11 @@ import warnings
 import glob2
 import numpy as np
 
-from common import db, my_utils
+from common import db, my_utils, particles_bin
 from common.generator import Generator
+from common.sim_pipeline import SimulationPipeline
+from common.sim_store import SimStore
+from common.stages import OUTPUTS, DEFAULT_OUTPUTS
 
 np.random.seed(0)
 warnings.filterwarnings("ignore")
@@ -114,12 +117,104 @@ def check_arg(args):
                         required=False)
 
     parser.add_argument('--save_envmap',
-                        help='Save environment maps, useful for debug purposes. NOTE: envmap are overwritten if they exist, regardless of the conflict strategy.',
+                        help='Save environment maps, useful for debug purposes (same as adding envmap to --outputs). NOTE: envmap are overwritten if they exist, regardless of the conflict strategy.',
                         action='store_true')
 
+    parser.add_argument('--outputs',
+                        help='Outputs to save, comma-separated among {}. Only the stages they need are computed.'.format(','.join(OUTPUTS)),
+                        type=str,
+                        default=','.join(DEFAULT_OUTPUTS),
+                        required=False)
+
+    parser.add_argument('--cache_dir',
+                        default=os.path.join('data', 'cache'),
+                        help='Where to persist data only depending on the camera geometry (e.g. environment map projection, solid angles), reused across runs',
+                        required=False)
+
+    parser.add_argument('--workers',
+                        help='Number of processes rendering frames in parallel (1 = no parallelism). Output is identical whatever the number of workers.',
+                        type=int,
+                        default=1,
+                        required=False)
+
+    parser.add_argument('--io_threads',
+                        help='Number of threads decoding upcoming frames and encoding rendered ones, while rendering (0 = sequential reading/writing)',
+                        type=int,
+                        default=2,
+                        required=False)
+
+    parser.add_argument('--png_compression',
+                        help='PNG compression level of outputs (0-9, 0 = fastest)',
+                        type=int,
+                        choices=range(10),
+                        default=3,
+                        required=False)
+
+    parser.add_argument('--sprite_angle_step',
+                        help='Quantization step (degrees) of streaks angles, for caching streaks sprites (0 = exact angles, identical to uncached rendering). Mostly useful with noise_scale > 0.',
+                        type=float,
+                        default=0.,
+                        required=False)
+
+    parser.add_argument('--sprite_cache_mb',
+                        help='Memory budget (MB) of the streaks sprites cache',
+                        type=int,
+                        default=256,
+                        required=False)
+
+    parser.add_argument('--asset_cache_mb',
+                        help='Memory budget (MB) of the cache of assets shared by all simulations of a process (streaks textures, particles simulations)',
+                        type=int,
+                        default=1024,
+                        required=False)
+
+    parser.add_argument('--defocus_sigma_step',
+                        help='Bucket the defocus blur sigmas by this step (pixels, e.g. 0.015625) to share the blur kernels across drops (approximation, see README). 0 for exact sigmas.',
+                        type=float,
+                        default=0.,
+                        required=False)
+
+    parser.add_argument('--fast_streaks',
+                        help='Render the Small and Medium streaks of a frame all at once as analytic splats, only Big drops being rendered from sprites (approximation, see README)',
+                        action='store_true')
+
+    parser.add_argument('--tile_threads',
+                        help='Number of threads compositing drops of a frame tile by tile (output is identical), useful for large frames. 0 or 1 to disable.',
+                        type=int,
+                        default=0,
+                        required=False)
+
+    parser.add_argument('--fanout',
+                        help='Render each frame for all intensities at once, reading its inputs once (output is identical). Simulations of all intensities of a sequence are kept loaded.',
+                        action='store_true')
+
+    parser.add_argument('--blend_mode',
+                        help='How drops are blended: "sequential" in the drops order, or "oit" order-independent transmittance accumulation resolved once per frame (differs only where drops overlap, see README)',
+                        choices=['sequential', 'oit'],
+                        default='sequential',
+                        required=False)
+
+    parser.add_argument('--precision',
+                        help='Type of the image sized buffers: "float64" (reference), or "float32" which halves the memory per frame (see README)',
+                        choices=['float64', 'float32'],
+                        default='float64',
+                        required=False)
+
     parser.add_argument('--noverbose',
                         action='store_true')
 
+    parser.add_argument('--log_frames',
+                        help='Print the drops and rendering time of each frame, which main_threaded.py reads from its logs to calibrate its cost model',
+                        action='store_true')
+
+    parser.add_argument('--sim_store',
+                        help='Store particles simulations by hash of their settings and weather in PARTICLES/store, so that sequences sharing their settings share their simulations (see README)',
+                        action='store_true')
+
+    parser.add_argument('--pipeline',
+                        help='Run missing particles simulations (and conversions) in background, rendering each simulation as soon as its particles are ready (see README)',
+                        action='store_true')
+
     parser.add_argument('--force_particles',
                         help='Force particles simulator to run even if simulation exist',
                         action='store_true')
@@ -137,6 +232,12 @@ def check_arg(args):
     assert os.path.exists(results.norm_coeff), ("rainstreakdb database is not valid. Some files are missing.", results.norm_coeff)
 
     results.intensity = [int(i) for i in results.intensity.split(",")]
+    results.outputs = [o for o in results.outputs.split(",") if o != ""]
+    if results.save_envmap and 'envmap' not in results.outputs:
+        results.outputs.append('envmap')
+    assert len(results.outputs) != 0 and np.all([o in OUTPUTS for o in results.outputs]), ("Invalid outputs, choose among", OUTPUTS)
+    assert 'rain_layer' not in results.outputs or (results.blend_mode == 'sequential' and results.tile_threads <= 1 and not results.fast_streaks), \
+        "The rain layer depends on the drops order, it requires --blend_mode sequential without --tile_threads nor --fast_streaks"
     if results.frames:
         results.frames = [int(i) for i in results.frames.split(",")]
 
@@ -189,35 +290,76 @@ def check_arg(args):
     print("\nResolving particles simulations...")
     particles_root = os.path.join(results.particles, results.dataset)
 
+    # Simulations are either stored per sequence, or in the content-addressed store shared by sequences
+    store = SimStore(os.path.join(results.particles, 'store')) if results.sim_store else None
+
     sims_to_run = []
     results.particles = {}
     for seq in results.sequences:
         results.particles[seq] = db.sim(results.dataset, seq, particles_root)
 
         # Check if there is a need to run simulation
-        weathers_to_run = [w for w in results.weather if len(glob2.glob(my_utils.particles_path(results.particles[seq]["path"], w))) == 0 or results.force_particles]
+        backend = results.particles[seq]["options"]["sim_backend"]
+        if backend == "sampler":
+            # Frames are sampled at rendering
+            continue
+        if store is not None:
+            for w in results.weather:
+                path = store.register('{}/{}'.format(results.dataset, seq), results.particles[seq]["options"], w)
+                if len(glob2.glob(my_utils.particles_path(path, w, backend))) == 0 or results.force_particles:
+                    # Sequences sharing a simulation run it once
+                    if path not in [sim["path"][0] for sim in sims_to_run]:
+                        sims_to_run.append({"path": [path], "options": [results.particles[seq]["options"]], "weather": [w]})
+            continue
+        weathers_to_run = [w for w in results.weather if len(glob2.glob(my_utils.particles_path(results.particles[seq]["path"], w, backend))) == 0 or results.force_particles]
         if len(weathers_to_run) != 0:
             sims_to_run.append({"path": [results.particles[seq]["path"]], "options": [results.particles[seq]["options"]], "weather": weathers_to_run})
 
+    if store is not None:
+        store.save()
+        print(" {} sequence(s) use {} stored simulation(s)".format(len(store.entries), len(set(h for e in store.entries.values() for h in e.values()))))
+
+    # With the pipeline, simulations run in background while rendering the simulations ready
+    pipeline = SimulationPipeline() if results.pipeline else None
+
     if len(sims_to_run) == 0:
         print(" All particles simulations ready")
+    elif pipeline is not None:
+        for sim in sims_to_run:
+            for path, options in zip(sim["path"], sim["options"]):
+                for w in sim["weather"]:
+                    pipeline.submit(path, options, w)
+        print(" {} particles simulations to compute... They will run along with the rendering".format(len(pipeline)))
     else:
         print(" {} particles simulations to compute... Simulations will attempt to run automatically using weather particle simulator".format(len(sims_to_run)))
-        for sim in sims_to_run:
-            import tools.particles_simulation
-            tools.particles_simulation.process(sim, force_recompute=True)  # Current script already decided it has to be re-run
+        import tools.particles_simulation
+        tools.particles_simulation.process(sims_to_run, force_recompute=True)  # Current script already decided it has to be re-run
         print(" All particles simulation completed")
 
     # Resolve particle simulation files path
     particles2 = {}
     for seq in results.sequences:
         try:
-            particles2[seq] = [glob2.glob(my_utils.particles_path(results.particles[seq]["path"], w))[0] for w in results.weather]
+            backend = results.particles[seq]["options"]["sim_backend"]
+            if backend == "sampler":
+                particles2[seq] = [None for w in results.weather]
+                continue
+            options = results.particles[seq]["options"]
+            paths = [store.path(options, w) if store is not None else results.particles[seq]["path"] for w in results.weather]
+            patterns = [my_utils.particles_path(path, w, backend) for path, w in zip(paths, results.weather)]
+            # Simulations of the pipeline stand for their particles file until they are ready
+            particles2[seq] = [pattern if pipeline is not None and pipeline.is_pending(pattern) else glob2.glob(pattern)[0] for pattern in patterns]
+            if pipeline is not None and backend != "numpy":
+                # Existing simulations not converted to the binary format yet are converted in background too
+                particles2[seq] = [pipeline.submit(path, options, w, simulate=False) if not pipeline.is_pending(f) and not particles_bin.is_up_to_date(particles_bin.bin_path(f), f) else f
+                                   for path, w, f in zip(paths, results.weather, particles2[seq])]
         except Exception:
             print('Something went wrong, cannot locate particles simulation file for sequence {}'.format(seq))
             print("Might crash later on")
 
+    results.sim_options = {seq: results.particles[seq]["options"] for seq in results.sequences}
     results.particles = particles2
+    results.pipeline = pipeline
 
     return results
 
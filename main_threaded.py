@@ -1,4 +1,5 @@
 import argparse
+import glob
 import os
 import subprocess
 import sys
@@ -10,12 +11,14 @@ import numpy as np
 np.random.seed(0)  # if args.frame_step is the same for each script, the permutation will the same
 sys.path.append(os.path.dirname(__file__))
 
+from common import db, work_planner
+
 
 class RainRendering(threading.Thread):
     def __init__(self, args):
         threading.Thread.__init__(self)
         self.args = args
-        self.dargs = {args[i]: args[i + 1] for i in range(0, len(args), 2) if i < len(args) - 1}
+        self.dargs = {a: args[i + 1] for i, a in enumerate(args[:-1]) if a.startswith('-')}
 
     def toString(self):
         return " ".join(self.args)
@@ -49,11 +52,29 @@ class RainRendering(threading.Thread):
         errfile.close()
 
 
+# Options of main_threaded.py only, not passed to main.py (name: whether it has a value)
+THREADED_OPTIONS = {'--scene_threaded': False, '--scenes_per_thread': True, '--threads': True, '--units_per_thread': True,
+                    '--ms_per_drop': True, '--ms_per_frame': True}
+
+
+def set_option(args, names, value=None):
+    '''
+    Function to remove an option (any of its names) from main.py arguments, and set it to value unless None.
+    '''
+    args = list(args)
+    for i in reversed([i for i, a in enumerate(args) if a in names]):
+        del args[i:i + 2]
+    if value is not None:
+        args += [names[-1], str(value)]
+
+    return args
+
+
 def check_arg(args):
     # Optimized
     parser = argparse.ArgumentParser(description='Rain renderer method')
 
-    parser.add_argument('--intensity',
+    parser.add_argument('-i', '--intensity',
                         help='Rain Intensities. List of fall rate comma-separated. E.g.: 1,15,25,50.',
                         type=str,
                         required=True)
@@ -63,23 +84,24 @@ def check_arg(args):
                         action='store_true',
                         required=False)
 
-    parser.add_argument('--frame_start',
+    parser.add_argument('-fs', '--frame_start',
                         help='frame_start',
                         type=int,
                         default=0,
                         required=False)
 
-    parser.add_argument('--frame_end',
+    parser.add_argument('-fe', '--frame_end',
                         help='frame_end',
                         type=int,
                         default=None,
                         required=False)
 
-    parser.add_argument('--frame_step',
+    parser.add_argument('-fst', '--frame_step',
                         type=int,
+                        default=1,
                         required=False)
 
-    parser.add_argument('--frames',
+    parser.add_argument('-ff', '--frames',
                         type=str,
                         required=False)
 
@@ -88,113 +110,162 @@ def check_arg(args):
                         type=int,
                         default=25)
 
+    parser.add_argument('--threads',
+                        help='Number of renderings run concurrently.',
+                        type=int,
+                        default=10)
+
+    parser.add_argument('--units_per_thread',
+                        help='With --scene_threaded, frames are cut in units of about the same cost, this many per thread. More units balance threads better, but each one loads the simulation and streaks database.',
+                        type=int,
+                        default=4)
+
+    parser.add_argument('--ms_per_drop',
+                        help='Rendering time of a drop (ms) of the cost model (see common/work_planner.py). Default is calibrated from the frames reported by main.py in the logs of previous runs.',
+                        type=float,
+                        default=None)
+
+    parser.add_argument('--ms_per_frame',
+                        help='Rendering time of a frame without drops (ms) of the cost model. Default is calibrated as --ms_per_drop.',
+                        type=float,
+                        default=None)
+
+    # main.py options used to resolve images and particles simulations
+    parser.add_argument('--dataset', type=str, required=True)
+    parser.add_argument('-k', '--dataset_root', default=os.path.join('data', 'source'))
+    parser.add_argument('-d', '--depth', default=os.path.join('data', 'source'))
+    parser.add_argument('-s', '--sequences', type=str, default='')
+    parser.add_argument('-r', '--particles', default=os.path.join('data', 'particles'))
+    parser.add_argument('--sim_store', action='store_true')
+    parser.add_argument('-sd', '--streaks_db')  # Declared so that it is not parsed as -s d
+
     results, _ = parser.parse_known_args(args)
     results.intensity = np.array([int(i) for i in results.intensity.split(",")])
+    results.sequences = [s for s in results.sequences.split(",") if s != '']
 
     print(results)
     return results
 
 
-if __name__ == "__main__":
-    args = check_arg(sys.argv[1:])
-
-    threads = np.zeros((0, 3), object)
-    if args.scenes_per_thread > 1:
-        max_nb_scenes = 111
-        scenes_per_thread = args.scenes_per_thread
+def plan(args, main_args):
+    '''
+    Function to split the renderings in work units, and order them longest first (see common/work_planner.py).
+    :return: List of (unit, main.py arguments, predicted start and end time) ordered, and predicted makespan (ms).
+    '''
+    if args.frames:
+        frames = [int(f) for f in args.frames.split(",")]
     else:
-        max_nb_scenes = 1
-        scenes_per_thread = 1
+        assert args.frame_end or not args.scene_threaded, "--frame_end or --frames is required with --scene_threaded"
+        # Without frame_end, the number of frames is not known here, costs are estimated on ESTIMATE_FRAMES
+        frame_end = args.frame_end if args.frame_end else args.frame_start + work_planner.ESTIMATE_FRAMES
+        frames = list(range(args.frame_start, frame_end, args.frame_step))
+
+    ms_per_drop, ms_per_frame = work_planner.calibrate(glob.glob('automate_log_*.txt'))
+    model = work_planner.CostModel(args.ms_per_drop if args.ms_per_drop is not None else ms_per_drop,
+                                   args.ms_per_frame if args.ms_per_frame is not None else ms_per_frame)
+    images = work_planner.sequences_images(args.dataset, args.dataset_root, args.depth, db.settings(args.dataset))
+    sequences = args.sequences if len(args.sequences) != 0 else [None]  # All sequences, not resolved here
+    for intensity in args.intensity:
+        weather = {"weather": "rain", "fallrate": int(intensity)}
+        for sequence in sequences:
+            if sequence not in images:
+                model.add(sequence, intensity, frames)
+                continue
+            files, imW, imH = images[sequence]
+            sim_db = work_planner.open_simulation(args.dataset, sequence, args.particles, weather, [imW, imH],
+                                                  args.sim_store)
+            model.add(sequence, intensity, frames, sim_db, args.dataset, len(files))
+    print(model)
+
+    # Sequences are grouped by scenes_per_thread, and frames cut in units of balanced cost
+    groups = [sequences[s:s + args.scenes_per_thread] for s in range(0, len(sequences), max(1, args.scenes_per_thread))]
+    units = []
+    for intensity in args.intensity:
+        for group in groups:
+            costs = np.sum([model.costs(sequence, intensity)[1] for sequence in group], axis=0)
+            units.append(work_planner.Unit(intensity, group, frames, costs.sum()))
 
     if args.scene_threaded:
-        assert args.frame_end or args.frames
-        frames_per_thread = 41
-        ix = 0
-
-        for frame_start in range(0, args.frame_end, frames_per_thread):
-            for intensity in args.intensity:
-                c = 0
-                # modified from range(0, ...)
-                for s in range(0, max_nb_scenes, args.scenes_per_thread):
-                    _new_args = sys.argv[1:]
-
-                    # Add existing strategy
-                    _new_args.append('--conflict_strategy')
-                    _new_args.append('skip')
-                    _new_args.remove('--scene_threaded')
-
-                    # In multithread, the progress is a bad idea; it could make the log file EXTREMELY big
-                    if '-v' in _new_args:
-                        _new_args.remove('-v')
-                    _new_args.append('--noverbose')
-
-                    # Replace intensity
-                    _new_args[_new_args.index('--intensity') + 1] = str(intensity)
-                    if not args.frames:
-                        # Replace frame_start
-                        _new_args[_new_args.index('--frame_start') + 1] = str(frame_start)
-                        # Replace frame_end
-                        _new_args[_new_args.index('--frame_end') + 1] = str(min(frame_start + frames_per_thread, args.frame_end))
-                    elif args.jump and args.frames:
-                        _new_args[_new_args.index('--frames') + 1] = ",".join(
-                            [str((int(f) + c) % 41) for f in _new_args[_new_args.index('--frames') + 1].split(',')])
-                        c += args.scenes_per_thread if args.scenes_per_thread else 1
-
-                    if "sequences" in args and args.scenes_per_thread:
-                        _new_args.append('--sequences')
-                        _new_args.append(",".join([str(j) for j in range(s, np.min((s + args.scenes_per_thread, max_nb_scenes)))]))
-
-                    if "--scenes_per_thread" in _new_args:
-                        j = _new_args.index("--scenes_per_thread")
-                        del _new_args[j:j + 2]
-
-                    print("Create thread: ", " ".join(_new_args))
-                    sim = RainRendering(_new_args)
-                    threads = np.vstack([threads, [intensity, ix, sim]])
-                    ix += 1
-    else:
-        for ix, intensity in enumerate(args.intensity):
-            _new_args = sys.argv[1:]
+        target = sum(unit.cost for unit in units) / (args.threads * args.units_per_thread)
+        units = [work_planner.Unit(unit.intensity, unit.sequences, chunk, cost)
+                 for unit in units
+                 for chunk, cost in work_planner.cut(unit.frames, np.sum([model.costs(s, unit.intensity)[1] for s in unit.sequences], axis=0), target)]
+
+    units, times, makespan = work_planner.schedule(units, args.threads)
 
-            # Add existing strategy
-            _new_args.append('--conflict_strategy')
-            _new_args.append('skip')
+    jobs = []
+    for unit, predicted in zip(units, times):
+        _new_args = set_option(main_args, ['-i', '--intensity'], unit.intensity)
 
+        # Add existing strategy
+        _new_args = set_option(_new_args, ['--conflict_strategy'], 'skip')
+
+        # In multithread, the progress is a bad idea; it could make the log file EXTREMELY big
+        if '-v' in _new_args:
+            _new_args.remove('-v')
+        if '--noverbose' not in _new_args:
             _new_args.append('--noverbose')
 
-            # Replace intensity
-            _new_args[_new_args.index('--intensity') + 1] = str(intensity)
+        # Frames are logged to calibrate the cost model of the next runs
+        if '--log_frames' not in _new_args:
+            _new_args.append('--log_frames')
+
+        if unit.sequences != [None]:
+            _new_args = set_option(_new_args, ['-s', '--sequences'], ",".join(unit.sequences))
+
+        if args.scene_threaded:
+            if args.frames:
+                _new_args = set_option(_new_args, ['-ff', '--frames'], ",".join(str(f) for f in unit.frames))
+            else:
+                _new_args = set_option(_new_args, ['-fs', '--frame_start'], unit.frames[0])
+                _new_args = set_option(_new_args, ['-fe', '--frame_end'], unit.frames[-1] + 1)
+
+        jobs.append((unit, _new_args, predicted))
+
+    return jobs, makespan
 
-            print("Create thread: ", " ".join(_new_args))
-            sim = RainRendering(_new_args)
-            threads = np.vstack([threads, [intensity, ix, sim]])
+
+if __name__ == "__main__":
+    args = check_arg(sys.argv[1:])
+
+    main_args = sys.argv[1:]
+    for option, has_value in THREADED_OPTIONS.items():
+        main_args = set_option(main_args, [option]) if has_value else [a for a in main_args if a != option]
+
+    jobs, makespan = plan(args, main_args)
+    threads = []
+    for unit, _new_args, (start, end) in jobs:
+        print("Create thread ({:.0f}mm, {} frames, predicted {:.0f}s to {:.0f}s): {}".format(
+            unit.intensity, len(unit.frames), start / 1000., end / 1000., " ".join(_new_args)))
+        threads.append((RainRendering(_new_args), end))
 
     print("\n---------------")
+    print("{} work units on {} threads, predicted makespan {:.1f}m{}".format(len(threads), args.threads, makespan / 60000.,
+          "" if args.frames or args.frame_end else " (for {} frames per sequence)".format(work_planner.ESTIMATE_FRAMES)))
     print("Note this script does not show real-time output to avoid cumbersome console scrolling. Check ad-hoc logs.")
 
-    # To change, if needed
-    max_thread = 10
+    # Units are started longest first (LPT order), as predicted
+    t0 = time.time()
     while len(threads) > 0:
-        thread_not_started_mask = np.array([not t[2]._started.is_set() for t in threads])
-
-        if np.sum(thread_not_started_mask) > 0:
-            t = threads[thread_not_started_mask][0, 2]
+        not_started = [t for t, _ in threads if not t._started.is_set()]
+        if len(not_started) > 0:
+            t = not_started[0]
             print("\n\n>>> START thread: ", t.toString())
             t.start()
 
         # Wait for an available thread
-        print("Wait for threads")
-        while np.sum([t[2].isAlive() for t in threads]) >= max_thread:
+        while np.sum([t.is_alive() for t, _ in threads]) >= args.threads:
             time.sleep(2)
 
-        thread_ended_mask = np.array([not t[2].isAlive() and t[2]._started.is_set() for t in threads])
-        for t in threads[thread_ended_mask]:
-            print("\nThread ended: ", t[2].toString())
-        threads = threads[~thread_ended_mask]
+        for t, end in threads:
+            if not t.is_alive() and t._started.is_set():
+                print("\nThread ended ({:.1f}m elapsed, predicted {:.1f}m): {}".format(
+                    (time.time() - t0) / 60., end / 60000., t.toString()))
+        threads = [(t, end) for t, end in threads if t.is_alive() or not t._started.is_set()]
 
         # Wait for all threads if no remaining ones
-        if np.sum(np.array([not t[2]._started.is_set() for t in threads])) == 0:
-            while np.sum([t[2].isAlive() for t in threads]) != 0:
+        if len(threads) > 0 and all(t._started.is_set() for t, _ in threads):
+            while np.sum([t.is_alive() for t, _ in threads]) != 0:
                 time.sleep(2)
 
-            print("All threads completed")
+    print("All threads completed ({:.1f}m, predicted {:.1f}m)".format((time.time() - t0) / 60., makespan / 60000.))
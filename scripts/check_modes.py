@@ -0,0 +1,65 @@
+import argparse
+import glob2
+import os
+import subprocess
+import sys
+import cv2
+import numpy as np
+
+
+# Simple script to assess a rendering mode against a reference (golden) rendering, e.g. --blend_mode oit against
+# --blend_mode sequential, or --precision float32 against --precision float64.
+# Renders the same frames with both values of the option and reports the per image differences. With --max_mean_diff
+# and/or --max_diff, exits with an error if rainy images differ more than these bounds (8-bit).
+# Usage: python scripts/check_modes.py --compare OPTION REFERENCE TESTED [bounds] [main.py arguments], e.g.
+#   python scripts/check_modes.py --compare blend_mode sequential oit --dataset kitti --sequences data_object/training --intensity 100 --frame_end 10
+#   python scripts/check_modes.py --compare precision float64 float32 --max_mean_diff 0.01 --max_diff 2 --dataset kitti ...
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--compare', nargs=3, metavar=('OPTION', 'REFERENCE', 'TESTED'), required=True)
+parser.add_argument('--max_mean_diff', type=float, default=None)
+parser.add_argument('--max_diff', type=float, default=None)
+parser.add_argument('--output', default=os.path.join('data', 'check_modes'))
+args, main_args = parser.parse_known_args(sys.argv[1:])
+option, reference, tested = args.compare
+assert '--' + option not in main_args, "--{} is set by --compare".format(option)
+
+db_left = os.path.join(args.output, reference)
+db_right = os.path.join(args.output, tested)
+
+for value, db in [(reference, db_left), (tested, db_right)]:
+    cmd = [sys.executable, 'main.py'] + main_args + ['--output', db, '--' + option, value, '--noverbose']
+    print("Rendering with --{} {}: {}".format(option, value, ' '.join(cmd)))
+    subprocess.check_call(cmd)
+
+p_left = sorted([p[len(db_left)+1:] for p in glob2.glob(os.path.join(db_left, '**', '*.png'))])
+p_right = [p[len(db_right)+1:] for p in glob2.glob(os.path.join(db_right, '**', '*.png'))]
+
+rainy, masks = [], []
+for p in p_left:
+    if p not in p_right or '/envmap/' in p:
+        continue
+
+    im_left = cv2.imread(os.path.join(db_left, p), cv2.IMREAD_UNCHANGED).astype(np.float64)
+    im_right = cv2.imread(os.path.join(db_right, p), cv2.IMREAD_UNCHANGED).astype(np.float64)
+    diff = np.abs(im_left - im_right)
+    mse = np.mean(diff ** 2)
+    psnr = 10 * np.log10(255. ** 2 / mse) if mse > 0 else np.inf
+    stats = [diff.mean(), diff.max(), np.mean(diff > 1), psnr]
+    (masks if '/rain_mask/' in p else rainy).append(stats)
+    print("{:60s} mean {:.4f} max {:3.0f} >1LSB {:.5f} PSNR {:.1f}dB".format(p, *stats))
+
+for name, stats in [("rainy images", rainy), ("rain masks", masks)]:
+    if len(stats) == 0:
+        continue
+    stats = np.array(stats)
+    print("{}: {} compared, mean diff {:.4f}, max diff {:.0f}, >1LSB fraction {:.5f}, min PSNR {:.1f}dB".format(
+        name, len(stats), stats[:, 0].mean(), stats[:, 1].max(), stats[:, 2].mean(), stats[:, 3].min()))
+
+assert len(rainy) > 0, "No rainy images to compare"
+rainy = np.array(rainy)
+if args.max_mean_diff is not None and rainy[:, 0].max() > args.max_mean_diff:
+    sys.exit("FAILED: mean diff {:.4f} > {}".format(rainy[:, 0].max(), args.max_mean_diff))
+if args.max_diff is not None and rainy[:, 1].max() > args.max_diff:
+    sys.exit("FAILED: max diff {:.0f} > {}".format(rainy[:, 1].max(), args.max_diff))
+print("OK")
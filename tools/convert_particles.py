@@ -0,0 +1,44 @@
+import argparse
+import os
+import sys
+
+import glob2
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from common import particles_bin
+from common.bad_weather import DBManager
+
+# Convert particles simulation XML files to the columnar binary format (see common/particles_bin.py).
+# Conversion also happens automatically at rendering, this script allows preparing simulations beforehand.
+# E.g.: python tools/convert_particles.py data/particles/kitti
+
+
+def check_arg(args):
+    parser = argparse.ArgumentParser(description='Particles simulation converter')
+
+    parser.add_argument('paths',
+                        help='Simulation XML files or folders (searched recursively for *_camera0.xml)',
+                        nargs='+')
+
+    parser.add_argument('--force',
+                        help='Convert even if the binary file is up to date',
+                        action='store_true')
+
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = check_arg(sys.argv[1:])
+
+    xml_files = []
+    for p in args.paths:
+        xml_files += glob2.glob(os.path.join(p, '**', '*_camera0.xml')) if os.path.isdir(p) else [p]
+
+    for xml_path in xml_files:
+        bin_path = particles_bin.bin_path(xml_path)
+        if not args.force and particles_bin.is_up_to_date(bin_path, xml_path):
+            print("Up to date {}, next!".format(bin_path))
+            continue
+
+        DBManager(streaks_path_xml=xml_path).convert_xml(bin_path)
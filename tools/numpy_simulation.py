@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from common import particles_bin
+from common.particles_physics import RainSimulator
+
+# Pure NumPy particles simulator (see common/particles_physics.py), a drop-in for the AHLSimulation binary which
+# writes simulations directly in the columnar binary format. Selected with the "sim_backend" setting set to "numpy".
+
+output_name = 'numpy_camera0.npsim'
+
+
+class NumpyWeatherSimulation(threading.Thread):
+    def __init__(self, id, path, options, weather, redo=False):
+        threading.Thread.__init__(self)
+
+        self.id = id
+        self.simtime = 0.  # Time (s)
+        self.simdur = 0.  # Duration (s)
+
+        self.options = options
+        self.path = path
+        self.weather = weather
+        self.redo = redo
+        self.output_dir = os.path.join(self.path, weather["weather"], "{}mm".format(weather["fallrate"]))
+        print("Create thread", self.output_dir)
+
+        assert "preset" not in self.options, "Presets are only supported by the AHLSimulation backend"
+
+    def _print(self, *argv):
+        print("\r #{}  ".format(self.id), end='')
+        print.__call__(*argv)
+
+    def frames(self, sim):
+        for attrs, columns in sim:
+            self.simtime = attrs[0] / self.options["cam_hz"]
+            yield attrs, columns
+
+    def run(self):
+        weather = self.weather
+        output_path = os.path.join(self.output_dir, output_name)
+
+        if not self.redo and particles_bin.is_up_to_date(output_path):
+            self._print("Simulation file exits {}, next!".format(self.output_dir))
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        fallrate = weather["fallrate"] if weather["weather"] == "rain" else 0.
+        sim = RainSimulator(self.options, fallrate, seed=0)
+        self.simdur = sim.frames / self.options["cam_hz"]
+
+        # Options are stored along, as for AHLSimulation
+        options_ = {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in self.options.items()}
+        if "sim_steps" in options_:
+            options_["sim_steps"] = {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in options_["sim_steps"].items()}
+        with open(os.path.join(self.output_dir, "sim_options.json"), 'w') as fp:
+            json.dump(options_, fp)
+
+        t0 = time.time()
+        meta = {"simulator": "numpy", "weather": weather}
+        frames_num, drops_num = particles_bin.write(output_path, self.frames(sim), meta)
+        self._print("Simulation completed: {} drops in {} frames ({:.2f}s)".format(drops_num, frames_num, time.time() - t0))
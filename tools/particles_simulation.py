@@ -1,10 +1,53 @@
+import asyncio
+import os
+import sys
+
 from common import my_utils, db
-from tools.simulation import *
+from tools.numpy_simulation import NumpyWeatherSimulation
 
 force_recompute = False
 particles_root = os.path.join('data', 'particles')
 
-_sim_status = None
+# Memory (bytes) a simulation may use, to bound the number of simulations run concurrently
+memory_per_simulation = 2 << 30
+report_interval = 2.  # Time (s) between progress reports
+
+
+def max_concurrency():
+    '''
+    Function to bound the number of simulations run concurrently by the CPU cores and the available memory.
+    '''
+    cpus = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        # Not available on Windows
+        return cpus
+
+    return max(1, min(cpus, memory // memory_per_simulation))
+
+
+def job_seed(path, weather):
+    '''
+    Function to derive the seed of a simulation from its output folder, so that simulations are reproducible and
+    different from one another without staggering their starts.
+    '''
+    output_dir = os.path.join(path, weather["weather"], "{}mm".format(weather["fallrate"]))
+    return int(my_utils.hash_(output_dir, path=True)[0][:7], 16) + 1
+
+
+def create_simulation(id, path, options, weather, redo=False, deactivate_window_mode=True):
+    '''
+    Function to create the simulation thread of the backend set in options (see "sim_backend" setting).
+    '''
+    if options.get("sim_backend", "ahl") == "numpy":
+        return NumpyWeatherSimulation(id, path, options, weather, redo)
+
+    # Only import when needed, the AHLSimulation wrapper requires a supported platform
+    from tools.simulation import WeatherSimulation
+    return WeatherSimulation(id, path, options, weather, redo, deactivate_window_mode, seed=job_seed(path, weather))
+
+
 def process_sequences(sequences, weathers, force_recompute=False):
     simulations = {"path": [], "options": [], "weather": weathers}
 
@@ -20,57 +63,80 @@ def process_sequences(sequences, weathers, force_recompute=False):
     return process(simulations, force_recompute=force_recompute)
 
 
-def process(sim, force_recompute=False):
-    path, options, weathers = sim["path"], sim["options"], sim["weather"]
-    threads = np.array([], object)
-
-    def print_progress():
-        global _sim_status
-        threads_active = [t for t in threads if t._started.is_set() and t.isAlive()]
-        status = " | ".join(["#{id}: {time:.2f}/{dur:.2f}s".format(id=t.id, time=t.simtime, dur=t.simdur) for t in threads_active])
-        if status == _sim_status:
-            return
-
-        _sim_status = status
-        sys.stdout.write("\r sim. progress: {}".format(_sim_status))
-
-    max_thread = 10
-    deactivate_window_mode = True
-    redo = force_recompute
-    for weather in weathers:
-        for i in range(len(path)):
-            sim = WeatherSimulation(len(threads), path[i], options[i], weather, redo, deactivate_window_mode)
-            threads = np.append(threads, sim)
-
-
-    while len(threads) > 0:
-        thread_not_started_mask = np.array([not t._started.is_set() for t in threads])
-
-        if np.sum(thread_not_started_mask) > 0:
-            t = threads[thread_not_started_mask][0]
-            print("START thread: ", t.output_dir)
-            t.start()
-            # to ensure that the seed (which seems to use the time in sec :| ?!) won't be the same
-            time.sleep(1.5)
-
-        # Wait for an available thread
-        print("Wait for threads")
-        while np.sum([t.isAlive() for t in threads]) >= max_thread:
-            time.sleep(2)
-            print_progress()
-
-        thread_ended_mask = np.array([not t.isAlive() and t._started.is_set() for t in threads])
-        for t in threads[thread_ended_mask]:
-            print("Thread ended: ", t.output_dir)
-        threads = threads[~thread_ended_mask]
-
-        # Wait for all threads if no remaining ones
-        if np.sum(np.array([not t._started.is_set() for t in threads])) == 0:
-            while np.sum([t.isAlive() for t in threads]) != 0:
-                time.sleep(2)
-                print_progress()
-
-            print("All threads completed")
+_sim_status = None
+def print_progress(status):
+    '''
+    Default progress report, prints the simulations running (when changed).
+    '''
+    global _sim_status
+    running = " | ".join(["#{id}: {simtime:.2f}/{simdur:.2f}s".format(**s) for s in status if s["state"] == "running"])
+    done = sum(s["state"] in ["done", "failed"] for s in status)
+    line = "\r sim. progress ({}/{} done): {}".format(done, len(status), running)
+    if line != _sim_status:
+        _sim_status = line
+        sys.stdout.write(line)
+
+
+async def orchestrate(sims, max_jobs=None, report=print_progress):
+    '''
+    Function to run simulations concurrently in an event loop. AHLSimulation dialogs are driven asynchronously (see
+    WeatherSimulation.simulate), numpy simulations run in threads.
+    :param sims: Simulations, see create_simulation.
+    :param max_jobs: Maximum number of simulations run concurrently, default is max_concurrency().
+    :param report: Function called with the status of the simulations periodically, and once all are completed.
+    :return: Status of the simulations, list of dictionaries (id, output_dir, state, simtime, simdur, error).
+    '''
+    max_jobs = max_concurrency() if max_jobs is None else max_jobs
+    semaphore = asyncio.Semaphore(max_jobs)
+    loop = asyncio.get_running_loop()
+    states = [{"state": "queued", "error": None} for _ in sims]
+
+    def status():
+        return [dict(id=sim.id, output_dir=sim.output_dir, simtime=sim.simtime, simdur=sim.simdur, **state)
+                for sim, state in zip(sims, states)]
+
+    async def run(sim, state):
+        async with semaphore:
+            state["state"] = "running"
+            try:
+                if hasattr(sim, 'simulate'):
+                    await sim.simulate()
+                else:
+                    await loop.run_in_executor(None, sim.run)
+                state["state"] = "done"
+            except Exception as e:
+                state["state"], state["error"] = "failed", str(e)
+
+    print("Run {} simulation(s), {} at a time".format(len(sims), max_jobs))
+    jobs = asyncio.gather(*[run(sim, state) for sim, state in zip(sims, states)])
+    while not jobs.done():
+        report(status())
+        await asyncio.wait([jobs], timeout=report_interval)
+
+    report(status())
+    return status()
+
+
+def process(sim, force_recompute=False, max_jobs=None):
+    '''
+    Function to run the simulations of paths and weathers (all combinations).
+    :param sim: Dictionary with lists of simulation "path", "options" and "weather" (see db.sim), or list of them.
+    :return: Status of the simulations, see orchestrate.
+    '''
+    sims = []
+    for s in [sim] if isinstance(sim, dict) else sim:
+        path, options, weathers = s["path"], s["options"], s["weather"]
+        for weather in weathers:
+            for i in range(len(path)):
+                sims.append(create_simulation(len(sims), path[i], options[i], weather, force_recompute))
+
+    status = asyncio.run(orchestrate(sims, max_jobs))
+    print("\nAll simulations completed")
+    for s in status:
+        if s["state"] == "failed":
+            print(" #{} FAILED {}: {}".format(s["id"], s["output_dir"], s["error"]))
+
+    return status
 
 
 if __name__ == "__main__":
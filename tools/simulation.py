@@ -1,25 +1,90 @@
+import asyncio
 import json
 import os
 import platform
-import signal
+import re
 import sys
 import threading
-import time
 
 import numpy as np
-from pexpect.exceptions import ExceptionPexpect
-from pexpect.popen_spawn import PopenSpawn
 
 
-class logwriter():
-    def __init__(self, outbuffer):
-        self._outbuffer = outbuffer
-
-    def write(self, str):
-        self._outbuffer.write(str.decode('ascii'))
+# Timeouts (s) of the dialog with the simulator, instead of fixed waits
+step_timeout = 60.  # Menu prompt
+progress_timeout = 600.  # Simulation progress output (e.g. a simulation time display)
+
+
+class SimulatorError(Exception):
+    pass
+
+
+class SimulatorProcess:
+    '''
+    Asynchronous driver of the menus of the simulator through its stdin/stdout (expect/sendline as with pexpect), so
+    that many simulations are driven by a single event loop (see tools/particles_simulation.py).
+    '''
+    def __init__(self, process, logfile):
+        self.process = process
+        self.logfile = logfile
+        self.buffer = ''
+
+    @classmethod
+    async def start(cls, cmd, cwd, logfile):
+        process = await asyncio.create_subprocess_exec(cmd, cwd=cwd, stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        return cls(process, logfile)
+
+    async def expect(self, patterns, timeout=step_timeout):
+        '''
+        Function to wait for the output to match one of the patterns, consuming the output up to the match.
+        :param patterns: Regular expression, or list of regular expressions.
+        :param timeout: Time (s) after which SimulatorError is raised, None to wait forever.
+        :return: Index of the matched pattern (the first matching in the output).
+        '''
+        patterns = [re.compile(p) for p in ([patterns] if isinstance(patterns, str) else patterns)]
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            matches = [(m.start(), idx, m) for idx, m in enumerate(p.search(self.buffer) for p in patterns) if m is not None]
+            if len(matches) != 0:
+                _, idx, m = min(matches, key=lambda match: match[:2])
+                self.buffer = self.buffer[m.end():]
+                return idx
+
+            try:
+                remaining = None if deadline is None else max(0., deadline - loop.time())
+                data = await asyncio.wait_for(self.process.stdout.read(4096), remaining)
+            except asyncio.TimeoutError:
+                raise SimulatorError("Timeout ({}s) waiting for {}".format(timeout, [p.pattern for p in patterns]))
+            if len(data) == 0:
+                raise SimulatorError("Simulator exited while waiting for {}".format([p.pattern for p in patterns]))
+
+            data = data.decode('ascii', errors='replace')
+            self.logfile.write(data)
+            self.buffer += data
+
+    def sendline(self, line=b''):
+        line = line.encode('ascii') if isinstance(line, str) else line
+        self.logfile.write(line.decode('ascii', errors='replace') + '\n')
+        self.process.stdin.write(line + b'\n')
+
+    async def close(self, timeout=step_timeout):
+        '''
+        Function to wait for the simulator to exit, killing it after timeout (s).
+        '''
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.kill()
 
-    def flush(self):
-        self._outbuffer.flush()
+    async def kill(self):
+        if self.process.returncode is None:
+            self.process.kill()
+        try:
+            # Waiting also waits for the pipes, which children of the simulator may hold
+            await asyncio.wait_for(self.process.wait(), step_timeout)
+        except asyncio.TimeoutError:
+            pass
 
 
 sequence_code = {}
@@ -35,7 +100,7 @@ bin_bitness = 'x64'
 stats_start_time = 5.0  # Stats starting time (s)
 
 class WeatherSimulation(threading.Thread):
-    def __init__(self, id, path, options, weather, redo=False, deactivate_window_mode=True,
+    def __init__(self, id, path, options, weather, redo=False, deactivate_window_mode=True, seed=0,
                  bin_folder=os.path.join(os.getcwd(), "3rdparty", "weather-particle-simulator", "{}_{}".format(bin_platform, bin_bitness))):
         threading.Thread.__init__(self)
 
@@ -53,6 +118,7 @@ class WeatherSimulation(threading.Thread):
         self.weather = weather
         self.deactivate_window_mode = deactivate_window_mode
         self.redo = redo
+        self.seed = seed  # 0 lets the simulator seed itself (from the time in seconds)
         self.bin_folder = bin_folder
         self.output_dir = os.path.join(self.path, weather["weather"], "{}mm".format(weather["fallrate"]))
         print("Create thread", self.output_dir)
@@ -68,181 +134,181 @@ class WeatherSimulation(threading.Thread):
         print("\r #{}  ".format(self.id), end='')
         print.__call__(*argv)
     
-    def interact(self, wait_for, send_str):
+    async def interact(self, wait_for, send_str):
         # print('wait for: {}'.format(wait_for))
-        self.child.expect(wait_for)
+        await self.child.expect(wait_for)
         # print('send: {}'.format(send_str))
         self.child.sendline(send_str.encode('ascii'))
 
-    def interact_step_menu(self, menu):
-        self.interact('Steps: What do you want to do \?', menu)
-
-    def set_sim_steps_times(self, start, dur, last):
-        self.interact_step_menu('2')
-        self.interact('Enter new duration', '{}'.format(start))
-
-        self.interact_step_menu('3')
-        self.interact('Enter new duration', '{}'.format(dur))
-
-        self.interact_step_menu('4')
-        self.interact('Enter new duration', '{}'.format(last))
-
-    def set_sim_steps_camera_focal(self, values):
-        self.interact_step_menu('12')
-        self.interact('What do you want to do \?', '{}'.format(3))
-        self.interact('Separator', '{}'.format(";"))
-        self.interact('Enter all steps values', '{}'.format(";".join(["{}".format(v) for v in values])))
-        self.interact('Continue \?', '{}'.format("y"))
-
-    def set_sim_steps_camera_exposure(self, values):
-        self.interact_step_menu('13')
-        self.interact('What do you want to do \?', '{}'.format(3))
-        self.interact('Separator', '{}'.format(";"))
-        self.interact('Enter all steps values', '{}'.format(";".join(["{}".format(v) for v in values])))
-        self.interact('Continue \?', '{}'.format("y"))
-
-    def set_sim_steps_camera_motion(self, values):
-        self.interact_step_menu('18')
-        self.interact('What do you want to do \?', '{}'.format(3))
-        self.interact('Separator', '{}'.format(";"))
-        self.interact('Enter all steps values', '{}'.format(";".join(["{}".format(v) for v in values])))
-        self.interact('Continue \?', '{}'.format("y"))
-
-    def set_sim_steps_rain_fallrate(self, values):
-        self.interact_step_menu('41')
-        self.interact('What do you want to do \?', '{}'.format(3))
-        self.interact('Separator', '{}'.format(";"))
-        self.interact('Enter all steps values', '{}'.format(";".join(["{}".format(v) for v in values])))
-        self.interact('Continue \?', '{}'.format("y"))
-
-    def interact_main_menu(self, menu):
-        self.interact('What do you want to do \?', menu)
-
-    def set_sim_Duration(self, val):
-        self.interact_main_menu('6')
-        self.interact('Enter new duration', '{}'.format(val))
-
-    def set_sim_Hz(self, val):
-        self.interact_main_menu('7')
-        self.interact('Enter new frequency', '{}'.format(val))
-
-    def set_sim_ParticlesDetectionLatencyFrames(self, val):
-        self.interact_main_menu('61')
-        self.interact('Enter new particles detection latency', '{}'.format(val))
-
-    def set_sim_ParticlesDetectionErrorMargin(self, val):
-        self.interact_main_menu('62')
-        self.interact('Enter new particles detection error', '{}'.format(val))
-
-    def set_sim_Camera0_Hz(self, val):
-        self.interact_main_menu('10')
-        self.interact('Enter new frequency', '{}'.format(val))
-
-    def set_sim_Camera0_ViewMatrixIC(self, pos, lookat, up):
-        self.interact_main_menu('15')
-        self.interact('Enter new IC pos x', '{}'.format(pos[0]))
-        self.interact('Enter new IC pos y', '{}'.format(pos[1]))
-        self.interact('Enter new IC pos z', '{}'.format(pos[2]))
-
-        self.interact('Enter new IC lookat x', '{}'.format(lookat[0]))
-        self.interact('Enter new IC lookat y', '{}'.format(lookat[1]))
-        self.interact('Enter new IC lookat z', '{}'.format(lookat[2]))
-
-        self.interact('Enter new IC up x', '{}'.format(up[0]))
-        self.interact('Enter new IC up y', '{}'.format(up[1]))
-        self.interact('Enter new IC up z', '{}'.format(up[2]))
-
-    def set_sim_Camera0_CcdSpecs(self, width, height, pixsize):
-        self.interact_main_menu('11')
-        self.interact('Camera 0 CCD pxl size', '{}'.format(pixsize))
-        self.interact('Camera 0 CCD width', '{}'.format(width))
-        self.interact('Camera 0 CCD height', '{}'.format(height))
-
-    def set_sim_Camera0_Focal(self, val):
-        self.interact_main_menu('12')
-        self.interact('Enter new focal', '{}'.format(val))
-
-    def set_sim_Camera0_Resolution(self, width, height):
-        self.interact_main_menu('14')
-        self.interact('Camera 0 Resolution WIDTH', '{}'.format(width))
-        self.interact('Camera 0 Resolution HEIGHT', '{}'.format(height))
-
-    def set_sim_Camera0_ExposureTime(self, val):
-        self.interact_main_menu('13')
-        self.interact('Enter new exposure time', '{}'.format(val))
-
-    def set_sim_Camera0_VisibilityMappingAuto(self):
-        self.interact_main_menu('17')
-        self.interact('Enter new visibility mapping MIN', '{}'.format(0))
-        self.interact('Enter new visibility mapping MAX', '{}'.format(0))
-
-    def set_sim_Camera0_MotionSpeedIC(self, val):
-        self.interact_main_menu('18')
-        self.interact('Enter new initial motion speed', '{}'.format(val))
-
-    def set_sim_Projector0_Hz(self, val):
-        self.interact_main_menu('21')
+    async def interact_step_menu(self, menu):
+        await self.interact('Steps: What do you want to do \?', menu)
+
+    async def set_sim_steps_times(self, start, dur, last):
+        await self.interact_step_menu('2')
+        await self.interact('Enter new duration', '{}'.format(start))
+
+        await self.interact_step_menu('3')
+        await self.interact('Enter new duration', '{}'.format(dur))
+
+        await self.interact_step_menu('4')
+        await self.interact('Enter new duration', '{}'.format(last))
+
+    async def set_sim_steps_camera_focal(self, values):
+        await self.interact_step_menu('12')
+        await self.interact('What do you want to do \?', '{}'.format(3))
+        await self.interact('Separator', '{}'.format(";"))
+        await self.interact('Enter all steps values', '{}'.format(";".join(["{}".format(v) for v in values])))
+        await self.interact('Continue \?', '{}'.format("y"))
+
+    async def set_sim_steps_camera_exposure(self, values):
+        await self.interact_step_menu('13')
+        await self.interact('What do you want to do \?', '{}'.format(3))
+        await self.interact('Separator', '{}'.format(";"))
+        await self.interact('Enter all steps values', '{}'.format(";".join(["{}".format(v) for v in values])))
+        await self.interact('Continue \?', '{}'.format("y"))
+
+    async def set_sim_steps_camera_motion(self, values):
+        await self.interact_step_menu('18')
+        await self.interact('What do you want to do \?', '{}'.format(3))
+        await self.interact('Separator', '{}'.format(";"))
+        await self.interact('Enter all steps values', '{}'.format(";".join(["{}".format(v) for v in values])))
+        await self.interact('Continue \?', '{}'.format("y"))
+
+    async def set_sim_steps_rain_fallrate(self, values):
+        await self.interact_step_menu('41')
+        await self.interact('What do you want to do \?', '{}'.format(3))
+        await self.interact('Separator', '{}'.format(";"))
+        await self.interact('Enter all steps values', '{}'.format(";".join(["{}".format(v) for v in values])))
+        await self.interact('Continue \?', '{}'.format("y"))
+
+    async def interact_main_menu(self, menu):
+        await self.interact('What do you want to do \?', menu)
+
+    async def set_sim_Duration(self, val):
+        await self.interact_main_menu('6')
+        await self.interact('Enter new duration', '{}'.format(val))
+
+    async def set_sim_Hz(self, val):
+        await self.interact_main_menu('7')
+        await self.interact('Enter new frequency', '{}'.format(val))
+
+    async def set_sim_ParticlesDetectionLatencyFrames(self, val):
+        await self.interact_main_menu('61')
+        await self.interact('Enter new particles detection latency', '{}'.format(val))
+
+    async def set_sim_ParticlesDetectionErrorMargin(self, val):
+        await self.interact_main_menu('62')
+        await self.interact('Enter new particles detection error', '{}'.format(val))
+
+    async def set_sim_Camera0_Hz(self, val):
+        await self.interact_main_menu('10')
+        await self.interact('Enter new frequency', '{}'.format(val))
+
+    async def set_sim_Camera0_ViewMatrixIC(self, pos, lookat, up):
+        await self.interact_main_menu('15')
+        await self.interact('Enter new IC pos x', '{}'.format(pos[0]))
+        await self.interact('Enter new IC pos y', '{}'.format(pos[1]))
+        await self.interact('Enter new IC pos z', '{}'.format(pos[2]))
+
+        await self.interact('Enter new IC lookat x', '{}'.format(lookat[0]))
+        await self.interact('Enter new IC lookat y', '{}'.format(lookat[1]))
+        await self.interact('Enter new IC lookat z', '{}'.format(lookat[2]))
+
+        await self.interact('Enter new IC up x', '{}'.format(up[0]))
+        await self.interact('Enter new IC up y', '{}'.format(up[1]))
+        await self.interact('Enter new IC up z', '{}'.format(up[2]))
+
+    async def set_sim_Camera0_CcdSpecs(self, width, height, pixsize):
+        await self.interact_main_menu('11')
+        await self.interact('Camera 0 CCD pxl size', '{}'.format(pixsize))
+        await self.interact('Camera 0 CCD width', '{}'.format(width))
+        await self.interact('Camera 0 CCD height', '{}'.format(height))
+
+    async def set_sim_Camera0_Focal(self, val):
+        await self.interact_main_menu('12')
+        await self.interact('Enter new focal', '{}'.format(val))
+
+    async def set_sim_Camera0_Resolution(self, width, height):
+        await self.interact_main_menu('14')
+        await self.interact('Camera 0 Resolution WIDTH', '{}'.format(width))
+        await self.interact('Camera 0 Resolution HEIGHT', '{}'.format(height))
+
+    async def set_sim_Camera0_ExposureTime(self, val):
+        await self.interact_main_menu('13')
+        await self.interact('Enter new exposure time', '{}'.format(val))
+
+    async def set_sim_Camera0_VisibilityMappingAuto(self):
+        await self.interact_main_menu('17')
+        await self.interact('Enter new visibility mapping MIN', '{}'.format(0))
+        await self.interact('Enter new visibility mapping MAX', '{}'.format(0))
+
+    async def set_sim_Camera0_MotionSpeedIC(self, val):
+        await self.interact_main_menu('18')
+        await self.interact('Enter new initial motion speed', '{}'.format(val))
+
+    async def set_sim_Projector0_Hz(self, val):
+        await self.interact_main_menu('21')
         assert(val == "AHL_HZ_MAX")
         # No need to do anything
 
-    def set_sim_Projector0_Res(self, width, height):
-        self.interact_main_menu('22')
+    async def set_sim_Projector0_Res(self, width, height):
+        await self.interact_main_menu('22')
         # No need to do anything
 
-    def set_sim_Projector0_MinPixelOverlay(self, val):
-        self.interact_main_menu('24')
-        self.interact('Enter new minimum pixel overlay', '{}'.format(val))
+    async def set_sim_Projector0_MinPixelOverlay(self, val):
+        await self.interact_main_menu('24')
+        await self.interact('Enter new minimum pixel overlay', '{}'.format(val))
 
-    def set_sim_Projector0_DbgSaveLightmap(self, val):
+    async def set_sim_Projector0_DbgSaveLightmap(self, val):
         while True:
-            self.interact_main_menu('28')
-            obs = self.child.expect(["Projector 0 save light maps \(OFF\)", "Projector 0 save light maps \(ON\)"])
+            await self.interact_main_menu('28')
+            obs = await self.child.expect(["Projector 0 save light maps \(OFF\)", "Projector 0 save light maps \(ON\)"])
             if (val and obs == 1) or (not val and obs == 0):
                 break
 
-    def set_sim_Stats_Active(self, val):
+    async def set_sim_Stats_Active(self, val):
         while True:
-            self.interact_main_menu('70')
-            obs = self.child.expect(["Output simulation stats \(OFF\)", "Output simulation stats \(ON\)"])
+            await self.interact_main_menu('70')
+            obs = await self.child.expect(["Output simulation stats \(OFF\)", "Output simulation stats \(ON\)"])
             if (val and obs == 1) or (not val and obs == 0):
                 break
 
-    def set_sim_Stats_StatsLevel(self, val):
+    async def set_sim_Stats_StatsLevel(self, val):
         while True:
-            self.interact_main_menu('72')
-            obs = self.child.expect(["Stats level \(HIERARCHY\)", "Stats level \(NO HIERARCHY\)"])
+            await self.interact_main_menu('72')
+            obs = await self.child.expect(["Stats level \(HIERARCHY\)", "Stats level \(NO HIERARCHY\)"])
             if (val == "HIERARCHY" and obs == 0) or (val == "NO HIERARCHY" and obs == 1):
                 break
 
-    def set_sim_Stats_StartTime(self, val):
-        self.interact_main_menu('71')
-        self.interact('Enter start time', '{}'.format(val))
+    async def set_sim_Stats_StartTime(self, val):
+        await self.interact_main_menu('71')
+        await self.interact('Enter start time', '{}'.format(val))
 
-    def apply_options(self):
+    async def apply_options(self):
         # Series of hacks to avoid warning due to incompatible parameters
-        self.set_sim_Camera0_CcdSpecs(99999, 99999, 1.0)
+        await self.set_sim_Camera0_CcdSpecs(99999, 99999, 1.0)
 
         # Apply settings
-        self.set_sim_Duration(stats_start_time * 1000 + self.options["sim_duration"] * 1000)
-        self.set_sim_Hz(str(self.options["sim_hz"]))
-        self.set_sim_ParticlesDetectionLatencyFrames(0)
-        self.set_sim_ParticlesDetectionErrorMargin(0)
+        await self.set_sim_Duration(stats_start_time * 1000 + self.options["sim_duration"] * 1000)
+        await self.set_sim_Hz(str(self.options["sim_hz"]))
+        await self.set_sim_ParticlesDetectionLatencyFrames(0)
+        await self.set_sim_ParticlesDetectionErrorMargin(0)
 
         # Camera parameters
-        self.set_sim_Camera0_Hz(self.options["cam_hz"])
-        self.set_sim_Camera0_ViewMatrixIC(self.options["cam_pos"], self.options["cam_lookat"], self.options["cam_up"])
-        self.set_sim_Camera0_Resolution(self.options["cam_WH"][0], self.options["cam_WH"][1])  # Order matters
-        self.set_sim_Camera0_CcdSpecs(self.options["cam_CCD_WH"][0], self.options["cam_CCD_WH"][1], self.options["cam_CCD_pixsize"])  # Order matters
-        self.set_sim_Camera0_Focal(self.options["cam_focal"])
-        self.set_sim_Camera0_ExposureTime(self.options["cam_exposure"])
-        self.set_sim_Camera0_VisibilityMappingAuto()
+        await self.set_sim_Camera0_Hz(self.options["cam_hz"])
+        await self.set_sim_Camera0_ViewMatrixIC(self.options["cam_pos"], self.options["cam_lookat"], self.options["cam_up"])
+        await self.set_sim_Camera0_Resolution(self.options["cam_WH"][0], self.options["cam_WH"][1])  # Order matters
+        await self.set_sim_Camera0_CcdSpecs(self.options["cam_CCD_WH"][0], self.options["cam_CCD_WH"][1], self.options["cam_CCD_pixsize"])  # Order matters
+        await self.set_sim_Camera0_Focal(self.options["cam_focal"])
+        await self.set_sim_Camera0_ExposureTime(self.options["cam_exposure"])
+        await self.set_sim_Camera0_VisibilityMappingAuto()
         # self.set_sim_Camera0_motionSpeedIC = 30
 
         # Projector parameters
-        self.set_sim_Projector0_Hz("AHL_HZ_MAX")
-        self.set_sim_Projector0_Res(self.options["cam_WH"][0], self.options["cam_WH"][1])
-        self.set_sim_Projector0_MinPixelOverlay(50)
-        self.set_sim_Projector0_DbgSaveLightmap(True)
+        await self.set_sim_Projector0_Hz("AHL_HZ_MAX")
+        await self.set_sim_Projector0_Res(self.options["cam_WH"][0], self.options["cam_WH"][1])
+        await self.set_sim_Projector0_MinPixelOverlay(50)
+        await self.set_sim_Projector0_DbgSaveLightmap(True)
 
         # Debug
         # parameters
@@ -252,11 +318,15 @@ class WeatherSimulation(threading.Thread):
         # self.set_sim_Render()->DbgCameraManipViewMatrix(self.set_sim_Camera0_Pos(), self.set_sim_Camera0_Lookat(), self.set_sim_Camera(
         #     0)->Up())
 
-        self.set_sim_Stats_Active(True)
-        self.set_sim_Stats_StartTime("{}".format(stats_start_time*1000))
-        self.set_sim_Stats_StatsLevel("HIERARCHY")
+        await self.set_sim_Stats_Active(True)
+        await self.set_sim_Stats_StartTime("{}".format(stats_start_time*1000))
+        await self.set_sim_Stats_StatsLevel("HIERARCHY")
 
     def run(self):
+        # Simulations run in threads (see tools/particles_simulation.py) each run their own event loop
+        asyncio.run(self.simulate())
+
+    async def simulate(self):
         weather = self.weather
 
         os.makedirs(self.output_dir, exist_ok=True)
@@ -283,34 +353,32 @@ class WeatherSimulation(threading.Thread):
         log_path = os.path.join(self.output_dir, 'automate_log.txt')
         log_fp = open(log_path, 'a+')
         # self._print(self.output_dir)
-        self.child = PopenSpawn(os.path.join(self.bin_folder, 'AHLSimulation'), cwd=self.output_dir, logfile=logwriter(log_fp))
+        self.child = await SimulatorProcess.start(os.path.join(self.bin_folder, 'AHLSimulation'), self.output_dir, log_fp)
 
         try:
             self._print("In main menu")
 
-            self.interact_main_menu('9')
-            self.interact('Set the seed for random generator', '0')
+            await self.interact_main_menu('9')
+            await self.interact('Set the seed for random generator', '{}'.format(self.seed))
 
             if self.preset is None:
                 self._print("Apply options:", self.options)
-                self.apply_options()
+                await self.apply_options()
             else:
                 self._print("Apply preset (ignoring options):", self.preset[:2])
                 if self.preset[0] in sequence_code:
-                    self.interact_main_menu('99')
-                    time.sleep(0.5)
+                    await self.interact_main_menu('99')
 
                     self._print("Setting system")
-                    self.child.expect('Which system to run ?')
+                    await self.child.expect('Which system to run ?')
                     seq_code = sequence_code[self.preset[0]]+self.preset[1]
                     self._print('		System code: ', seq_code)
                     self.child.sendline(seq_code.encode('ascii'))
                 elif "nuscenes" in self.preset[0].lower():
-                    self.interact_main_menu('99')
-                    time.sleep(0.5)
+                    await self.interact_main_menu('99')
 
                     self._print("Setting system")
-                    self.child.expect('Which system to run ?')
+                    await self.child.expect('Which system to run ?')
                     if "2Hz" in self.preset[0]:
                         seq_code = '1000'
                     else:
@@ -323,25 +391,24 @@ class WeatherSimulation(threading.Thread):
             # Deactivate windows AND save light map option
             if self.deactivate_window_mode:
                 self._print("In main menu")
-                self.interact_main_menu('28')
-                time.sleep(0.5)
+                await self.interact_main_menu('28')
                 self._print("	Save light map")
 
             # Deactivate rain particles
             self._print("Deactivating rain particles")
-            self.interact_main_menu('410')
-            self.child.expect('410. Rain \(OFF\)')
+            await self.interact_main_menu('410')
+            await self.child.expect('410. Rain \(OFF\)')
 
             if weather["weather"] == "rain":
                 self._print("Activating rain particles")
                 # Activate rain particles
-                self.interact_main_menu('410')
-                self.child.expect('410. Rain \(ON\)')
+                await self.interact_main_menu('410')
+                await self.child.expect('410. Rain \(ON\)')
 
                 self._print("Setting rain fallrate")
                 # Set rain fallrate
-                self.interact_main_menu('414')
-                self.child.expect('Enter new Rain fall rate')
+                await self.interact_main_menu('414')
+                await self.child.expect('Enter new Rain fall rate')
                 code = str(weather["fallrate"])
                 self.child.sendline(code.encode('ascii'))
 
@@ -359,17 +426,17 @@ class WeatherSimulation(threading.Thread):
                     # Apply initial cam speed
                     if "cam_motion" in self.options["sim_steps"]:
                         speedIC = self.options["sim_steps"]["cam_motion"][0]
-                        self.set_sim_Camera0_MotionSpeedIC(speedIC)
+                        await self.set_sim_Camera0_MotionSpeedIC(speedIC)
 
                 # Actions in step menu
                 if self.options["sim_mode"] == "steps":
                     # Enter step menu
-                    self.interact_main_menu('102')
+                    await self.interact_main_menu('102')
                     _steps_menu = True
 
                     # Set step durations
                     step_dur = 1. / self.options["cam_hz"]
-                    self.set_sim_steps_times(stats_start_time*1000, step_dur*1000, step_dur*1000)
+                    await self.set_sim_steps_times(stats_start_time*1000, step_dur*1000, step_dur*1000)
 
                     # Attempt to compute the total simulation time
                     max_steps = max([len(v) for k,v in self.options["sim_steps"].items()])
@@ -377,22 +444,22 @@ class WeatherSimulation(threading.Thread):
 
                     if "cam_motion" in self.options["sim_steps"]:
                         self._print(" Apply {} steps cam motion: {}".format(len(self.options["sim_steps"]["cam_motion"]), ";".join(["{}".format(v) for v in self.options["sim_steps"]["cam_motion"]])))
-                        self.set_sim_steps_camera_motion(self.options["sim_steps"]["cam_motion"])
+                        await self.set_sim_steps_camera_motion(self.options["sim_steps"]["cam_motion"])
                     if "cam_focal" in self.options["sim_steps"]:
                         self._print(" Apply {} steps cam focal: {}".format(len(self.options["sim_steps"]["cam_focal"]), ";".join(["{}".format(v) for v in self.options["sim_steps"]["cam_focal"]])))
-                        self.set_sim_steps_camera_focal(self.options["sim_steps"]["cam_focal"])
+                        await self.set_sim_steps_camera_focal(self.options["sim_steps"]["cam_focal"])
                     if "cam_exposure" in self.options["sim_steps"]:
                         self._print(" Apply {} steps cam exposure: {}".format(len(self.options["sim_steps"]["cam_exposure"]), ";".join(["{}".format(v) for v in self.options["sim_steps"]["cam_exposure"]])))
-                        self.set_sim_steps_camera_exposure(self.options["sim_steps"]["cam_exposure"])
+                        await self.set_sim_steps_camera_exposure(self.options["sim_steps"]["cam_exposure"])
                     if "rain_fallrate" in self.options["sim_steps"]:
                         self._print(" Apply {} steps rain fallrate: {}".format(len(self.options["sim_steps"]["rain_fallrate"]), ";".join(["{}".format(v) for v in self.options["sim_steps"]["rain_fallrate"]])))
-                        self.set_sim_steps_rain_fallrate(self.options["sim_steps"]["rain_fallrate"])
+                        await self.set_sim_steps_rain_fallrate(self.options["sim_steps"]["rain_fallrate"])
 
                     if self.options["sim_mode"] == "normal":
                         self.simdur = stats_start_time + self.options["sim_duration"]
             else:
                 # Enter step menu
-                self.interact_main_menu('102')
+                await self.interact_main_menu('102')
                 _steps_menu = True
 
             # self._print("Going to step menu")
@@ -420,20 +487,20 @@ class WeatherSimulation(threading.Thread):
                 self._print("In Step menu")
 
             self._print("Starting simulation")
-            self.interact_step_menu('1')
+            await self.interact_step_menu('1')
 
             index = None
             while index != 1:
-                index = self.child.expect(['[0-9]+:[0-9]+:[0-9]+\.[0-9]* +\(p#[0-9]*\)', '\[Simulation stopped\]'], timeout=None)
+                index = await self.child.expect(['[0-9]+:[0-9]+:[0-9]+\.[0-9]* +\(p#[0-9]*\)', '\[Simulation stopped\]'], timeout=progress_timeout)
                 if index == 0:
                     self.simtime += 0.5  # Each time a time is displayed the simulation advanced of 0.5 seconds
 
             self._print("Simulation stopped")
-            time.sleep(5.)  # Wait for the "Press any key to continue"
+            await self.child.expect('Press any key to continue', timeout=progress_timeout)  # Stats are written meanwhile
             self.child.sendline(b'\n')
 
             if _steps_menu:
-                self.child.expect('Steps: What do you want to do \?')
+                await self.child.expect('Steps: What do you want to do \?')
                 self._print("In Step menu")
                 self._print("Going to main menu")
                 self.child.sendline('0'.encode('ascii'))
@@ -441,19 +508,20 @@ class WeatherSimulation(threading.Thread):
 
             self._print("In main menu")
             self._print("Stopping process")
-            self.child.expect('What do you want to do \?')
+            await self.child.expect('What do you want to do \?')
             self.child.sendline('0'.encode('ascii'))
 
-            self.child.expect('Press any key to continue . . .')
+            await self.child.expect('Press any key to continue . . .')
             self.child.sendline(b'\n')
-            self.child.expect('Press any key to continue . . .')
+            await self.child.expect('Press any key to continue . . .')
             self.child.sendline(b'\n')
-        except ExceptionPexpect as e:
+        except SimulatorError as e:
             self._print("ERROR occured. Check the content of the log file to solve: {}".format(log_path))
             self._print(e)
             self._print("If starting python from an IDE, check LD_LIBRARY_PATH environment is accessible (https://youtrack.jetbrains.com/issue/PY-29580)")
-            self.child.kill(signal.SIGINT)
-            exit()
+            await self.child.kill()
+            log_fp.close()
+            raise
         except Exception as e:
             # Might happens at the end of the simulation, if the process closes slightly before last key strike
             self._print(e)
@@ -461,8 +529,7 @@ class WeatherSimulation(threading.Thread):
 
         # Kill process in case it's not dead (cruel world)
         try:
-            self.child.wait()
-            self.child.kill(signal.SIGINT)
+            await self.child.close()
         except Exception:
             pass
 